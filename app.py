@@ -1,31 +1,46 @@
 from flask import (
     Flask, render_template, render_template_string, request, redirect,
     url_for, send_file, jsonify, session, abort, send_from_directory, make_response,
-    flash, current_app
+    flash, current_app, g, has_request_context, Response
 )
 from werkzeug.security import generate_password_hash, check_password_hash
-from docx import Document
-from datetime import timedelta
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from functools import wraps
 from jinja2 import TemplateNotFound
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 import json
 import re
-import pandas as pd
 import io
 import smtplib
 from email.header import Header
 from email.utils import formataddr
 from email.mime.text import MIMEText
 from pathlib import Path
+from urllib.parse import quote, urlsplit
 from uuid import uuid4
-from psycopg2.pool import SimpleConnectionPool
+import psycopg2
+import psycopg2.extensions
 import unicodedata
 import time
+import threading
+import queue
+import hashlib
+import secrets
+import gzip
+import click
+from collections import OrderedDict
 from werkzeug.exceptions import RequestEntityTooLarge
 import os, uuid
 from werkzeug.utils import secure_filename
+import zipfile
+import fcntl
+import tempfile
+import mimetypes
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait as futures_wait
+from concurrent.futures.process import BrokenProcessPool
+import docx_export
 # ========== Flask 应用 ==========
 app = Flask(__name__)
 try:
@@ -103,60 +118,475 @@ app.config["MAX_CONTENT_LENGTH"] = 150 * 1024 * 1024
 load_dotenv()
 app.secret_key = os.getenv("SECRET_KEY", "replace-this-in-prod")
 
+# 部署在 Heroku 路由（反向代理）后面：request.remote_addr 是路由的地址。按代理层数信任 X-Forwarded-For
+# 的最后几跳（路由追加的那一跳客户端伪造不了），按 IP 的限额才是真正按客户端算。不在代理后面时设为 0
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+if TRUSTED_PROXY_HOPS > 0:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
 # 连接池：复用到 Neon 的连接，避免每次请求建链
+# gunicorn 用 -k gthread 多线程跑，SimpleConnectionPool 既不是线程安全的，耗尽时还会直接抛 PoolError；
+# 这里换成线程安全、可等待的池：拿不到连接就排队等到 DB_POOL_TIMEOUT，超时返回 503
 DB_URL = os.getenv("DB_URL", globals().get("DB_URL", ""))
 if not DB_URL:
     raise RuntimeError("DB_URL is not set. Please configure your database DSN.")
-_POOL = SimpleConnectionPool(minconn=1, maxconn=int(os.getenv("DB_POOL_MAX","10")), dsn=DB_URL)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # 秒
+# 空闲超过这么久的连接由后台线程做一次 SELECT 1 校验（取连接时不再发心跳）
+DB_POOL_VALIDATE_IDLE = float(os.getenv("DB_POOL_VALIDATE_IDLE", "30"))  # 秒
+
+# 会话参数只在建链时设置一次（一次往返），不再每次取连接都 SET
+_SESSION_INIT_SQL = (
+    "SET statement_timeout TO 60000; "
+    "SET idle_in_transaction_session_timeout TO 30000"
+)
+
+
+class PoolTimeout(Exception):
+    """在 DB_POOL_TIMEOUT 内没等到空闲连接（由 errorhandler 转成 503）。"""
+
+
+class _InstrumentedPool:
+    """线程安全连接池：空闲连接 LIFO 复用，满了就在 Condition 上等待，附带运行统计。
+
+    取连接时只做本地状态检查（conn.closed / transaction_status），不发心跳；
+    长时间空闲的连接由后台校验线程定期探活，坏连接直接丢弃。
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=10.0,
+                 validate_idle=30.0, connect_kwargs=None):
+        self._dsn = dsn
+        self.minconn = max(0, int(minconn))
+        self.maxconn = max(1, int(maxconn))
+        self.timeout = float(timeout)
+        self.validate_idle = float(validate_idle)
+        # client_encoding 走启动包，不额外往返
+        self._connect_kwargs = {"client_encoding": "UTF8", **(connect_kwargs or {})}
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []        # [(原始连接, 归还时刻)]
+        self._opened = 0       # 已建立（含正在建立/正在校验）的连接数
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._validator = None
+        self._st = {
+            "checkouts": 0, "timeouts": 0, "connects": 0, "discarded": 0,
+            "waits": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+            "hold_ms_total": 0.0, "hold_ms_max": 0.0, "returns": 0,
+            "validations": 0,
+        }
+        # 不在构造时建链（import 阶段零数据库往返）；首次取连接时后台预热到 minconn
+
+    def _connect(self):
+        raw = psycopg2.connect(self._dsn, **self._connect_kwargs)
+        try:
+            with raw.cursor() as c:
+                c.execute(_SESSION_INIT_SQL)
+            raw.commit()
+        except Exception:
+            try: raw.close()
+            except Exception: pass
+            raise
+        with self._cond:
+            self._st["connects"] += 1
+        return raw
+
+    @staticmethod
+    def _usable(raw) -> bool:
+        # 纯本地判断，不产生网络往返
+        if raw.closed:
+            return False
+        try:
+            return raw.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        except Exception:
+            return False
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._opened -= 1
+            self._st["discarded"] += 1
+            self._cond.notify()
+
+    def getconn(self, timeout=None):
+        self._ensure_validator()
+        timeout = self.timeout if timeout is None else timeout
+        t0 = time.monotonic()
+        deadline = t0 + timeout
+        waited = False
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("connection pool is closed")
+                    if self._idle:
+                        raw = self._idle.pop()[0]
+                        break
+                    if self._opened < self.maxconn:
+                        self._opened += 1
+                        raw = None
+                        break
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        self._st["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"no free DB connection within {timeout:.1f}s "
+                            f"(in_use={self._in_use}, max={self.maxconn})"
+                        )
+                    waited = True
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(left)
+                    finally:
+                        self._waiting -= 1
+                self._in_use += 1
+
+            if raw is None:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._opened -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._usable(raw):
+                # 服务端已断开的连接：丢掉换一条
+                with self._cond:
+                    self._in_use -= 1
+                self._discard(raw)
+                continue
+            break
+
+        wait_ms = (time.monotonic() - t0) * 1000.0
+        with self._cond:
+            st = self._st
+            st["checkouts"] += 1
+            if waited:
+                st["waits"] += 1
+            st["wait_ms_total"] += wait_ms
+            if wait_ms > st["wait_ms_max"]:
+                st["wait_ms_max"] = wait_ms
+        return raw
+
+    def putconn(self, raw, close=False, hold_ms=None):
+        keep = not close and not self._closed and not raw.closed
+        if keep:
+            try:
+                status = raw.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    keep = False
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    raw.rollback()
+            except Exception:
+                keep = False
+        if not keep:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+        with self._cond:
+            self._in_use -= 1
+            st = self._st
+            st["returns"] += 1
+            if hold_ms is not None:
+                st["hold_ms_total"] += hold_ms
+                if hold_ms > st["hold_ms_max"]:
+                    st["hold_ms_max"] = hold_ms
+            if keep:
+                self._idle.append((raw, time.monotonic()))
+            else:
+                self._opened -= 1
+                st["discarded"] += 1
+            self._cond.notify()
+
+    # —— 后台空闲校验：把空闲太久的连接拿出来 SELECT 1，坏的丢弃 ——
+    def _ensure_validator(self):
+        if self._validator is not None:
+            return
+        with self._cond:
+            if self._validator is not None:
+                return
+            t = threading.Thread(target=self._validate_loop, name="db-pool-validator", daemon=True)
+            self._validator = t
+        t.start()
+
+    def _prewarm(self):
+        # 后台把空闲连接补到 minconn，失败就算了（请求会按需建链）
+        while True:
+            with self._cond:
+                if self._closed or self._opened >= min(self.minconn, self.maxconn):
+                    return
+                self._opened += 1
+            try:
+                raw = self._connect()
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                return
+            with self._cond:
+                self._idle.append((raw, time.monotonic()))
+                self._cond.notify()
+
+    def _validate_loop(self):
+        self._prewarm()
+        if self.validate_idle <= 0:
+            return
+        while not self._closed:
+            time.sleep(self.validate_idle)
+            try:
+                self.validate_idle_now()
+            except Exception:
+                pass
+
+    def validate_idle_now(self, older_than=None):
+        older_than = self.validate_idle if older_than is None else older_than
+        cutoff = time.monotonic() - older_than
+        with self._cond:
+            stale = [(r, ts) for r, ts in self._idle if ts <= cutoff]
+            if not stale:
+                return 0
+            self._idle = [(r, ts) for r, ts in self._idle if ts > cutoff]
+        for raw, _ in stale:
+            ok = self._usable(raw)
+            if ok:
+                try:
+                    with raw.cursor() as c:
+                        c.execute("SELECT 1")
+                    raw.rollback()
+                except Exception:
+                    ok = False
+            if ok:
+                with self._cond:
+                    self._st["validations"] += 1
+                    self._idle.insert(0, (raw, time.monotonic()))
+                    self._cond.notify()
+            else:
+                self._discard(raw)
+        return len(stale)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for raw, _ in idle:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        with self._cond:
+            st = dict(self._st)
+            st.update(
+                in_use=self._in_use, idle=len(self._idle), opened=self._opened,
+                waiting=self._waiting, max=self.maxconn, timeout_s=self.timeout,
+            )
+        n = st["checkouts"] or 1
+        r = st["returns"] or 1
+        st["wait_ms_avg"] = round(st["wait_ms_total"] / n, 3)
+        st["hold_ms_avg"] = round(st["hold_ms_total"] / r, 3)
+        for k in ("wait_ms_total", "wait_ms_max", "hold_ms_total", "hold_ms_max"):
+            st[k] = round(st[k], 3)
+        return st
+
+
+_POOL = _InstrumentedPool(DB_URL, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                          timeout=DB_POOL_TIMEOUT, validate_idle=DB_POOL_VALIDATE_IDLE)
+
+
+# —— 按路由统计连接占用时长（endpoint -> 次数/总计/最大），/_health/pool 里看 ——
+_ROUTE_HOLD = {}
+_ROUTE_HOLD_LOCK = threading.Lock()
+
+
+def _record_hold(route, hold_ms):
+    with _ROUTE_HOLD_LOCK:
+        st = _ROUTE_HOLD.get(route)
+        if st is None:
+            st = _ROUTE_HOLD[route] = {"n": 0, "ms_total": 0.0, "ms_max": 0.0}
+        st["n"] += 1
+        st["ms_total"] += hold_ms
+        if hold_ms > st["ms_max"]:
+            st["ms_max"] = hold_ms
+
+
+def _route_hold_stats() -> dict:
+    with _ROUTE_HOLD_LOCK:
+        items = [(k, dict(v)) for k, v in _ROUTE_HOLD.items()]
+    out = {}
+    for k, st in sorted(items, key=lambda kv: -kv[1]["ms_total"]):
+        out[k] = {"n": st["n"], "ms_avg": round(st["ms_total"] / st["n"], 3),
+                  "ms_max": round(st["ms_max"], 3), "ms_total": round(st["ms_total"], 3)}
+    return out
 
 
 class _ConnProxy:
-    __slots__ = ("_raw",)
+    __slots__ = ("_raw", "_t0", "_done", "_route")
     def __init__(self, raw):
         self._raw = raw
+        self._t0 = time.monotonic()
+        self._done = False
+        # 流式响应的生成器、CLI、后台线程里没有请求上下文，统一记在 "(background)"
+        self._route = (request.endpoint or "(unmatched)") if has_request_context() else "(background)"
     def __getattr__(self, name):
         return getattr(self._raw, name)
     def close(self):
-        # 把 close 变成“归还连接到连接池”
+        # 把 close 变成“归还连接到连接池”；重复 close 无副作用
+        if self._done:
+            return
+        self._done = True
+        hold_ms = (time.monotonic() - self._t0) * 1000.0
+        _record_hold(self._route, hold_ms)
         try:
-            _POOL.putconn(self._raw)
+            _POOL.putconn(self._raw, hold_ms=hold_ms)
         except Exception:
             try:
                 self._raw.close()
             except Exception:
                 pass
 
-def get_conn():
-    raw = None
-    # 最多两次尝试拿“活的”连接
-    for _ in range(2):
-        conn = _POOL.getconn()
+class _RequestConn(_ConnProxy):
+    """请求级共享连接：同一请求里（含 after_request 钩子）多次 get_conn() 拿到的都是它。
+
+    业务代码里的 conn.close() 只做“逻辑归还”：最外层 close 时回滚未提交事务，
+    物理连接留到 teardown 再还给池，所以一个请求最多只占一次 checkout。
+    """
+    __slots__ = ("_refs", "_txn")
+    def __init__(self, raw):
+        super().__init__(raw)
+        self._refs = 0
+        self._txn = 0   # 每次整事务 commit/rollback +1，嵌套句柄据此判断自己的 savepoint 还在不在
+    def commit(self):
+        self._txn += 1
+        self._raw.commit()
+    def rollback(self):
+        self._txn += 1
+        self._raw.rollback()
+    def close(self):
+        if self._refs > 0:
+            self._refs -= 1
+        if self._refs == 0 and not self._done:
+            try:
+                if (not self._raw.closed and self._raw.info.transaction_status
+                        != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                    self._raw.rollback()
+            except Exception:
+                pass
+    def release(self):
+        _ConnProxy.close(self)
+
+
+class _NestedConn:
+    """请求里嵌套的 get_conn()（外层还拿着连接、事务没结束）拿到的句柄：进来时打一个 savepoint。
+    它的 rollback() 只回滚到 savepoint，不会把外层还没提交的写入一起扔掉；
+    它吞掉错误没回滚就 close 时也先回滚到 savepoint，外层后面的语句不会撞上 "current transaction is aborted"。
+    commit() 仍是整个事务提交（与原来一致），之后 savepoint 随事务结束，不再回滚/释放。"""
+    __slots__ = ("_shared", "_sp", "_txn", "_closed")
+    def __init__(self, shared, sp):
+        self._shared = shared
+        self._sp = sp
+        self._txn = shared._txn
+        self._closed = False
+        with shared._raw.cursor() as c:
+            c.execute(f"SAVEPOINT {sp}")
+    def __getattr__(self, name):
+        return getattr(self._shared, name)
+    def _sp_alive(self):
+        return (self._txn == self._shared._txn and not self._shared._raw.closed
+                and self._shared._raw.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+    def commit(self):
+        self._shared.commit()
+    def rollback(self):
+        if not self._sp_alive():
+            return self._shared.rollback()
+        with self._shared._raw.cursor() as c:
+            c.execute(f"ROLLBACK TO SAVEPOINT {self._sp}")
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
         try:
-            with conn.cursor() as c:
-                c.execute("SELECT 1")  # 心跳
-            raw = conn
-            break
+            if self._sp_alive():
+                with self._shared._raw.cursor() as c:
+                    if self._shared._raw.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                        c.execute(f"ROLLBACK TO SAVEPOINT {self._sp}")
+                    c.execute(f"RELEASE SAVEPOINT {self._sp}")
         except Exception:
-            # 这条连接已经坏了，丢回去并关闭
-            try: _POOL.putconn(conn, close=True)
-            except Exception: pass
-            raw = None
-    if raw is None:
-        # 兜底再取一次（若仍坏，会在后续使用时报错并被上层捕获）
-        raw = _POOL.getconn()
+            pass
+        finally:
+            self._shared.close()
 
-    # 会话参数
-    try:
-        raw.set_client_encoding('UTF8')
-    except Exception:
-        pass
-    try:
-        with raw.cursor() as c:
-            c.execute("SET statement_timeout TO 60000")
-            c.execute("SET idle_in_transaction_session_timeout TO 30000")
-    except Exception:
-        pass
-    return _ConnProxy(raw)
+def get_conn():
+    # 不再发 SELECT 1 / SET：会话参数建链时已设置，存活性由池本地检查 + 后台校验负责
+    if not has_request_context():
+        return _ConnProxy(_POOL.getconn())
+    shared = g.get("_db_conn")
+    if shared is not None and shared._raw.closed:
+        # 请求中途连接断了：还回去（池会丢弃），重新拿一条
+        shared.release()
+        shared = None
+    if shared is None:
+        shared = g._db_conn = _RequestConn(_POOL.getconn())
+    nested = (shared._refs > 0 and shared._raw.info.transaction_status
+              == psycopg2.extensions.TRANSACTION_STATUS_INTRANS)
+    shared._refs += 1
+    if nested:
+        try:
+            return _NestedConn(shared, f"rc_{shared._refs}")
+        except Exception:
+            shared._refs -= 1
+            raise
+    return shared
+
+def get_dedicated_conn():
+    """独立借一条连接（不挂在请求上）：给流式响应等会活过视图函数的场景用，用完必须 close()。"""
+    return _ConnProxy(_POOL.getconn())
+
+def _release_request_conn_early():
+    """后面不再碰数据库的请求：现在就把请求级连接还给池，不等 teardown（渲染、写盘时不占连接）。
+    之后若又调用 get_conn()，会重新借一条。"""
+    if not has_request_context():
+        return
+    shared = g.get("_db_conn")
+    if shared is not None and shared._refs == 0:
+        g.pop("_db_conn", None)
+        shared.release()
+
+@app.teardown_request
+def _release_request_conn(exc=None):
+    shared = g.pop("_db_conn", None)
+    if shared is not None:
+        shared.release()
+
+
+@app.errorhandler(PoolTimeout)
+def _handle_pool_timeout(e):
+    # 连接池耗尽：快速失败，让客户端稍后重试，而不是一直挂着或 500
+    try: current_app.logger.warning("db pool exhausted: %s", e)
+    except Exception: pass
+    wants_json = (
+        request.headers.get("X-Requested-With") == "XMLHttpRequest"
+        or "application/json" in (request.headers.get("Accept") or "").lower()
+        or "/api/" in (request.path or "")
+    )
+    msg = "服务器繁忙，请稍后重试（503）"
+    if wants_json:
+        resp = jsonify({"ok": False, "error": msg})
+    else:
+        resp = make_response(msg)
+        resp.headers["Content-Type"] = "text/plain; charset=utf-8"
+    resp.status_code = 503
+    resp.headers["Retry-After"] = "1"
+    return resp
 
 
 # Gzip 压缩与静态缓存（不改业务逻辑）
@@ -182,7 +612,7 @@ except Exception:
 def _perf_add_cache_headers(resp):
     try:
         ct = resp.headers.get("Content-Type", "")
-        # HTML 不缓存（避免管理端看到旧页）
+        # HTML 不缓存（避免管理端看到旧页）；视图自己设了 Cache-Control 的（如带 ETag 的公开表单页）不覆盖
         if "text/html" in ct:
             resp.headers.setdefault("Cache-Control", "no-store")
         # 静态资源缓存一周（第一次加载后明显加速）
@@ -205,41 +635,150 @@ def _force_utf8_headers(resp):
         pass
     return resp
 
-# === UTF-8 兜底(2)：HTML 没有 <meta charset> 时自动注入 ===
+# === HTML 后处理流水线 ===
+# 以前六个 after_request 钩子各自 get_data(as_text)→lower()→replace→set_data，
+# 3900 行的 create_form.html 每次响应要整页解码/复制/编码好几遍。
+# 现在各处只登记规则（路径匹配 → 插到 </head> 前 / </body> 前的片段，启动时编码成 bytes），
+# 由唯一的 _html_postprocess 在原始 bytes 上定位一次、拼接一次。
+_HTML_RULES = []   # 按 order 排序；同一位置的片段按 order 先后拼接
+
+def _html_rule(name, match, head=None, body=None, order=100):
+    """登记一条注入规则。
+    match(path, endpoint) 返回真值即命中（返回值原样传给动态片段）；
+    head/body 为 str（此处预编码）或 callable(m, buf) -> bytes|None（按请求生成）。"""
+    enc = lambda x: x.encode("utf-8") if isinstance(x, str) else x
+    _HTML_RULES.append({"name": name, "order": order, "match": match,
+                        "head": enc(head), "body": enc(body)})
+    _HTML_RULES.sort(key=lambda r: r["order"])
+
+_RE_HEAD_CLOSE = re.compile(rb"</head>", re.I)
+_RE_BODY_OPEN = re.compile(rb"<body", re.I)
+
+def _apply_html_rules(buf: bytes, path: str, endpoint=None) -> bytes:
+    """对一份 HTML（bytes）应用所有命中的规则；没有任何改动时原样返回 buf。"""
+    heads, bodies = [], []
+    for r in _HTML_RULES:
+        m = r["match"](path, endpoint)
+        if not m:
+            continue
+        for part, out in ((r["head"], heads), (r["body"], bodies)):
+            if part is None:
+                continue
+            piece = part(m, buf) if callable(part) else part
+            if piece:
+                out.append(piece)
+    inserts = []
+    if heads:
+        mh = _RE_HEAD_CLOSE.search(buf) or _RE_BODY_OPEN.search(buf)
+        at = mh.start() if mh else -1
+        if at >= 0:
+            inserts.append((at, b"".join(heads)))
+    if bodies:
+        at = buf.rfind(b"</body>")
+        if at >= 0:
+            inserts.append((at, b"".join(bodies)))
+    if not inserts:
+        return buf
+    inserts.sort(key=lambda x: x[0])
+    mv = memoryview(buf)
+    out, prev = [], 0
+    for at, piece in inserts:
+        out.append(mv[prev:at]); out.append(piece); prev = at
+    out.append(mv[prev:])
+    return b"".join(out)
+
 @app.after_request
-def _ensure_meta_charset(resp):
-    try:
-        if resp.content_type and resp.content_type.startswith("text/html"):
-            html = resp.get_data(as_text=True)
-            low = html.lower()
-            if "</head>" in low and "<meta charset=" not in low:
-                html = html.replace("</head>", '<meta charset="utf-8"></head>', 1)
-                resp.set_data(html)
+def _html_postprocess(resp):
+    try:
+        if (resp.direct_passthrough or resp.is_streamed
+                or resp.status_code in (204, 304) or getattr(resp, "_html_done", False)
+                or not (resp.content_type or "").startswith("text/html")
+                or resp.headers.get("Content-Encoding")):
+            return resp
+        buf = resp.get_data()
+        out = _apply_html_rules(buf, request.path or "", request.endpoint)
+        if out is not buf:
+            resp.set_data(out)
     except Exception:
         pass
     return resp
 
+# === UTF-8 兜底(2)：HTML 没有 <meta charset> 时自动注入 ===
+_RE_META_CHARSET = re.compile(rb"<meta charset=", re.I)
+
+def _meta_charset_snippet(m, buf):
+    if not _RE_HEAD_CLOSE.search(buf) or _RE_META_CHARSET.search(buf):
+        return None
+    return b'<meta charset="utf-8">'
+
+_html_rule("meta-charset", lambda path, ep: True, head=_meta_charset_snippet, order=60)
+
 # SMTP（可选）
 SMTP_SERVER = os.getenv("SMTP_SERVER", "")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587") or 587)
 SENDER_EMAIL = os.getenv("SENDER_EMAIL", "")
 SENDER_PASSWORD = os.getenv("SENDER_PASSWORD", "")
 
-# ========== 用户表 ==========
-def init_user_table():
-    conn = get_conn(); c = conn.cursor()
+# ========== 数据库迁移 ==========
+# 全局表与每个租户 schema 的 DDL 都登记为有序版本，记录在 public.schema_migrations 里；
+# 由 `flask --app app migrate` 在部署时执行（Procfile 的 release 阶段），
+# worker 启动与请求路径都不再跑 DDL。新增迁移只能往列表末尾追加，已发布的版本不要改。
+_MIGRATIONS = {"global": [], "tenant": []}   # scope -> [(version, fn)]
+_GLOBAL_SCOPE = "global"
+
+def _migration(scope: str, version: str):
+    """登记一个迁移步骤：global 的 fn(c)，tenant 的 fn(c, schema_name)。"""
+    def deco(fn):
+        _MIGRATIONS[scope].append((version, fn))
+        return fn
+    return deco
+
+def _ensure_migrations_table(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS public.schema_migrations (
+            scope      TEXT NOT NULL,
+            version    TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, version)
+        )
+    """)
+
+def _applied_versions(c, scope: str) -> set:
+    c.execute("SELECT version FROM public.schema_migrations WHERE scope=%s", (scope,))
+    return {r[0] for r in c.fetchall()}
+
+def _run_migrations(c, kind: str, scope: str, *args) -> list:
+    """在当前事务里按顺序补齐 scope 缺的迁移；返回本次执行的版本号。"""
+    _ensure_migrations_table(c)
+    # 同一个 scope 串行迁移（多个实例同时部署也安全）
+    c.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"formly_migrate:{scope}",))
+    done = _applied_versions(c, scope)
+    ran = []
+    for version, fn in _MIGRATIONS[kind]:
+        if version in done:
+            continue
+        fn(c, *args)
+        c.execute("INSERT INTO public.schema_migrations (scope, version) VALUES (%s, %s)",
+                  (scope, version))
+        ran.append(version)
+    return ran
+
+def _tenant_head() -> str:
+    return _MIGRATIONS["tenant"][-1][0]
+
+# ---- 全局表 ----
+@_migration("global", "0001_users")
+def _m_users(c):
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id SERIAL PRIMARY KEY,
         username TEXT UNIQUE,
         password_hash TEXT,
         role TEXT DEFAULT 'admin'
     )''')
-    conn.commit(); conn.close()
-init_user_table()
 
-# ========= 主 submissions（保留）=========
-def init_main_submissions():
-    conn = get_conn(); c = conn.cursor()
+# 主 submissions（保留）
+@_migration("global", "0002_main_submissions")
+def _m_main_submissions(c):
     c.execute('''CREATE TABLE IF NOT EXISTS submissions (
         id SERIAL PRIMARY KEY,
         name TEXT, phone TEXT, email TEXT,
@@ -252,12 +791,9 @@ def init_main_submissions():
         status TEXT DEFAULT '待审核',
         review_comment TEXT
     )''')
-    conn.commit(); conn.close()
-init_main_submissions()
 
-# ========= form_defs =========
-def init_form_defs():
-    conn = get_conn(); c = conn.cursor()
+@_migration("global", "0003_form_defs")
+def _m_form_defs(c):
     # 统一表结构：schema_json 用 JSONB
     c.execute("""
         CREATE TABLE IF NOT EXISTS form_defs (
@@ -271,11 +807,17 @@ def init_form_defs():
             created_at  TIMESTAMP   DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    # 兜底补列（历史库）
+    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS schema_json JSONB DEFAULT '{}'::jsonb")
+    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS description TEXT")
+    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS created_by  INT")
+    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS db_url      TEXT")
     # 如果历史库里 schema_json 还是 TEXT，这里在线迁移到 JSONB
     c.execute("""
         SELECT data_type
           FROM information_schema.columns
-         WHERE table_name='form_defs' AND column_name='schema_json'
+         WHERE table_schema='public' AND table_name='form_defs' AND column_name='schema_json'
     """)
     row = c.fetchone()
     if row and row[0].lower() in ("text", "character varying"):
@@ -287,13 +829,849 @@ def init_form_defs():
                     ELSE schema_json::jsonb
                  END
         """)
-    # 兜底补列
-    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS description TEXT")
-    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS created_by  INT")
-    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS db_url      TEXT")
-    conn.commit(); conn.close()
-init_form_defs()
+
+@_migration("global", "0004_form_defs_schema_version")
+def _m_form_defs_version(c):
+    # 每次写 schema 都 +1，供进程内缓存判断新旧
+    c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS schema_version BIGINT NOT NULL DEFAULT 1")
+
+# ---- 租户 schema（每个表单一个）----
+@_migration("tenant", "0001_submissions_drafts")
+def _m_tenant_base(c, schema_name):
+    c.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema_name}"')
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS "{schema_name}".submissions (
+            id             SERIAL PRIMARY KEY,
+            user_id        INT,
+            data           JSONB,
+            status         TEXT DEFAULT '待审核',
+            review_comment TEXT,
+            created_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # 草稿表（供 /draft/save）
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS "{schema_name}".drafts (
+            token TEXT PRIMARY KEY,
+            data  JSONB,
+            files JSONB,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+
+@_migration("tenant", "0002_submissions_keyset_idx")
+def _m_tenant_keyset_idx(c, schema_name):
+    # 管理端按 created_at 排序翻页用（id 排序直接走主键）
+    c.execute(f'''CREATE INDEX IF NOT EXISTS submissions_created_id_idx
+                   ON "{schema_name}".submissions (created_at, id)''')
+
+@_migration("tenant", "0003_submissions_search_tsv")
+def _m_tenant_search_tsv(c, schema_name):
+    # 管理端搜索：应用侧切词（CJK 单字+二元组）写入 search_tsv，GIN 索引
+    c.execute(f'ALTER TABLE "{schema_name}".submissions ADD COLUMN IF NOT EXISTS search_tsv TSVECTOR')
+    c.execute(f'''CREATE INDEX IF NOT EXISTS submissions_search_tsv_idx
+                   ON "{schema_name}".submissions USING GIN (search_tsv)''')
+    # 回填旧数据（按 id 分批）
+    last = 0
+    while True:
+        c.execute(f'''SELECT id, data FROM "{schema_name}".submissions
+                       WHERE id > %s AND search_tsv IS NULL ORDER BY id LIMIT 1000''', (last,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        execute_values(c, f'''
+            UPDATE "{schema_name}".submissions s
+               SET search_tsv = array_to_tsvector(v.toks::TEXT[])
+              FROM (VALUES %s) AS v(id, toks)
+             WHERE s.id = v.id''', [(rid, _search_tokens(d)) for rid, d in rows])
+        last = rows[-1][0]
+
+@_migration("tenant", "0004_submissions_lookup")
+def _m_tenant_lookup(c, schema_name):
+    # 公开状态查询：lookup_key（规范化后的姓名）+ receipt（提交回执号），都走索引等值查找
+    c.execute(f'''ALTER TABLE "{schema_name}".submissions
+                   ADD COLUMN IF NOT EXISTS lookup_key TEXT,
+                   ADD COLUMN IF NOT EXISTS receipt TEXT''')
+    c.execute(f'''CREATE INDEX IF NOT EXISTS submissions_lookup_idx
+                   ON "{schema_name}".submissions (lookup_key, created_at DESC, id DESC)''')
+    c.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS submissions_receipt_idx
+                   ON "{schema_name}".submissions (receipt)''')
+    # 回填 lookup_key：需要表单 schema 才知道哪个字段是"姓名"；与写入同一个 _lookup_key 计算
+    _lookup_rekey(c, schema_name, _lookup_field(_tenant_form_schema(c, schema_name)))
+
+@_migration("tenant", "0005_submissions_filter_idx")
+def _m_tenant_filter_idx(c, schema_name):
+    # 管理端字段筛选：data @> {...} 走 jsonb_path_ops GIN；状态 + 时间范围走 btree
+    c.execute(f'''CREATE INDEX IF NOT EXISTS submissions_data_path_idx
+                   ON "{schema_name}".submissions USING GIN (data jsonb_path_ops)''')
+    c.execute(f'''CREATE INDEX IF NOT EXISTS submissions_status_created_idx
+                   ON "{schema_name}".submissions (status, created_at)''')
+
+@_migration("tenant", "0006_chart_rollups")
+def _m_tenant_rollups(c, schema_name):
+    # 图表汇总表：触发器在写入时增量维护，api_charts 直接读计数
+    s = schema_name
+    c.execute(f'''
+        CREATE TABLE IF NOT EXISTS "{s}".rollup_fields (field TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS "{s}".rollup_field (
+            field TEXT NOT NULL, value TEXT NOT NULL, n BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (field, value));
+        CREATE TABLE IF NOT EXISTS "{s}".rollup_daily (day DATE PRIMARY KEY, n BIGINT NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS "{s}".rollup_status (status TEXT PRIMARY KEY, n BIGINT NOT NULL DEFAULT 0);
+
+        CREATE OR REPLACE FUNCTION "{s}".rollup_fields_add(d JSONB, delta INT) RETURNS void
+        LANGUAGE sql AS $fn$
+            INSERT INTO "{s}".rollup_field AS r (field, value, n)
+            SELECT f.field, e.v, delta * COUNT(*)
+              FROM "{s}".rollup_fields f
+             CROSS JOIN LATERAL (
+                    SELECT jsonb_array_elements_text(d -> f.field) AS v
+                     WHERE jsonb_typeof(d -> f.field) = 'array'
+                    UNION ALL
+                    SELECT d ->> f.field
+                     WHERE jsonb_typeof(d -> f.field) NOT IN ('array', 'null')
+             ) e
+             GROUP BY 1, 2
+             ORDER BY 1, 2
+            ON CONFLICT (field, value) DO UPDATE SET n = r.n + EXCLUDED.n
+        $fn$;
+
+        CREATE OR REPLACE FUNCTION "{s}".rollup_status_add(st TEXT, delta INT) RETURNS void
+        LANGUAGE sql AS $fn$
+            INSERT INTO "{s}".rollup_status AS r (status, n)
+            VALUES (COALESCE(NULLIF(btrim(st), ''), '待审核'), delta)
+            ON CONFLICT (status) DO UPDATE SET n = r.n + EXCLUDED.n
+        $fn$;
+
+        CREATE OR REPLACE FUNCTION "{s}".rollup_daily_add(ts TIMESTAMP, delta INT) RETURNS void
+        LANGUAGE sql AS $fn$
+            INSERT INTO "{s}".rollup_daily AS r (day, n)
+            SELECT ts::DATE, delta WHERE ts IS NOT NULL
+            ON CONFLICT (day) DO UPDATE SET n = r.n + EXCLUDED.n
+        $fn$;
+
+        CREATE OR REPLACE FUNCTION "{s}".submissions_rollup() RETURNS trigger
+        LANGUAGE plpgsql AS $fn$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                IF NEW.status IS DISTINCT FROM OLD.status THEN
+                    PERFORM "{s}".rollup_status_add(OLD.status, -1);
+                    PERFORM "{s}".rollup_status_add(NEW.status, 1);
+                END IF;
+                IF NEW.created_at IS DISTINCT FROM OLD.created_at THEN
+                    PERFORM "{s}".rollup_daily_add(OLD.created_at, -1);
+                    PERFORM "{s}".rollup_daily_add(NEW.created_at, 1);
+                END IF;
+                IF NEW.data IS DISTINCT FROM OLD.data THEN
+                    PERFORM "{s}".rollup_fields_add(OLD.data, -1);
+                    PERFORM "{s}".rollup_fields_add(NEW.data, 1);
+                END IF;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM "{s}".rollup_status_add(OLD.status, -1);
+                PERFORM "{s}".rollup_daily_add(OLD.created_at, -1);
+                PERFORM "{s}".rollup_fields_add(OLD.data, -1);
+            ELSE
+                PERFORM "{s}".rollup_status_add(NEW.status, 1);
+                PERFORM "{s}".rollup_daily_add(NEW.created_at, 1);
+                PERFORM "{s}".rollup_fields_add(NEW.data, 1);
+            END IF;
+            RETURN NULL;
+        END
+        $fn$;
+
+        DROP TRIGGER IF EXISTS submissions_rollup ON "{s}".submissions;
+        CREATE TRIGGER submissions_rollup
+            AFTER INSERT OR UPDATE OR DELETE ON "{s}".submissions
+            FOR EACH ROW EXECUTE FUNCTION "{s}".submissions_rollup();
+    ''')
+    _rollup_rebuild(c, s, _rollup_field_keys(_tenant_form_schema(c, s)))
+
+@_migration("tenant", "0007_rollup_shards")
+def _m_tenant_rollup_shards(c, schema_name):
+    # 计数表按 shard 拆行：每个提交都要 +1 的“待审核”和当天那一行原来是全站共用的两行热点，
+    # 并发提交在这两行上排队直到各自事务结束。现在 shard = 后端进程号 % 16，
+    # 不同连接落在不同行，读的时候 SUM（读侧不关心 shard 数）。
+    # shard 数写死在这里：它已经编进各租户的触发函数，要改得另加一个迁移重建函数，不能改已执行的这个。
+    # rollup_fields.ready：保存表单时新登记的字段先不计数（ready=false，图表对它实时聚合），
+    # 由 `flask rollup-backfill` 锁表补算后置 true，请求里不再做整表重算
+    s = schema_name
+    shard = "(pg_backend_pid() % 16)::SMALLINT"
+    c.execute(f'''
+        ALTER TABLE "{s}".rollup_fields ADD COLUMN IF NOT EXISTS ready BOOLEAN NOT NULL DEFAULT TRUE;
+        ALTER TABLE "{s}".rollup_field  ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;
+        ALTER TABLE "{s}".rollup_daily  ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;
+        ALTER TABLE "{s}".rollup_status ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;
+        ALTER TABLE "{s}".rollup_field  DROP CONSTRAINT IF EXISTS rollup_field_pkey,  ADD PRIMARY KEY (field, value, shard);
+        ALTER TABLE "{s}".rollup_daily  DROP CONSTRAINT IF EXISTS rollup_daily_pkey,  ADD PRIMARY KEY (day, shard);
+        ALTER TABLE "{s}".rollup_status DROP CONSTRAINT IF EXISTS rollup_status_pkey, ADD PRIMARY KEY (status, shard);
+
+        CREATE OR REPLACE FUNCTION "{s}".rollup_fields_add(d JSONB, delta INT) RETURNS void
+        LANGUAGE sql AS $fn$
+            INSERT INTO "{s}".rollup_field AS r (field, value, shard, n)
+            SELECT f.field, e.v, {shard}, delta * COUNT(*)
+              FROM "{s}".rollup_fields f
+             CROSS JOIN LATERAL (
+                    SELECT jsonb_array_elements_text(d -> f.field) AS v
+                     WHERE jsonb_typeof(d -> f.field) = 'array'
+                    UNION ALL
+                    SELECT d ->> f.field
+                     WHERE jsonb_typeof(d -> f.field) NOT IN ('array', 'null')
+             ) e
+             WHERE f.ready
+             GROUP BY 1, 2
+             ORDER BY 1, 2
+            ON CONFLICT (field, value, shard) DO UPDATE SET n = r.n + EXCLUDED.n
+        $fn$;
+
+        CREATE OR REPLACE FUNCTION "{s}".rollup_status_add(st TEXT, delta INT) RETURNS void
+        LANGUAGE sql AS $fn$
+            INSERT INTO "{s}".rollup_status AS r (status, shard, n)
+            VALUES (COALESCE(NULLIF(btrim(st), ''), '待审核'), {shard}, delta)
+            ON CONFLICT (status, shard) DO UPDATE SET n = r.n + EXCLUDED.n
+        $fn$;
+
+        CREATE OR REPLACE FUNCTION "{s}".rollup_daily_add(ts TIMESTAMP, delta INT) RETURNS void
+        LANGUAGE sql AS $fn$
+            INSERT INTO "{s}".rollup_daily AS r (day, shard, n)
+            SELECT ts::DATE, {shard}, delta WHERE ts IS NOT NULL
+            ON CONFLICT (day, shard) DO UPDATE SET n = r.n + EXCLUDED.n
+        $fn$;
+    ''')
+
+@_migration("tenant", "0008_upload_blobs")
+def _m_tenant_upload_blobs(c, schema_name):
+    # 上传文件按内容寻址：upload_blobs 一行一份字节（sha256），upload_names 是对外 URL 里的文件名 -> sha256；
+    # refs = 指向该 blob 的文件名个数，由触发器维护，降到 0 的由 `flask uploads-gc` 回收
+    s = schema_name
+    c.execute(f'''
+        CREATE TABLE IF NOT EXISTS "{s}".upload_blobs (
+            sha256     TEXT PRIMARY KEY,
+            size       BIGINT NOT NULL,
+            refs       INT NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE TABLE IF NOT EXISTS "{s}".upload_names (
+            name       TEXT PRIMARY KEY,
+            sha256     TEXT NOT NULL REFERENCES "{s}".upload_blobs(sha256),
+            filename   TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE INDEX IF NOT EXISTS upload_names_sha256_idx ON "{s}".upload_names (sha256);
+
+        CREATE OR REPLACE FUNCTION "{s}".upload_names_refs() RETURNS trigger
+        LANGUAGE plpgsql AS $fn$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                UPDATE "{s}".upload_blobs SET refs = refs - 1 WHERE sha256 = OLD.sha256;
+            ELSE
+                UPDATE "{s}".upload_blobs SET refs = refs + 1 WHERE sha256 = NEW.sha256;
+            END IF;
+            RETURN NULL;
+        END
+        $fn$;
+
+        DROP TRIGGER IF EXISTS upload_names_refs ON "{s}".upload_names;
+        CREATE TRIGGER upload_names_refs
+            AFTER INSERT OR DELETE ON "{s}".upload_names
+            FOR EACH ROW EXECUTE FUNCTION "{s}".upload_names_refs();
+    ''')
+
+@_migration("tenant", "0009_attachments")
+def _m_tenant_attachments(c, schema_name):
+    # 附件索引：每个提交/草稿里的每个上传文件一行，画廊和存储统计直接查它，不再扫 data JSONB。
+    # mime / 宽高是内容属性，记在 upload_blobs 上，写 attachments 时一并带过去
+    s = schema_name
+    c.execute(f'''
+        ALTER TABLE "{s}".upload_blobs ADD COLUMN IF NOT EXISTS mime TEXT;
+        ALTER TABLE "{s}".upload_blobs ADD COLUMN IF NOT EXISTS width INT;
+        ALTER TABLE "{s}".upload_blobs ADD COLUMN IF NOT EXISTS height INT;
+        CREATE TABLE IF NOT EXISTS "{s}".attachments (
+            id            BIGSERIAL PRIMARY KEY,
+            submission_id INT REFERENCES "{s}".submissions(id) ON DELETE CASCADE,
+            draft_token   TEXT,
+            field         TEXT NOT NULL,
+            name          TEXT NOT NULL,
+            url           TEXT NOT NULL,
+            filename      TEXT,
+            mime          TEXT,
+            size          BIGINT,
+            width         INT,
+            height        INT,
+            sha256        TEXT,
+            created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        CREATE INDEX IF NOT EXISTS attachments_submission_idx ON "{s}".attachments (submission_id);
+        CREATE INDEX IF NOT EXISTS attachments_draft_idx ON "{s}".attachments (draft_token)
+            WHERE draft_token IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS attachments_images_idx ON "{s}".attachments (id DESC)
+            WHERE submission_id IS NOT NULL AND mime LIKE 'image/%';
+    ''')
+    # 回填已有提交（按 id 分批）。旧画廊显示的纯文件名 / 外链图片也收进来（legacy=True）。
+    # 宽高要读文件，迁移里不读，由 `flask uploads-meta` 补
+    last = 0
+    while True:
+        c.execute(f'''SELECT id, data, created_at FROM "{s}".submissions
+                       WHERE id > %s ORDER BY id LIMIT 1000''', (last,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        for rid, d, created in rows:
+            _insert_attachments(c, s, _attachment_urls(d, legacy=True), submission_id=rid, created_at=created)
+        last = rows[-1][0]
+
+@_migration("tenant", "0010_submissions_created_keyset")
+def _m_tenant_created_keyset(c, schema_name):
+    # 按 created_at 翻页的排序键是 COALESCE(created_at, '-infinity')：老数据里 created_at 为空的行
+    # 排在最旧的位置（倒序时在最后），游标比较也不会因为 NULL 落空。原 (created_at, id) 索引留给时间范围筛选
+    c.execute(f'''CREATE INDEX IF NOT EXISTS submissions_created_key_idx
+                   ON "{schema_name}".submissions ((COALESCE(created_at, '-infinity'::TIMESTAMP)), id)''')
+
+def _tenant_form_schema(c, schema_name: str) -> dict:
+    """迁移里用：按租户 schema 名反查表单的 schema_json（没有返回 {}）。
+    新站点名只允许 [A-Za-z_][A-Za-z0-9_]*，schema 名就是小写后的站点名，先按它直接取；
+    取不到（历史站点名带大写 / 横线等）再只扫站点名，命中后取那一行。"""
+    c.execute("SELECT schema_json FROM public.form_defs WHERE lower(site_name) = %s ORDER BY site_name = %s DESC LIMIT 1",
+              (schema_name, schema_name))
+    row = c.fetchone()
+    if row is None:
+        c.execute("SELECT site_name FROM public.form_defs")
+        site = next((sn for (sn,) in c.fetchall() if _safe_schema(sn) == schema_name), None)
+        if site is not None:
+            c.execute("SELECT schema_json FROM public.form_defs WHERE site_name = %s", (site,))
+            row = c.fetchone()
+    sj = row[0] if row else None
+    if isinstance(sj, str):
+        sj = json.loads(sj or "{}")
+    return sj if isinstance(sj, dict) else {}
+
+def migrate_global(conn) -> list:
+    c = conn.cursor()
+    try:
+        ran = _run_migrations(c, "global", _GLOBAL_SCOPE)
+        conn.commit()
+        return ran
+    except Exception:
+        conn.rollback()
+        raise
+
+def migrate_tenant(conn, schema_name: str) -> list:
+    c = conn.cursor()
+    try:
+        ran = _run_migrations(c, "tenant", schema_name, schema_name)
+        conn.commit()
+        return ran
+    except Exception:
+        conn.rollback()
+        raise
+
+@app.cli.command("migrate")
+@click.option("--site", "sites", multiple=True, help="只迁移指定站点（可重复）；默认全局表 + 全部站点")
+def migrate_command(sites):
+    """执行数据库迁移：全局表 + 每个表单的租户 schema。"""
+    conn = get_conn()
+    try:
+        ran = migrate_global(conn)
+        click.echo(f"[global] {', '.join(ran) if ran else 'up to date'}")
+        if not sites:
+            c = conn.cursor()
+            c.execute("SELECT site_name FROM form_defs ORDER BY id")
+            sites = [r[0] for r in c.fetchall()]
+            conn.rollback()
+        for site in sites:
+            schema_name = _safe_schema(site)
+            ran = migrate_tenant(conn, schema_name)
+            click.echo(f"[{schema_name}] {', '.join(ran) if ran else 'up to date'}")
+            c = conn.cursor()
+            done = _rollup_backfill(c, schema_name)   # 发布时顺带补算上次发布以来新登记的图表字段
+            conn.commit()
+            if done:
+                click.echo(f"[{schema_name}] rollup backfilled {', '.join(done)}")
+    finally:
+        conn.close()
+
+# ========= form_defs 进程内缓存 =========
+# 几乎每个路由都要先读 form_defs.schema_json；这里按 site_name 做 LRU 缓存（每个 worker 一份）。
+# 写 schema 的地方 schema_version+1 并 pg_notify，所有 worker 的监听线程收到后淘汰本地副本；
+# 监听线程不在线时退化为短 TTL，保证最多几秒的陈旧。
+FORM_CACHE_SIZE = int(os.getenv("FORM_CACHE_SIZE", "512"))
+FORM_CACHE_TTL = float(os.getenv("FORM_CACHE_TTL", "300"))                # 秒（监听正常时）
+FORM_CACHE_TTL_DEGRADED = float(os.getenv("FORM_CACHE_TTL_DEGRADED", "5"))  # 秒（监听断开时）
+FORM_CACHE_LISTEN = os.getenv("FORM_CACHE_LISTEN", "1") != "0"
+_FORM_DEFS_CHANNEL = "formly_form_defs"
+
+
+class _FormDefCache:
+    """线程安全的 LRU：site_name -> 带 version/loaded_at 的字典（form_def、渲染好的页面）。
+    缓存里的内容只读，调用方不要原地修改。
+    回填用 generation：读库前 gen = generation(key)，put(key, ent, gen)；其间有过 evict 的话这次 put 作废，
+    否则“写之前读到的旧定义”会在写入方 evict 之后才 put 进来，一直用到 TTL 过期。"""
+
+    def __init__(self, maxsize=512):
+        self.maxsize = max(1, int(maxsize))
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0          # 整体淘汰（"*"）计数
+        self._gens = {}          # key -> 单独淘汰计数
+        self.hits = self.misses = self.evictions = 0
+
+    def generation(self, site_name):
+        with self._lock:
+            return (self._epoch, self._gens.get(site_name, 0))
+
+    def get(self, site_name, max_age):
+        with self._lock:
+            ent = self._data.get(site_name)
+            if ent is not None and time.monotonic() - ent["loaded_at"] <= max_age:
+                self._data.move_to_end(site_name)
+                self.hits += 1
+                return ent
+            self.misses += 1
+            return None
+
+    def put(self, site_name, ent, gen=None):
+        with self._lock:
+            if gen is not None and gen != (self._epoch, self._gens.get(site_name, 0)):
+                return   # 读库之后有过淘汰：这份可能是旧的，不进缓存（本次请求照常用）
+            cur = self._data.get(site_name)
+            # 并发回填时不让旧版本覆盖新版本
+            if cur is not None and cur["version"] > ent["version"]:
+                return
+            self._data[site_name] = ent
+            self._data.move_to_end(site_name)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def evict(self, site_name=None):
+        with self._lock:
+            if site_name is None or site_name == "*":
+                self.evictions += len(self._data)
+                self._data.clear()
+                self._epoch += 1
+                self._gens.clear()
+                return
+            if self._data.pop(site_name, None) is not None:
+                self.evictions += 1
+            if len(self._gens) >= 4 * self.maxsize and site_name not in self._gens:
+                self._epoch += 1      # 计数表太大：整体进一代（在途的回填都作废，偏保守）
+                self._gens.clear()
+            self._gens[site_name] = self._gens.get(site_name, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "max": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+_FORM_CACHE = _FormDefCache(FORM_CACHE_SIZE)
+# 公开表单页的整页缓存：site_name -> {"version","assets","loaded_at","etag","body","gz"}，
+# 表单版本或静态资源版本对不上即重渲染
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "256"))
+_PAGE_CACHE = _FormDefCache(PAGE_CACHE_SIZE)
+
+
+def _static_version() -> str:
+    """静态资源版本：ASSET_VERSION 环境变量，否则 static/ 下文件最新的 mtime。
+    同机各 worker 算出来一样（ETag 不会因为落到不同 worker 而对不上），发布换了 JS/CSS 就变。"""
+    v = os.getenv("ASSET_VERSION")
+    if v:
+        return v
+    latest = 0
+    for root, _, names in os.walk(app.static_folder or "static"):
+        for name in names:
+            try:
+                latest = max(latest, int(os.path.getmtime(os.path.join(root, name))))
+            except OSError:
+                pass
+    return str(latest)
+
+
+ASSET_VERSION = _static_version()
+
+
+# —— LISTEN/NOTIFY：每个 worker 一条独立的非池化连接 ——
+# Neon 的 -pooler 端点（事务模式 PgBouncer）不支持 LISTEN，默认去掉 -pooler 走直连
+DB_LISTEN_URL = os.getenv("DB_LISTEN_URL") or re.sub(r"-pooler(?=\.)", "", DB_URL, count=1)
+_NOTIFY_HANDLERS = {}      # channel -> handler(payload)
+_LISTENER = {"thread": None, "ok": False, "lock": threading.Lock()}
+
+
+def _on_notify(channel: str):
+    """注册某个 NOTIFY 频道的处理函数（在监听线程里调用）。"""
+    def deco(fn):
+        _NOTIFY_HANDLERS[channel] = fn
+        return fn
+    return deco
+
+
+def _listener_loop():
+    import select
+    backoff = 1.0
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DB_LISTEN_URL, client_encoding="UTF8")
+            conn.autocommit = True
+            with conn.cursor() as c:
+                for ch in _NOTIFY_HANDLERS:
+                    c.execute(f"LISTEN {ch}")
+            # 断线期间可能漏掉通知：重连后把依赖通知的缓存全部作废
+            for fn in _NOTIFY_HANDLERS.values():
+                fn("*")
+            _LISTENER["ok"] = True
+            backoff = 1.0
+            while True:
+                if select.select([conn], [], [], 60)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        fn = _NOTIFY_HANDLERS.get(n.channel)
+                        if fn:
+                            try: fn(n.payload or "*")
+                            except Exception: pass
+                else:
+                    with conn.cursor() as c:
+                        c.execute("SELECT 1")  # 空闲保活，顺便发现断线
+        except Exception as e:
+            _LISTENER["ok"] = False
+            try: app.logger.warning("notify listener down: %s", e)
+            except Exception: pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+        finally:
+            if conn is not None:
+                try: conn.close()
+                except Exception: pass
+
+
+def _ensure_listener():
+    if not FORM_CACHE_LISTEN or _LISTENER["thread"] is not None:
+        return
+    with _LISTENER["lock"]:
+        if _LISTENER["thread"] is not None:
+            return
+        t = threading.Thread(target=_listener_loop, name="db-notify-listener", daemon=True)
+        _LISTENER["thread"] = t
+    t.start()
+
+
+@_on_notify(_FORM_DEFS_CHANNEL)
+def _on_form_defs_changed(site_name):
+    _FORM_CACHE.evict(site_name)
+    _PAGE_CACHE.evict(site_name)
+
+
+_DESC_KEYS = ("desc", "descHTML", "description", "help", "helpText")
+_NAME_HINTS = ("姓名", "名字", "name", "fullname", "full_name", "realname", "real_name")
+_RE_TAGS = re.compile(r"<[^>]+>")
+_RECEIPT_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"   # 去掉 0/O、1/I/L 等易混字符
+_RE_RECEIPT = re.compile(r"^[%s]{10}$" % _RECEIPT_ALPHABET)
+
+
+def _lookup_field(schema: dict):
+    """状态查询用哪个字段做 lookup_key：优先 key/标题像"姓名"的字段，其次第一个文本字段。"""
+    fields = schema.get("fields") if isinstance(schema, dict) else None
+    if not isinstance(fields, list):
+        return None
+    first_text = None
+    for f in fields:
+        if not isinstance(f, dict):
+            continue
+        key = f.get("key") or f.get("id")
+        if not key:
+            continue
+        label = _RE_TAGS.sub("", str(f.get("label") or f.get("labelHTML") or "")).strip().lower()
+        if str(key).lower() in _NAME_HINTS or any(h in label for h in _NAME_HINTS):
+            return str(key)
+        if first_text is None and str(f.get("type") or "text").lower() == "text":
+            first_text = str(key)
+    return first_text
+
+
+def _lookup_norm(v) -> str:
+    """姓名规范化：全角转半角、去空白、小写。"""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(v or ""))).lower()
+
+
+def _lookup_key(data, field):
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except Exception:
+            return None
+    if not field or not isinstance(data, dict):
+        return None
+    v = data.get(field)
+    if isinstance(v, list):
+        v = v[0] if v else ""
+    return _lookup_norm(v)[:200] or None
+
+
+def _lookup_rekey(c, schema_name: str, field) -> int:
+    """按当前"姓名"字段重算整表的 lookup_key，只改结果不同的行，返回改了多少行。
+    键由 _lookup_key 算（写入、查询用的是同一个函数，不在 SQL 里另写一份规范化）；
+    按 id 分批，每批只取那一个字段的值，改动用一条 UPDATE ... FROM (VALUES ...) 写回。"""
+    last, changed = 0, 0
+    while True:
+        c.execute(f'''SELECT id, data -> %s, lookup_key FROM "{schema_name}".submissions
+                       WHERE id > %s ORDER BY id LIMIT 1000''', (field or "", last))
+        rows = c.fetchall()
+        if not rows:
+            break
+        pairs = [(rid, k) for rid, v, old in rows
+                 for k in [_lookup_key({field: v}, field) if field else None] if k != old]
+        if pairs:
+            execute_values(c, f'''
+                UPDATE "{schema_name}".submissions s
+                   SET lookup_key = v.k
+                  FROM (VALUES %s) AS v(id, k)
+                 WHERE s.id = v.id''', pairs, template="(%s, %s::TEXT)")
+            changed += len(pairs)
+        last = rows[-1][0]
+    return changed
+
+
+def _new_receipt() -> str:
+    return "".join(secrets.choice(_RECEIPT_ALPHABET) for _ in range(10))
+
+
+def _cfg_int(v, default: int, lo: int = 1) -> int:
+    """schema 里手填的数字：解析不了就用默认值（编译在缓存回填里跑，一个坏值不能让所有页面 500）。"""
+    try:
+        return max(lo, int(v))
+    except (TypeError, ValueError):
+        return default
+
+
+def _compile_form(schema: dict, name: str = "", description: str = "") -> dict:
+    """把 schema 预编译成渲染/收件要用的"计划"（只读）。
+    公开页、预览、提交、草稿原来各自每次请求重新推导这些值；现在随 form_def 一起缓存，
+    schema 变了（schema_version 递增）才重新编译一次。"""
+    schema = schema if isinstance(schema, dict) else {}
+
+    # 主题/外观（公开页语义）
+    theme = schema.get("theme") if isinstance(schema.get("theme"), dict) else {}
+    brand_light = str(theme.get("brand_light") or theme.get("brand") or "#2563eb").strip()
+    brand_dark  = str(theme.get("brand_dark")  or theme.get("brand") or "#0ea5e9").strip()
+    theme_mode  = str(theme.get("mode") or theme.get("theme_mode") or theme.get("appearance") or "auto").lower()
+    if theme_mode not in ("light", "dark", "auto"):
+        theme_mode = "auto"
+
+    # 上传配置
+    settings = schema.get("settings") if isinstance(schema.get("settings"), dict) else {}
+    upload_cfg = schema.get("upload") or settings.get("upload") or {}
+    upload_cfg = upload_cfg if isinstance(upload_cfg, dict) else {}
+    allowed = frozenset(
+        x.strip().lower()
+        for x in str(upload_cfg.get("allowed_file_types", "")).split(",")
+        if x.strip()
+    )
+
+    # 字段（仅去掉描述类键，其他不动）
+    raw_fields = schema.get("fields") or []
+    if not isinstance(raw_fields, list):
+        raw_fields = []
+    clean_fields = []
+    for f in raw_fields:
+        if not isinstance(f, dict):
+            continue
+        fld = dict(f)
+        for k in _DESC_KEYS:
+            fld.pop(k, None)
+        clean_fields.append(fld)
+
+    # 兜底字段（仅用于 TemplateNotFound 回退）
+    fields_fallback = [{
+        "label": f.get("labelHTML") or f.get("label") or f.get("key", ""),
+        "type": (f.get("type") or "text"),
+        "key":  (f.get("key") or f.get("id")),
+        "options": f.get("options") or [],
+        "required": bool(f.get("required", False)),
+    } for f in clean_fields]
+
+    header = schema.get("header") if isinstance(schema.get("header"), dict) else {}
+    display = schema.get("display") if isinstance(schema.get("display"), dict) else {}
+    return {
+        "title": name or schema.get("title") or schema.get("name") or "",
+        "desc_html": (schema.get("descHTML") or schema.get("desc") or schema.get("description")
+                      or (description or "").strip()),
+        "brand_light": brand_light, "brand_dark": brand_dark, "theme_mode": theme_mode,
+        "admin_theme": _read_theme(schema),
+        "upload_max_files": _cfg_int(upload_cfg.get("max_files") or 3, 3),
+        "allowed": allowed,
+        "clean_fields": clean_fields,
+        "fields_fallback": fields_fallback,
+        "has_file": any(str(f.get("type") or "").lower() == "file" for f in clean_fields),
+        "header_image": (header.get("title_image") or display.get("title_image")
+                         or display.get("cover_image") or ""),
+        "header_image_pos": (header.get("title_image_pos") or display.get("title_image_pos") or "center"),
+        "schema_json": json.dumps(schema, ensure_ascii=False),
+        "lookup_field": _lookup_field(schema),
+    }
+
+
+def _form_plan_context(plan: dict) -> dict:
+    """public_form.html 的公共模板参数。"""
+    return {
+        "form_title": plan["title"], "form_desc": plan["desc_html"],
+        "fields": plan["clean_fields"],
+        "brand_light": plan["brand_light"], "brand_dark": plan["brand_dark"],
+        "theme_mode": plan["theme_mode"], "has_file": plan["has_file"],
+        "upload_max_files": plan["upload_max_files"], "schema_json": plan["schema_json"],
+        "header_image": plan["header_image"], "header_image_pos": plan["header_image_pos"],
+    }
+
+
+def _render_form_fallback(site_name: str, plan: dict):
+    brand = plan["brand_dark"] if plan["theme_mode"] == "dark" else plan["brand_light"]
+    return render_template_string(
+        PUBLIC_FORM_HTML,
+        site_name=site_name,
+        form_name=plan["title"],
+        form_desc=plan["desc_html"],
+        fields=plan["fields_fallback"],
+        brand=brand,
+    )
+
+
+def _get_form_def(site_name: str):
+    """按 site_name 取表单定义（走缓存）。返回
+    {"id","name","site_name","schema","description","version","loaded_at","plan"}；不存在返回 None。
+    plan 见 _compile_form。"""
+    _ensure_listener()
+    max_age = FORM_CACHE_TTL if _LISTENER["ok"] else FORM_CACHE_TTL_DEGRADED
+    ent = _FORM_CACHE.get(site_name, max_age)
+    if ent is not None:
+        return ent
+    gen = _FORM_CACHE.generation(site_name)
+    conn = get_conn(); c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT id, name, schema_json, COALESCE(description,''::TEXT), schema_version
+              FROM form_defs
+             WHERE site_name=%s
+        """, (site_name,))
+        row = c.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    schema = row[2] if isinstance(row[2], dict) else (json.loads(row[2]) if row[2] else {})
+    ent = {
+        "id": row[0], "name": row[1], "site_name": site_name,
+        "schema": schema if isinstance(schema, dict) else {},
+        "description": row[3] or "", "version": int(row[4] or 1),
+        "loaded_at": time.monotonic(),
+    }
+    ent["plan"] = _compile_form(ent["schema"], ent["name"], ent["description"])
+    _FORM_CACHE.put(site_name, ent, gen)
+    return ent
+
+
+def _form_plan(site_name: str):
+    """读取站点的预编译计划（只读）；表单不存在返回 None。"""
+    ent = _get_form_def(site_name)
+    return ent["plan"] if ent else None
+
+
+def _form_schema(site_name: str):
+    """读取站点 schema_json（dict，只读）；表单不存在返回 None。"""
+    ent = _get_form_def(site_name)
+    return ent["schema"] if ent else None
+
+
+def _notify_form_changed(c, site_name: str = "*"):
+    """在写 form_defs 的同一事务里调用：提交后通知所有 worker 淘汰缓存。"""
+    c.execute("SELECT pg_notify(%s, %s)", (_FORM_DEFS_CHANNEL, site_name))
+
+
+def _form_changed_local(site_name: str = "*"):
+    """提交后立即淘汰本 worker 的缓存（不等监听线程回调）。"""
+    _FORM_CACHE.evict(site_name)
+    _PAGE_CACHE.evict(site_name)
+
+
+# —— 提交数据版本：新增/审核/删除提交时 +1，用作图表等结果缓存的失效依据 ——
+_SUBMISSIONS_CHANNEL = "formly_submissions"
+_SUB_VERSIONS = {}          # site_name -> int
+_SUB_EPOCH = [0]            # 监听断线重连（可能漏通知）时整体 +1
+_SUB_LOCK = threading.Lock()
+
+
+def _submissions_version(site_name: str):
+    with _SUB_LOCK:
+        return (_SUB_EPOCH[0], _SUB_VERSIONS.get(site_name, 0))
+
+
+@_on_notify(_SUBMISSIONS_CHANNEL)
+def _submissions_changed_local(site_name: str = "*"):
+    with _SUB_LOCK:
+        if site_name == "*":
+            _SUB_EPOCH[0] += 1
+        else:
+            _SUB_VERSIONS[site_name] = _SUB_VERSIONS.get(site_name, 0) + 1
+
+
+def _notify_submissions_changed(c, site_name: str):
+    """在写 submissions 的同一事务里调用：提交后通知所有 worker。"""
+    c.execute("SELECT pg_notify(%s, %s)", (_SUBMISSIONS_CHANNEL, site_name))
+
+
+class _SingleFlightCache:
+    """TTL + 版本的结果缓存；同一 key 并发未命中时只让一个线程计算，其余等它的结果。"""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = max(1, int(maxsize))
+        self._data = OrderedDict()      # key -> (version, expires_at, value)
+        self._inflight = {}             # key -> {"ev": Event, "version", "value"}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = 0
+
+    def get_or_compute(self, key, version, ttl, fn, cacheable=lambda v: True, wait=30.0):
+        now = time.monotonic()
+        with self._lock:
+            ent = self._data.get(key)
+            if ent is not None and ent[0] == version and ent[1] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return ent[2]
+            fl = self._inflight.get(key)
+            if fl is not None and fl["version"] == version:
+                self.coalesced += 1
+                leader = False
+            else:
+                fl = {"ev": threading.Event(), "version": version, "value": None, "ok": False}
+                self._inflight[key] = fl
+                self.misses += 1
+                leader = True
+        if not leader:
+            if fl["ev"].wait(wait) and fl["ok"]:
+                return fl["value"]
+            return fn()     # 领头的失败/超时：自己算，不缓存
+        try:
+            value = fn()
+            fl["value"], fl["ok"] = value, True
+            if cacheable(value):
+                with self._lock:
+                    self._data[key] = (version, time.monotonic() + ttl, value)
+                    self._data.move_to_end(key)
+                    while len(self._data) > self.maxsize:
+                        self._data.popitem(last=False)
+            return value
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is fl:
+                    del self._inflight[key]
+            fl["ev"].set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "max": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "coalesced": self.coalesced,
+                    "inflight": len(self._inflight)}
+
+
+CHARTS_CACHE_TTL = float(os.getenv("CHARTS_CACHE_TTL", "60"))          # 秒（监听正常时）
+CHARTS_CACHE_TTL_DEGRADED = float(os.getenv("CHARTS_CACHE_TTL_DEGRADED", "5"))
+_CHARTS_CACHE = _SingleFlightCache(int(os.getenv("CHARTS_CACHE_SIZE", "256")))
+
 
 # ========== 权限 ==========
 def admin_required(view_func):
@@ -315,9 +1693,10 @@ def _global_login_gate():
       - /site/<site_name>/status_query 公开状态查询
       - /site/<site_name>/uploads/* 公开文件访问
       - /site/<site_name>/draft/save 公开草稿保存（前台填写用）
+      - /site/<site_name>/upload/* 公开分片上传（init / PUT 分片 / complete）
       - /uploads/* （历史数据/兼容）
       - /static/*, /favicon.ico, /robots.txt
-      - /_health 健康检查
+      - /_health 健康检查（只回 ok；/_health/pool 内部统计要登录，或带 X-Health-Token）
     其它未登录访问将 302 跳转到 /login?enter=1&next=...
     """
     path = (request.path or "/")
@@ -325,6 +1704,7 @@ def _global_login_gate():
     if (
         path.startswith("/static/")
         or path in ("/favicon.ico", "/robots.txt", "/_health")
+        or (path.startswith("/_health/") and _health_token_ok())
         or path.startswith("/login")
         or path.startswith("/register")
         or path.startswith("/uploads/")
@@ -340,6 +1720,7 @@ def _global_login_gate():
             tail.startswith("status_query")
             or tail.startswith("uploads/")
             or tail == "draft/save"
+            or tail.startswith("upload/")
         ):
             return None  # 公共放行
 
@@ -523,18 +1904,7 @@ def index():
                            forms=forms)
 
 # ========= 入场动画注入 =========
-@app.after_request
-def _inject_enter_animation(resp):
-    try:
-        path = (request.path or "")
-        if not resp.content_type.startswith("text/html"):
-            return resp
-        need = (path == "/index" or path == "/create_form" or (path.startswith("/site/") and path.endswith("/admin")))
-        if not need:
-            return resp
-
-        html = resp.get_data(as_text=True)
-        inject = """
+_ENTER_ANIMATION_HTML = """
         <style id="page-enter-style">
         @keyframes riseSoft{
           0%   { transform: translateY(40px); opacity:0; filter: blur(6px); }
@@ -579,67 +1949,54 @@ def _inject_enter_animation(resp):
         })();
         </script>
         """
-        if "</body>" in html:
-            resp.set_data(html.replace("</body>", inject + "</body>"))
-    except Exception:
-        pass
-    return resp
+_html_rule(
+    "enter-animation",
+    lambda path, ep: path == "/index" or path == "/create_form" or (path.startswith("/site/") and path.endswith("/admin")),
+    body=_ENTER_ANIMATION_HTML, order=50,
+)
 
 # ========= 后台主题色注入 & 去除块 =========
-@app.after_request
-def _inject_admin_theme_and_cleanup(resp):
-    try:
-        path = (request.path or "")
-        if not resp.content_type.startswith("text/html"):
-            return resp
-
-        m = re.match(r"^/site/([^/]+)/admin/?$", path)
-        if not m:
-            return resp
-        site_name = m.group(1)
-
-        brand = "#2563eb"
-        try:
-            conn = get_conn(); c = conn.cursor()
-            c.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
-            row = c.fetchone(); conn.close()
-            if row:
-                schema = row[0] if isinstance(row[0], dict) else (json.loads(row[0]) if row[0] else {})
-                b = (((schema or {}).get("theme") or {}).get("brand") or "").strip()
-                if b:
-                    brand = b
-        except Exception:
-            pass
-
-        html = resp.get_data(as_text=True)
-        inject = f"""
+# {brand} 处在请求时替换成表单主题色；其余部分启动时预编码
+_ADMIN_THEME_HTML = """
 <style id="injected-theme-brand">
-  :root{{ --accent: {brand}; }}
-  body{{ background: {brand} !important; }}
+  :root{ --accent: {brand}; }
+  body{ background: {brand} !important; }
 </style>
 <script>
-(function(){{
+(function(){
   const killTitles = ['背景样式','通知'];
-  function removeBlocks(){{
+  function removeBlocks(){
     const heads = document.querySelectorAll('h1,h2,h3,h4,.title,.card-title');
-    heads.forEach(h => {{
+    heads.forEach(h => {
       const text = (h.textContent||'').trim();
-      if(killTitles.some(k => text.includes(k))) {{
+      if(killTitles.some(k => text.includes(k))) {
         const card = h.closest('.card, section, article, .box, .panel, .container, .wrap, div');
         if (card && card.parentNode) card.parentNode.removeChild(card);
-      }}
-    }});
-  }}
+      }
+    });
+  }
   if(document.readyState==='loading') document.addEventListener('DOMContentLoaded', removeBlocks);
   else removeBlocks();
-}})();
+})();
 </script>
 """
-        if "</body>" in html:
-            resp.set_data(html.replace("</body>", inject + "</body>"))
+_ADMIN_THEME_PARTS = [x.encode("utf-8") for x in _ADMIN_THEME_HTML.split("{brand}")]
+_RE_ADMIN_PAGE = re.compile(r"^/site/([^/]+)/admin/?$")
+
+def _admin_theme_snippet(m, buf):
+    brand = "#2563eb"
+    try:
+        schema = _form_schema(m.group(1))
+        if schema is not None:
+            b = (((schema or {}).get("theme") or {}).get("brand") or "").strip()
+            if b:
+                brand = b
     except Exception:
         pass
-    return resp
+    return brand.encode("utf-8").join(_ADMIN_THEME_PARTS)
+
+_html_rule("admin-theme", lambda path, ep: _RE_ADMIN_PAGE.match(path),
+           body=_admin_theme_snippet, order=40)
 
 # ========== 安全 next ==========
 def _safe_next_path(path: str) -> str:
@@ -647,12 +2004,7 @@ def _safe_next_path(path: str) -> str:
         return path
     return url_for("index")
 
-@app.after_request
-def _inject_preview_guard(resp):
-    try:
-        if request.path.endswith("/preview") and resp.content_type.startswith("text/html"):
-            html = resp.get_data(as_text=True)
-            inject = r"""
+_PREVIEW_GUARD_HTML = r"""
 <style id="preview-guard-style">
   #preview-banner{
     position:fixed;left:50%;top:14px;transform:translateX(-50%);
@@ -661,11 +2013,8 @@ def _inject_preview_guard(resp):
     opacity:.92
   }
 </style>"""
-            if "</body>" in html:
-                resp.set_data(html.replace("</body>", inject + "</body>"))
-    except Exception:
-        pass
-    return resp
+_html_rule("preview-guard", lambda path, ep: path.endswith("/preview"),
+           body=_PREVIEW_GUARD_HTML, order=30)
 
 
 # ========== 创建/编辑 ==========
@@ -727,40 +2076,10 @@ def create_form():
 
         conn = get_conn(); c = conn.cursor()
         try:
-            # 确保表存在 & 兼容
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS form_defs (
-                    id          SERIAL PRIMARY KEY,
-                    name        TEXT        NOT NULL,
-                    site_name   TEXT UNIQUE NOT NULL,
-                    schema_json JSONB       NOT NULL DEFAULT '{}'::jsonb,
-                    created_by  INT,
-                    db_url      TEXT,
-                    description TEXT,
-                    created_at  TIMESTAMP   DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS created_by  INT")
-            c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS db_url      TEXT")
-            c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS description TEXT")
-            c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS created_at  TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-            c.execute("ALTER TABLE form_defs ADD COLUMN IF NOT EXISTS schema_json JSONB DEFAULT '{}'::jsonb")
-            c.execute("""
-                SELECT data_type FROM information_schema.columns
-                 WHERE table_name='form_defs' AND column_name='schema_json'
-            """)
-            t = c.fetchone()
-            if t and t[0].lower() in ("text", "character varying"):
-                c.execute("""
-                    ALTER TABLE form_defs
-                    ALTER COLUMN schema_json TYPE JSONB
-                    USING CASE
-                            WHEN schema_json IS NULL OR schema_json='' THEN '{}'::jsonb
-                            ELSE schema_json::jsonb
-                         END
-                """)
-
-            # UPSERT
+            c.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
+            row = c.fetchone()
+            old_lookup = _lookup_field(row[0] if row and isinstance(row[0], dict) else {})
+            # UPSERT（form_defs 表结构由迁移负责）
             c.execute("""
                 INSERT INTO form_defs (name, site_name, schema_json, created_by, db_url, description)
                 VALUES (%s, %s, %s, %s, %s, %s)
@@ -769,34 +2088,22 @@ def create_form():
                     schema_json = EXCLUDED.schema_json,
                     created_by  = EXCLUDED.created_by,
                     db_url      = EXCLUDED.db_url,
-                    description = EXCLUDED.description
+                    description = EXCLUDED.description,
+                    schema_version = form_defs.schema_version + 1
                 RETURNING id
             """, (name, site_name, Json(schema_obj), user_id, schema_name, form_desc))
             _ = c.fetchone()[0]
+            _notify_form_changed(c, site_name)
 
-            # 业务 schema + submissions
-            c.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name}")
-            c.execute(f"""
-                CREATE TABLE IF NOT EXISTS {schema_name}.submissions (
-                    id             SERIAL PRIMARY KEY,
-                    user_id        INT,
-                    data           JSONB,
-                    status         TEXT DEFAULT '待审核',
-                    review_comment TEXT,
-                    created_at     TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            # 草稿表（供 /draft/save）
-            c.execute(f"""
-                CREATE TABLE IF NOT EXISTS {schema_name}.drafts (
-                    token TEXT PRIMARY KEY,
-                    data  JSONB,
-                    files JSONB,
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    updated_at TIMESTAMP DEFAULT NOW()
-                )
-            """)
+            # 业务 schema + submissions + drafts：已是最新版本就同步图表字段登记，否则提交后排队开通
+            tenant_ready = _tenant_is_current(c, schema_name)
+            if tenant_ready:
+                _rollup_sync_fields(c, schema_name, _rollup_field_keys(schema_obj))
             conn.commit()
+            _form_changed_local(site_name)
+            # 状态查询的"姓名"字段换了：已有提交的 lookup_key 要按新字段重算（整表重算，交给后台线程）
+            if not tenant_ready or _lookup_field(schema_obj) != old_lookup:
+                _queue_tenant(schema_name)
         except Exception as e:
             conn.rollback()
             try: current_app.logger.exception("create_form failed")
@@ -820,7 +2127,8 @@ def create_form():
                 "site_name": site_name,
                 "public_url": public_url,
                 "admin_url": admin_url,
-                "success_url": url_for("create_success", site_name=site_name)
+                "success_url": url_for("create_success", site_name=site_name),
+                "tenant_ready": tenant_ready,
             })
 
         return render_template(
@@ -863,7 +2171,7 @@ def create_form():
 
         try:
             schema_name = _safe_schema(site_name)
-            c.execute(f"SET search_path TO {schema_name}")
+            c.execute(f'SET LOCAL search_path TO "{schema_name}", public')   # 只在本事务内：请求级连接后面还有别的查询
             c.execute("SELECT id, user_id, data, status, created_at FROM submissions ORDER BY id DESC LIMIT 50")
             submissions = c.fetchall()
         except Exception:
@@ -937,6 +2245,99 @@ def _safe_schema(site_name: str) -> str:
     s = s[:_PG_IDENT_MAX]
     return s
 
+# ========= 租户（每个表单一个 schema）开通 =========
+# 建 schema/建表由迁移负责（见“数据库迁移”），请求里不跑 DDL：创建/保存表单时如果租户不是最新版本，
+# 提交后把它排进本进程的后台开通线程（独立连接跑 migrate_tenant）；flask migrate（发布时）兜底。
+# 提交路径只看本进程的“已开通”登记，首次遇到某个站点时读一次 schema_migrations（只读，不跑 DDL）。
+_PROVISIONED = set()
+_PROVISIONED_LOCK = threading.Lock()
+
+class TenantNotReady(Exception):
+    """租户 schema 还没迁移到当前版本（需要先执行 flask migrate）。"""
+
+def _mark_provisioned(schema_name: str):
+    with _PROVISIONED_LOCK:
+        _PROVISIONED.add(schema_name)
+
+_TENANT_QUEUE = queue.Queue()
+_TENANT_WORKER = {"thread": None, "lock": threading.Lock()}
+
+def _queue_tenant(schema_name: str):
+    """表单保存提交后调用：租户迁移交给后台线程（多个 worker 同时排到也没关系，迁移按 scope 加锁且幂等）。"""
+    with _TENANT_WORKER["lock"]:
+        t = _TENANT_WORKER["thread"]
+        if t is None or not t.is_alive():
+            t = threading.Thread(target=_tenant_worker_loop, name="tenant-provisioner", daemon=True)
+            _TENANT_WORKER["thread"] = t
+            t.start()
+    _TENANT_QUEUE.put(schema_name)
+
+def _tenant_worker_loop():
+    while True:
+        schema_name = _TENANT_QUEUE.get()
+        conn = get_dedicated_conn()
+        try:
+            ran = migrate_tenant(conn, schema_name)
+            c = conn.cursor()
+            # 排队期间保存的图表字段登记在这里补上（请求里租户没就绪时跳过了）
+            _rollup_sync_fields(c, schema_name, _rollup_field_keys(_tenant_form_schema(c, schema_name)))
+            _rollup_backfill(c, schema_name)
+            conn.commit()
+            # 表单换了状态查询字段时按新字段重算 lookup_key（没变的行不动）
+            rekeyed = _lookup_rekey(c, schema_name, _lookup_field(_tenant_form_schema(c, schema_name)))
+            conn.commit()
+            if rekeyed:
+                app.logger.info("tenant %s: %d lookup_key(s) rebuilt", schema_name, rekeyed)
+            if ran:
+                app.logger.info("tenant %s migrated: %s", schema_name, ", ".join(ran))
+        except Exception:
+            conn.rollback()
+            app.logger.exception("tenant %s migration failed; run `flask migrate`", schema_name)
+        finally:
+            conn.close()
+            _TENANT_QUEUE.task_done()
+
+def _tenant_is_current(c, schema_name: str) -> bool:
+    if schema_name in _PROVISIONED:
+        return True
+    c.execute("SELECT 1 FROM public.schema_migrations WHERE scope=%s AND version=%s",
+              (schema_name, _tenant_head()))
+    if c.fetchone():
+        _mark_provisioned(schema_name)
+        return True
+    return False
+
+def _require_tenant(c, schema_name: str):
+    """热路径（公开提交/草稿）用：只读检查，不跑 DDL。"""
+    if not _tenant_is_current(c, schema_name):
+        raise TenantNotReady(schema_name)
+
+@app.errorhandler(TenantNotReady)
+def _handle_tenant_not_ready(e):
+    try: current_app.logger.error("tenant schema %s not migrated; run `flask migrate`", e)
+    except Exception: pass
+    msg = "表单尚未初始化完成，请稍后再试（503）"
+    if ("application/json" in (request.headers.get("Accept") or "").lower()
+            or request.path.endswith("/draft/save") or "/upload/" in request.path):
+        return jsonify({"ok": False, "error": msg}), 503
+    return (msg, 503, {"Content-Type": "text/plain; charset=utf-8"})
+
+def _check_tenant(site_name: str):
+    """公开写入（提交 / 草稿 / 分片上传）在收请求体、写文件之前调用：租户没开通就直接 503。
+    已登记开通的不碰数据库；否则借一下请求级连接查一次。"""
+    schema_name = _safe_schema(site_name)
+    if schema_name in _PROVISIONED:
+        return
+    conn = get_conn(); c = conn.cursor()
+    try:
+        _require_tenant(c, schema_name)
+    finally:
+        conn.close()
+
+def _forget_tenant(schema_name: str):
+    with _PROVISIONED_LOCK:
+        _PROVISIONED.discard(schema_name)
+
 @app.route("/create_form/site/<site>", methods=["GET"])
 @admin_required
 def create_form_site(site):
@@ -960,7 +2361,7 @@ def create_form_site(site):
         submissions = []
         try:
             schema_name = _safe_schema(site_name)
-            c.execute(f"SET search_path TO {schema_name}")
+            c.execute(f'SET LOCAL search_path TO "{schema_name}", public')   # 只在本事务内：请求级连接后面还有别的查询
             c.execute(
                 "SELECT id, user_id, data, status, created_at FROM submissions ORDER BY id DESC LIMIT 50"
             )
@@ -980,12 +2381,7 @@ def create_form_site(site):
     )
 
 # ========= 创建页按钮微调注入 =========
-@app.after_request
-def _tweak_create_form_image_button(resp):
-    try:
-        if request.path.startswith("/create_form") and resp.content_type.startswith("text/html"):
-            html = resp.get_data(as_text=True)
-            inject_css = """
+_CREATE_FORM_IMGBTN_HTML = """
 <style id="cehs-imgbtn-style">
   .cehs-imgbtn{
     display:inline-flex !important;
@@ -1004,8 +2400,7 @@ def _tweak_create_form_image_button(resp):
   .cehs-imgbtn:hover{ background:#fafafa !important; border-color:#d1d5db !important; }
   .cehs-imgbtn svg, .cehs-imgbtn img{ width:18px !important; height:18px !important; flex:0 0 auto !important; }
 </style>
-"""
-            inject_js = """
+""" + """
 <script>
 (function(){
   function normalizeImageButtons(){
@@ -1041,22 +2436,15 @@ def _tweak_create_form_image_button(resp):
 })();
 </script>
 """
-            if "</body>" in html:
-                html = html.replace("</body>", inject_css + inject_js + "</body>")
-                resp.set_data(html)
-    except Exception:
-        pass
-    return resp
+_html_rule("create-form-imgbtn", lambda path, ep: path.startswith("/create_form"),
+           body=_CREATE_FORM_IMGBTN_HTML, order=20)
 
 # ========= 管理端上传/删除/主题保存 =========
 @app.route("/site/<site_name>/admin")
 @admin_required
 def site_admin(site_name):
-    conn = get_conn(); c = conn.cursor()
-    c.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
-    row = c.fetchone(); conn.close()
-    schema = row[0] if row and isinstance(row[0], dict) else (json.loads(row[0]) if row and row[0] else {})
-    brand_light, brand_dark, theme_mode = _read_theme(schema)
+    plan = _form_plan(site_name)
+    brand_light, brand_dark, theme_mode = plan["admin_theme"] if plan else _read_theme({})
 
     return render_template(
         "dynamic_admin.html",
@@ -1118,6 +2506,16 @@ def api_delete_asset(site_name):
 
     if os.path.exists(path):
         os.remove(path)
+    # 已收进内容寻址存储的：删掉文件名登记，blob 由 uploads-gc 按引用计数回收
+    schema_name = _safe_schema(site_name)
+    conn = get_conn(); c = conn.cursor()
+    try:
+        if _tenant_is_current(c, schema_name):
+            c.execute(f'DELETE FROM "{schema_name}".upload_names WHERE name=%s', (safe,))
+            conn.commit()
+    finally:
+        conn.close()
+    _UPLOAD_INDEX.evict((site_name, safe))
     return jsonify({"ok": True})
 
 @app.route("/site/<site_name>/admin/api/save_theme_bg", methods=["POST"])
@@ -1157,8 +2555,13 @@ def api_save_theme_bg(site_name):
         schema["theme"] = theme
 
         # 4) 回写
-        c.execute("UPDATE form_defs SET schema_json=%s WHERE site_name=%s", (Json(schema), site_name))
+        c.execute("""
+            UPDATE form_defs SET schema_json=%s, schema_version=schema_version+1
+             WHERE site_name=%s
+        """, (Json(schema), site_name))
+        _notify_form_changed(c, site_name)
         conn.commit()
+        _form_changed_local(site_name)
 
         return jsonify({"ok": True})
     except Exception as e:
@@ -1180,7 +2583,9 @@ def api_delete_submission(site_name):
     try:
         c.execute(f'SET search_path TO "{schema}", public')
         c.execute("DELETE FROM submissions WHERE id=%s", (sub_id,))
+        _notify_submissions_changed(c, site_name)
         conn.commit()
+        _submissions_changed_local(site_name)
         return jsonify({"ok": True})
     except Exception as e:
         conn.rollback()
@@ -1273,36 +2678,212 @@ def api_responses(site_name):
 def api_responses_alias(site_name):
     return _api_list_responses(site_name)
 
+# ========= 提交搜索：切词 =========
+# Postgres 自带解析器不会切中文，'simple' 配置下整句中文是一个词。这里在应用侧切好词，
+# 直接用 array_to_tsvector / 手写 tsquery 入库查询，不经过数据库的解析器：
+#   - 中日韩连续字符：单字 + 相邻二元组（查询时 ≥2 字只用二元组，1 字用单字）
+#   - 其它字母数字：按词小写；查询时做前缀匹配（手机号、邮箱片段）
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_RE_SEARCH_TOKEN = re.compile(r"([%s]+)|((?:(?![%s])\w)+)" % (_CJK, _CJK))
+SEARCH_MAX_TOKENS = 4000
+
+
+def _search_text(x, out):
+    if isinstance(x, dict):
+        for v in x.values():
+            _search_text(v, out)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _search_text(v, out)
+    elif x is not None and not isinstance(x, bool):
+        out.append(str(x))
+    return out
+
+
+def _search_tokens(data) -> list:
+    """提交数据（dict 或 JSON 文本）-> 去重后的词表，用于 array_to_tsvector。"""
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except Exception:
+            pass
+    text = unicodedata.normalize("NFKC", " ".join(_search_text(data, []))).lower()
+    toks = {}
+    for cjk, word in _RE_SEARCH_TOKEN.findall(text):
+        if cjk:
+            for i, ch in enumerate(cjk):
+                toks[ch] = None
+                if i + 1 < len(cjk):
+                    toks[cjk[i:i + 2]] = None
+        elif word:
+            toks[word] = None
+        if len(toks) >= SEARCH_MAX_TOKENS:
+            break
+    return list(toks)
+
+
+def _search_query(q: str):
+    """关键词 -> tsquery 文本（全部词 AND）；切不出词时返回 None（走 ILIKE 兜底）。"""
+    text = unicodedata.normalize("NFKC", q).lower()
+    parts = []
+    for cjk, word in _RE_SEARCH_TOKEN.findall(text):
+        if cjk:
+            grams = [cjk] if len(cjk) == 1 else [cjk[i:i + 2] for i in range(len(cjk) - 1)]
+            parts += ["'%s'" % g for g in grams]
+        elif word:
+            parts.append("'%s':*" % word.replace("\\", "\\\\").replace("'", "''"))
+    return " & ".join(dict.fromkeys(parts)) or None
+
+
+def _search_where(q: str):
+    """返回 (where 片段, 参数, tsquery 文本或 None)。
+    先用 GIN 索引筛候选，再对每个空格分隔的词做 ILIKE 复核（二元组不相邻时的误命中在这里去掉）。
+    复核两边都先做 NFKC（同切词）：全角 / 兼容字符的查询命中了索引，不能在复核里又被筛掉。"""
+    terms = [t for t in unicodedata.normalize("NFKC", q).split() if t]
+    recheck = " AND ".join(["normalize(data::text, NFKC) ILIKE %s"] * len(terms)) or "TRUE"
+    # 用户输入里的 % _ \ 按字面匹配（LIKE 默认转义符是反斜杠）；在 NFKC 之后转义，全角 ％ 也按字面
+    params = ["%" + re.sub(r"([\\%_])", r"\\\1", t) + "%" for t in terms]
+    tsq = _search_query(q)
+    if tsq is None:
+        return recheck, params, None
+    return f"search_tsv @@ %s::tsquery AND {recheck}", [tsq, *params], tsq
+
+
+LIST_PAGE_DEFAULT = 500    # 不带 limit 的旧调用仍然一次拿 500 条
+LIST_PAGE_MAX = 1000
+LIST_COUNT_EXACT_MAX = 20000  # 估算行数超过它就不再 count(*)，返回 reltuples 估算值
+_LIST_SORT_KEYS = {"id": "id", "created_at": "created_at", "rank": "rank"}
+
+
+def _int_arg(name, default=None, lo=None, hi=None):
+    try:
+        v = int(request.args.get(name, ""))
+    except (TypeError, ValueError):
+        return default
+    if lo is not None: v = max(lo, v)
+    if hi is not None: v = min(hi, v)
+    return v
+
+
 def _api_list_responses(site_name: str):
+    """
+    提交列表（键集分页）：
+      ?limit=N            每页条数（默认 500，上限 1000；0 = 只要 columns，不查行）
+      ?sort=id|created_at|rank &order=desc|asc
+      ?before_id=X        取排序键 (sort, id) 严格小于 X 那一行的记录
+      ?after_id=X         取 (sort, id) 严格大于 X 那一行的记录
+      ?before_at= / ?after_at=   sort=created_at 时游标行的时间（next_cursor 里带着），
+                          游标行被删了也能接着翻；created_at 为空的行按最旧处理
+      ?q=                 关键词搜索（search_tsv GIN 索引）；带 q 且没给 sort 时按相关度排序，
+                          相关度排序用 ?offset= 翻页
+      ?f.<字段key>=值      字段筛选（data @> 包含查询；同一字段给多个值为"或"）
+      ?status=            审核状态（可多个）
+      ?created_from= &created_to=   提交时间范围（只给日期时 created_to 含当天）
+    返回 next_cursor / prev_cursor（直接拼到下一次请求的参数里）与 total（total_exact=false 时为估算）。
+    """
     q = (request.args.get("q") or "").strip()
     schema = _safe_schema(site_name)
+    limit = _int_arg("limit", LIST_PAGE_DEFAULT, 0, LIST_PAGE_MAX)
+    sort_col = _LIST_SORT_KEYS.get((request.args.get("sort") or ("rank" if q else "id")).strip(), "id")
+    desc = (request.args.get("order") or "desc").strip().lower() != "asc"
+    before_id = _int_arg("before_id")
+    after_id = _int_arg("after_id")
+    before_at = (request.args.get("before_at") or "").strip() or None
+    after_at = (request.args.get("after_at") or "").strip() or None
+
+    try:
+        for v in (before_at, after_at):
+            if v and v != "-infinity":
+                datetime.fromisoformat(v)
+        where, params = _list_filters(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    tsq = None
+    if q:
+        search_sql, search_params, tsq = _search_where(q)
+        where.append(search_sql); params += search_params
+    # 筛选条件（不含游标）同时用于 total
+    filter_sql = ("WHERE " + " AND ".join(where)) if where else ""
+    filter_params = list(params)
+    if sort_col == "rank" and tsq is None:
+        sort_col = "id"
+    offset = _int_arg("offset", 0, 0) if sort_col == "rank" else 0
+    # 游标：按 (排序键, id) 的行值比较，能直接走 submissions_created_key_idx / 主键索引。
+    # created_at 的游标值随游标一起下发（_at），不再按 id 回查——游标行删掉后回查是 NULL，下一页就空了
+    created_key = "COALESCE(created_at, '-infinity'::TIMESTAMP)"
+    key = f"({created_key}, id)" if sort_col == "created_at" else "id"
+    if sort_col == "rank":
+        before_id = after_id = None
+    for cur_id, cur_at, op in ((before_id, before_at, "<"), (after_id, after_at, ">")):
+        if cur_id is None:
+            continue
+        if sort_col != "created_at":
+            where.append(f"id {op} %s"); params.append(cur_id)
+        elif cur_at:
+            where.append(f"{key} {op} (%s::TIMESTAMP, %s)"); params += [cur_at, cur_id]
+        else:   # 旧链接只带 id：回查一次，查不到就当游标在最旧处
+            where.append(f"""{key} {op} COALESCE((SELECT ({created_key}, id) FROM submissions WHERE id = %s),
+                                                 ('-infinity'::TIMESTAMP, %s))""")
+            params += [cur_id, cur_id]
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+    # 逆着列表方向翻页（倒序给 after_id / 正序给 before_id）时，先按反方向取离游标最近的一页，再翻回来
+    flip = ((desc and after_id is not None and before_id is None)
+            or (not desc and before_id is not None and after_id is None))
+    scan_desc = desc != flip
+    direction = "DESC" if scan_desc else "ASC"
+    order_sql = (f"ORDER BY {created_key} {direction}, id {direction}" if sort_col == "created_at"
+                 else f"ORDER BY id {direction}")
+    order_params = []
+    if sort_col == "rank":
+        order_sql = "ORDER BY ts_rank(search_tsv, %s::tsquery) DESC, id DESC"
+        order_params = [tsq]
 
     # 读提交数据
     conn = get_conn(); c = conn.cursor()
     try:
         c.execute(f'SET search_path TO "{schema}", public')
-        if q:
-            c.execute("""
-                SELECT id, data, status, review_comment, created_at
-                  FROM submissions
-                 WHERE data::text ILIKE %s
-                 ORDER BY id DESC
-                 LIMIT 500
-            """, (f"%{q}%",))
-        else:
-            c.execute("""
+        rows, has_more = [], False
+        if limit > 0:
+            c.execute(f"""
                 SELECT id, data, status, review_comment, created_at
                   FROM submissions
-                 ORDER BY id DESC
-                 LIMIT 500
-            """)
-        rows = c.fetchall()
+                  {where_sql}
+                  {order_sql}
+                 LIMIT %s OFFSET %s
+            """, (*params, *order_params, limit + 1, offset))
+            rows = c.fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if flip:
+                rows.reverse()
+        total, total_exact = _count_submissions(c, schema, filter_sql, filter_params)
     except Exception as e:
         conn.rollback()
         return jsonify({"ok": False, "error": str(e)}), 500
     finally:
         conn.close()
 
+    # 翻页游标：沿当前方向继续用最后一行，反方向用第一行
+    nxt = prv = None
+    if sort_col == "rank":
+        if has_more:
+            nxt = {"offset": offset + limit}
+        if offset > 0:
+            prv = {"offset": max(0, offset - limit)}
+    elif rows:
+        def cursor(side, row):
+            cur = {f"{side}_id": row[0]}
+            if sort_col == "created_at":
+                cur[f"{side}_at"] = row[4].isoformat() if row[4] else "-infinity"
+            return cur
+        more_forward = has_more if not flip else (before_id is not None or after_id is not None)
+        more_back = has_more if flip else (before_id is not None or after_id is not None)
+        if more_forward:
+            nxt = cursor("before" if desc else "after", rows[-1])
+        if more_back:
+            prv = cursor("after" if desc else "before", rows[0])
+
     # 数据项：统一做 UTF-8 归一化
     items = []
     for rid, d, status, review, created in rows:
@@ -1316,18 +2897,11 @@ def _api_list_responses(site_name: str):
             "data": data,
         })
 
-    # 读 schema，生成“中文列头”
-    conn2 = get_conn(); c2 = conn2.cursor()
+    # 读 schema，生成“中文列头”（与上面共用同一条请求级连接）
     try:
-        c2.execute(f'SET search_path TO "{schema}", public')
-        c2.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
-        row = c2.fetchone()
+        schema_json = _form_schema(site_name) or {}
     except Exception:
-        row = None
-    finally:
-        conn2.close()
-
-    schema_json = row[0] if (row and isinstance(row[0], dict)) else (json.loads(row[0]) if row and row[0] else {})
+        schema_json = {}
     columns = _extract_columns_from_schema(schema_json) if schema_json else []
 
     cleaned = []
@@ -1342,7 +2916,66 @@ def _api_list_responses(site_name: str):
         })
     title_map = {c["key"]: c["label"] for c in cleaned if c.get("key")}
 
-    return jsonify({"ok": True, "items": items, "columns": cleaned, "titleMap": title_map})
+    return jsonify({"ok": True, "items": items, "columns": cleaned, "titleMap": title_map,
+                    "limit": limit, "next_cursor": nxt, "prev_cursor": prv,
+                    "total": total, "total_exact": total_exact})
+
+
+def _list_filters(args):
+    """把查询参数里的结构化筛选翻译成 (where 片段列表, 参数)，都能走索引：
+    字段值用 data @> 包含（值可能存成字符串或数组，两种都匹配），状态/时间走 (status, created_at)。"""
+    where, params = [], []
+    keys = sorted({k for k in args.keys() if k.startswith("f.") and len(k) > 2})
+    for k in keys:
+        field = k[2:]
+        vals = [v for v in args.getlist(k) if v != ""]
+        if not vals:
+            continue
+        ors = []
+        for v in vals:
+            ors.append("data @> %s::jsonb OR data @> %s::jsonb")
+            params += [json.dumps({field: v}, ensure_ascii=False),
+                       json.dumps({field: [v]}, ensure_ascii=False)]
+        where.append("(" + " OR ".join(ors) + ")")
+    statuses = [v.strip() for v in args.getlist("status") if v.strip()]
+    if statuses:
+        where.append("status = ANY(%s)"); params.append(statuses)
+    for name, op in (("created_from", ">="), ("created_to", "<")):
+        raw = (args.get(name) or "").strip()
+        if not raw:
+            continue
+        try:
+            ts = datetime.fromisoformat(raw)
+        except ValueError:
+            raise ValueError(f"{name} 格式应为 YYYY-MM-DD 或 ISO 时间")
+        if name == "created_to" and len(raw) <= 10:
+            ts += timedelta(days=1)   # 只给日期：含当天
+        where.append(f"created_at {op} %s"); params.append(ts)
+    return where, params
+
+
+def _count_submissions(c, schema: str, where_sql: str = "", params=()):
+    """返回 (总数, 是否精确)。无过滤时先看 pg_class.reltuples，大表直接用估算值；
+    有过滤（搜索/筛选）时最多数到 LIST_COUNT_EXACT_MAX 条为止。"""
+    if not where_sql:
+        c.execute("""
+            SELECT cl.reltuples::BIGINT
+              FROM pg_class cl JOIN pg_namespace n ON n.oid = cl.relnamespace
+             WHERE n.nspname=%s AND cl.relname='submissions'
+        """, (schema,))
+        row = c.fetchone()
+        est = int(row[0]) if row and row[0] is not None else -1
+        if est > LIST_COUNT_EXACT_MAX:
+            return est, False
+        c.execute("SELECT COUNT(*) FROM submissions")
+        return int(c.fetchone()[0]), True
+    c.execute(f"""
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM submissions {where_sql} LIMIT %s
+        ) t
+    """, (*params, LIST_COUNT_EXACT_MAX + 1))
+    n = int(c.fetchone()[0])
+    return (LIST_COUNT_EXACT_MAX, False) if n > LIST_COUNT_EXACT_MAX else (n, True)
 
 # ========= 公共页回退模板 =========
 PUBLIC_FORM_HTML = """
@@ -1421,6 +3054,7 @@ PUBLIC_SUCCESS_HTML = """
 <div class="box">
   <h2>提交成功 🎉</h2>
   <p>我们已收到你的提交，请稍后到“查看状态”里查看审核结果。</p>
+  {% if receipt %}<p>回执号：<strong id="receiptNo" style="letter-spacing:1px">{{ receipt }}</strong>（请保存，凭姓名或回执号均可查询）</p>{% endif %}
   <p>
     <a href="{{ public_url }}" class="btn ghost">返回表单主页</a>
     <a href="javascript:void(0)" id="btnCheck" class="btn">查看状态</a>
@@ -1434,7 +3068,7 @@ PUBLIC_SUCCESS_HTML = """
       <a href="javascript:void(0)" id="closeStatus" class="btn ghost">关闭</a>
     </div>
     <div style="display:flex;gap:8px;align-items:center;margin-bottom:10px;flex-wrap:wrap">
-      <input id="statusName" placeholder="请输入姓名">
+      <input id="statusName" placeholder="请输入姓名或回执号" value="{{ receipt or '' }}">
       <a href="javascript:void(0)" id="goQuery" class="btn">查看</a>
     </div>
     <div id="statusResult" style="font-size:14px;color:#111"></div>
@@ -1494,7 +3128,9 @@ def api_review(site_name):
         c.execute(f'SET search_path TO "{schema}", public')
         c.execute("UPDATE submissions SET status=%s, review_comment=%s WHERE id=%s",
                   (status, review_comment, sub_id))
+        _notify_submissions_changed(c, site_name)
         conn.commit()
+        _submissions_changed_local(site_name)
         return jsonify({"ok": True})
     except Exception as e:
         conn.rollback()
@@ -1544,221 +3180,867 @@ def api_send_mail(site_name):
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-# ========= 公开表单 GET =========
-@app.route("/f/<site_name>", methods=["GET"])
-def public_form(site_name):
-    conn = get_conn(); c = conn.cursor()
-    c.execute("SELECT name, schema_json, COALESCE(description,'') FROM form_defs WHERE site_name=%s", (site_name,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        abort(404)
-
-    form_title = row[0]
-    schema = row[1] if isinstance(row[1], dict) else json.loads(row[1] or "{}")
-    db_desc = (row[2] or "").strip()
-    form_desc_html = (
-        (schema.get("descHTML") or schema.get("desc") or schema.get("description"))
-        or db_desc
-    )
-
-    # ✅ 从 schema 里取主题
-    theme = schema.get('theme') or {}
-
-    # 主题/外观
-    brand_light = (theme.get("brand_light") or theme.get("brand") or "#2563eb").strip()
-    brand_dark  = (theme.get("brand_dark")  or theme.get("brand") or "#0ea5e9").strip()
-    theme_mode  = (theme.get("mode") or theme.get("theme_mode") or theme.get("appearance") or "auto").lower()
-    if theme_mode not in ("light", "dark", "auto"):
-        theme_mode = "auto"
-
-    # 上传配置
-    upload_cfg = (schema.get("upload") or (schema.get("settings") or {}).get("upload") or {})
-    upload_max_files = int(upload_cfg.get("max_files") or 3)
-    allowed = set(
-        x.strip().lower()
-        for x in str(upload_cfg.get("allowed_file_types", "")).split(",")
-        if x.strip()
-    )
+# ========= 公开表单 GET =========
+@app.route("/f/<site_name>", methods=["GET"])
+def public_form(site_name):
+    fd = _get_form_def(site_name)
+    if not fd:
+        abort(404)
+    # 页面随表单定义和静态资源变化：按 (site_name, schema_version, ASSET_VERSION) 缓存渲染+后处理后的字节和 gzip 版本；
+    # ETag 也带上资源版本，发布后浏览器手里的旧页（引用旧 JS）不会再被 304 续命
+    page = _PAGE_CACHE.get(site_name, float("inf"))
+    if page is None or page["version"] != fd["version"] or page.get("assets") != ASSET_VERSION:
+        html = _render_public_form(site_name, fd)
+        body = _apply_html_rules(html.encode("utf-8"), request.path or "", request.endpoint)
+        page = {
+            "version": fd["version"], "assets": ASSET_VERSION, "loaded_at": time.monotonic(),
+            "etag": hashlib.sha1(ASSET_VERSION.encode() + b"\0" + body).hexdigest()[:24],
+            "body": body, "gz": gzip.compress(body, 6, mtime=0),
+        }
+        _PAGE_CACHE.put(site_name, page)
+    return _cached_page_response(page)
 
-    # 字段（仅去掉描述类键，其他不动）
-    raw_fields = schema.get("fields") or []
-    if not isinstance(raw_fields, list):
-        raw_fields = []
-    def _strip_desc(f):
-        g = dict(f or {})
-        for k in ("desc","descHTML","description","help","helpText"):
-            g.pop(k, None)
-        return g
-    clean_fields = [_strip_desc(f) for f in raw_fields]
 
-    # 兜底字段（仅用于 TemplateNotFound 回退）
-    fields_fallback = []
-    for f in clean_fields:
-        fields_fallback.append({
-            "label": f.get("labelHTML") or f.get("label") or f.get("key",""),
-            "type": (f.get("type") or "text"),
-            "key":  (f.get("key") or f.get("id")),
-            "options": f.get("options") or [],
-            "required": bool(f.get("required", False)),
-        })
+def _cached_page_response(page):
+    """按 Accept-Encoding 返回缓存页；If-None-Match 命中（任一编码的 ETag）时返回 304。"""
+    use_gz = "gzip" in (request.headers.get("Accept-Encoding") or "").lower()
+    etag = page["etag"] + ("-gz" if use_gz else "")
+    inm = request.if_none_match
+    if inm and (inm.contains(page["etag"]) or inm.contains(page["etag"] + "-gz")):
+        resp = Response(status=304)
+    else:
+        resp = Response(page["gz"] if use_gz else page["body"], mimetype="text/html")
+        if use_gz:
+            resp.headers["Content-Encoding"] = "gzip"
+    resp._html_done = True   # 已经过 _apply_html_rules
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"   # 可存，但每次带 If-None-Match 回源验证
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
 
-    header_image = (
-            (schema.get("header") or {}).get("title_image")
-            or (schema.get("display") or {}).get("title_image")
-            or (schema.get("display") or {}).get("cover_image")
-            or ""
-    )
 
+def _render_public_form(site_name, fd):
+    plan = fd["plan"]
     try:
-        return render_template(
-            "public_form.html",
-            site_name=site_name,
-            form_title=form_title,
-            form_desc=form_desc_html,
-            fields=clean_fields,
-            brand_light=brand_light,
-            brand_dark=brand_dark,
-            theme_mode=theme_mode,
-            has_file=any((f.get("type") or "").lower() == "file" for f in clean_fields),
-            upload_max_files=upload_max_files,
-            schema_json=json.dumps(schema, ensure_ascii=False),  # ← 保留
-            header_image=header_image,
-        )
+        return render_template("public_form.html", site_name=site_name, **_form_plan_context(plan))
     except TemplateNotFound:
         # 简易回退模板
-        brand = brand_dark if theme_mode == "dark" else brand_light
-        return render_template_string(
-            PUBLIC_FORM_HTML,
-            site_name=site_name,
-            form_name=form_title,
-            form_desc=form_desc_html,
-            fields=fields_fallback,
-            brand=brand,
-        )
+        return _render_form_fallback(site_name, plan)
 
 def _read_theme(schema: dict):
     theme = schema.get("theme") if isinstance(schema.get("theme"), dict) else {}
-    brand_single = (theme.get("brand") or "").strip()
-    brand_light = (theme.get("brand_light") or brand_single or "#2563eb").strip()
-    brand_dark  = (theme.get("brand_dark")  or brand_single or brand_light or "#0ea5e9").strip()
-    mode = (theme.get("mode") or theme.get("theme_mode") or theme.get("appearance") or "auto").lower()
+    brand_single = str(theme.get("brand") or "").strip()
+    brand_light = str(theme.get("brand_light") or brand_single or "#2563eb").strip()
+    brand_dark  = str(theme.get("brand_dark")  or brand_single or brand_light or "#0ea5e9").strip()
+    mode = str(theme.get("mode") or theme.get("theme_mode") or theme.get("appearance") or "auto").lower()
     if mode not in ("light", "dark", "auto"):
         mode = "auto"
     return brand_light, brand_dark, mode
 
-# ========= 公开表单 POST =========
-@app.route("/f/<site_name>", methods=["POST"])
-def public_submit(site_name):
-    schema_name = _safe_schema(site_name)
-    conn = get_conn(); c = conn.cursor()
+# ========= 上传文件：内容寻址存储 =========
+# 字节按 sha256 存一份：uploads/<site>/.cas/ab/cd/<sha256>；对外 URL 仍是 /site/<site>/uploads/<name>，
+# 通过租户表 upload_names 解析到 blob。草稿自动保存、重复提交同一文件不会再多占一份磁盘。
+# 落盘（无连接）和登记（短事务里批量 INSERT）分开：事务失败留下的无主 blob 由 uploads-gc 清掉。
+# 对外响应：学生附件不能进共享缓存（删除后 CDN 上还在），只给浏览器私有缓存 + sha256 ETag 重新验证。
+UPLOAD_INDEX_CACHE_SIZE = int(os.getenv("UPLOAD_INDEX_CACHE_SIZE", "4096"))
+UPLOAD_INDEX_TTL = float(os.getenv("UPLOAD_INDEX_TTL", "60"))       # 别的 worker 删掉文件名后，最多还能解析这么久
+UPLOAD_CACHE_MAX_AGE = int(os.getenv("UPLOAD_CACHE_MAX_AGE", "3600"))
+_UPLOAD_INDEX = _FormDefCache(UPLOAD_INDEX_CACHE_SIZE)   # (site, name) -> {"sha256", ...}
+_RE_SHA256 = re.compile(r"^[a-f0-9]{64}$")
 
-    # 读 schema（上传上限）
-    c.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return "not found", 404
-    schema = row[0] if isinstance(row[0], dict) else json.loads(row[0] or "{}")
 
-    upload_cfg = (schema.get("upload") or (schema.get("settings") or {}).get("upload") or {})
-    max_files = int(upload_cfg.get("max_files") or 3)
-    allowed = set(
-        x.strip().lower()
-        for x in str(upload_cfg.get("allowed_file_types", "")).split(",")
-        if x.strip()
-    )
+def _cas_root(site_name: str) -> str:
+    return os.path.join(app.config["UPLOAD_FOLDER"], site_name, ".cas")
 
-    # 非文件字段
-    data = request.form.to_dict()
 
-    # 站点专属目录
-    site_folder = os.path.join(app.config["UPLOAD_FOLDER"], site_name)
-    os.makedirs(site_folder, exist_ok=True)
+def _blob_path(site_name: str, sha: str) -> str:
+    return os.path.join(_cas_root(site_name), sha[:2], sha[2:4], sha)
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _blob_commit(site_name: str, tmp_path: str, sha: str):
+    """把已算好哈希的临时文件转正为 blob（同文件系统 rename）；同内容已存在就直接丢掉临时文件。
+    返回：这次新建了 blob 时为它的 mtime（纳秒，给 _discard_new_blobs 认领用），否则 None。"""
+    dst = _blob_path(site_name, sha)
+    created = not os.path.exists(dst)
+    if created:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(tmp_path, dst)
+    else:
+        os.remove(tmp_path)
+    # 刷新 mtime：uploads-gc 先读已登记的 blob、再删宽限期外没登记的文件，
+    # 登记前的这段时间里 blob 必须是“新的”（rename 会保留 .part 原来的 mtime，也要刷）
+    os.utime(dst)
+    return os.stat(dst).st_mtime_ns if created else None
+
+
+def _store_blob(site_name: str, stream):
+    """边读边算哈希写进 .cas/tmp，再转正。返回 (sha256, size, 新建 blob 的 mtime 或 None)。"""
+    tmp_dir = os.path.join(_cas_root(site_name), "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    h, size = hashlib.sha256(), 0
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as out:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            h.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    sha = h.hexdigest()
+    return sha, size, _blob_commit(site_name, out.name, sha)
+
+
+def _discard_new_blobs(c, site_name: str, schema_name: str, created):
+    """写库事务失败后调用：删掉本次请求新建、且最终没有登记的 blob 文件。
+    created: [(sha256, 新建时的 mtime)]。别的请求同时传了同样内容时，它的 _blob_commit 会刷 mtime，
+    这里看到 mtime 变了就不删（留给 uploads-gc）；查不了库（租户表不在等）也不删。"""
+    if not created:
+        return
+    try:
+        c.execute(f'SELECT sha256 FROM "{schema_name}".upload_blobs WHERE sha256 = ANY(%s)',
+                  ([sha for sha, _ in created],))
+        live = {r[0] for r in c.fetchall()}
+    except Exception:
+        return
+    for sha, mtime_ns in created:
+        path = _blob_path(site_name, sha)
+        try:
+            if sha not in live and os.stat(path).st_mtime_ns == mtime_ns:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _image_info(path: str):
+    """只读文件头识别常见图片格式与宽高（纯 Python，不依赖 Pillow）。返回 (mime, 宽, 高) 或 None。"""
+    import struct
+    try:
+        with open(path, "rb") as f:
+            head = f.read(32)
+            if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+                w, h = struct.unpack(">II", head[16:24])
+                return "image/png", w, h
+            if head[:6] in (b"GIF87a", b"GIF89a"):
+                w, h = struct.unpack("<HH", head[6:10])
+                return "image/gif", w, h
+            if head[:2] == b"BM" and len(head) >= 26:
+                w, h = struct.unpack("<ii", head[18:26])
+                return "image/bmp", w, abs(h)
+            if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+                chunk = head[12:16]
+                if chunk == b"VP8 ":
+                    w, h = struct.unpack("<HH", head[26:30])
+                    return "image/webp", w & 0x3FFF, h & 0x3FFF
+                if chunk == b"VP8L":
+                    bits = int.from_bytes(head[21:25], "little")
+                    return "image/webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+                if chunk == b"VP8X":
+                    return ("image/webp", int.from_bytes(head[24:27], "little") + 1,
+                            int.from_bytes(head[27:30], "little") + 1)
+                return None
+            if head[:2] == b"\xff\xd8":
+                # JPEG：逐个段跳过去找 SOFn（EXIF 缩略图等可能很长，所以按段长 seek，不整读）
+                f.seek(2)
+                while True:
+                    b = f.read(1)
+                    while b and b != b"\xff":
+                        b = f.read(1)
+                    while b == b"\xff":
+                        b = f.read(1)
+                    if not b:
+                        return None
+                    marker = b[0]
+                    if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                        continue
+                    seg = f.read(2)
+                    if len(seg) < 2:
+                        return None
+                    seglen = struct.unpack(">H", seg)[0]
+                    if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                        data = f.read(5)
+                        if len(data) < 5:
+                            return None
+                        h, w = struct.unpack(">HH", data[1:5])
+                        return "image/jpeg", w, h
+                    f.seek(seglen - 2, 1)
+    except (OSError, struct.error):
+        return None
+    return None
+
+
+def _blob_meta(path: str, filename: str):
+    """(mime, 宽, 高)：图片按文件头识别，其余按扩展名猜 mime、宽高为空。"""
+    info = _image_info(path)
+    if info:
+        return info
+    return mimetypes.guess_type(filename or "")[0] or "application/octet-stream", None, None
+
+
+def _register_uploads(c, schema_name: str, blobs):
+    """blobs: [(name, sha256, size, 原始文件名, mime, 宽, 高)]，在调用方的事务里登记。"""
+    if not blobs:
+        return
+    execute_values(c, f'''INSERT INTO "{schema_name}".upload_blobs (sha256, size, mime, width, height) VALUES %s
+                           ON CONFLICT (sha256) DO NOTHING''',
+                   sorted({(sha, size, mime, w, h) for _, sha, size, _, mime, w, h in blobs},
+                          key=lambda r: r[0]))
+    execute_values(c, f'''INSERT INTO "{schema_name}".upload_names (name, sha256, filename) VALUES %s
+                           ON CONFLICT (name) DO NOTHING''',
+                   [(name, sha, filename) for name, sha, _, filename, _, _, _ in blobs])
+
+
+_RE_UPLOAD_URL = re.compile(r"^/site/[^/]+/uploads/([^/?#]+)$")
+# 旧画廊的认图规则：字段名像图片，或值以图片扩展名结尾（老数据里有纯文件名、外链 http 地址）
+_LEGACY_IMAGE_KEYS = ("image", "img", "photo", "picture", "图片", "照片", "附件", "attachment")
+_LEGACY_IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".svg")
+
+
+def _legacy_image_url(key: str, u: str):
+    """旧画廊会显示、但不是 /site/<site>/uploads/ 形式的值 -> 能打开的 URL；不是图片返回 None。
+    纯文件名走全局 /uploads/<filename>（同旧画廊的 _to_url）。"""
+    u = (u or "").strip()
+    if not u or "\n" in u:
+        return None
+    if not (any(x in str(key).lower() for x in _LEGACY_IMAGE_KEYS) or u.lower().endswith(_LEGACY_IMAGE_EXTS)):
+        return None
+    if u.startswith(("http://", "https://", "/")):
+        return u
+    if "/" in u or " " in u:
+        return None
+    return f"/uploads/{u}"
+
+
+def _attachment_urls(data, legacy: bool = False) -> dict:
+    """提交数据里指向站内上传的值：{字段: [url]}（值可能是单个字符串或列表）。
+    legacy=True（迁移回填）时把旧画廊认的纯文件名 / 外链图片也带上，升级后画廊不丢图。"""
+    if isinstance(data, str):
+        data = json.loads(data or "{}")
+    out = {}
+    for k, v in (data or {}).items():
+        vals = v if isinstance(v, list) else [v]
+        urls = []
+        for u in vals:
+            if not isinstance(u, str):
+                continue
+            if _RE_UPLOAD_URL.match(u):
+                urls.append(u)
+            elif legacy:
+                lu = _legacy_image_url(k, u)
+                if lu:
+                    urls.append(lu)
+        if urls:
+            out[str(k)] = urls
+    return out
+
+
+def _insert_attachments(c, schema_name: str, files: dict, submission_id=None, draft_token=None, created_at=None):
+    """files: {字段: [url]}。大小 / 哈希 / mime / 宽高从上传索引里带过来；没登记的旧文件按扩展名猜 mime。
+    非站内上传的旧图（只有迁移回填会传进来）按 URL 末段当文件名，猜不出 mime 的记成 image/*。"""
+    rows = []
+    for field, urls in (files or {}).items():
+        for u in urls:
+            m = _RE_UPLOAD_URL.match(u or "")
+            if m:
+                rows.append((submission_id, draft_token, field, m.group(1), u,
+                             mimetypes.guess_type(m.group(1))[0], created_at))
+            elif u:
+                name = os.path.basename(urlsplit(u).path) or u
+                rows.append((submission_id, draft_token, field, name, u,
+                             mimetypes.guess_type(name)[0] or "image/*", created_at))
+    if not rows:
+        return
+    execute_values(c, f'''
+        INSERT INTO "{schema_name}".attachments
+               (submission_id, draft_token, field, name, url, filename, mime, size, width, height, sha256, created_at)
+        SELECT v.sid, v.tok, v.field, v.name, v.url, n.filename, COALESCE(b.mime, v.mime),
+               b.size, b.width, b.height, b.sha256, COALESCE(v.created_at, CURRENT_TIMESTAMP)
+          FROM (VALUES %s) AS v(sid, tok, field, name, url, mime, created_at)
+          LEFT JOIN "{schema_name}".upload_names n ON n.name = v.name
+          LEFT JOIN "{schema_name}".upload_blobs b ON b.sha256 = n.sha256
+    ''', rows, template="(%s::INT, %s, %s, %s, %s, %s, %s::TIMESTAMP)")
+
+
+def _resolve_upload(site_name: str, name: str):
+    """URL 里的文件名 -> (blob 路径, sha256)；没登记（旧文件、主题图等）返回 None。"""
+    key = (site_name, name)
+    ent = _UPLOAD_INDEX.get(key, max_age=UPLOAD_INDEX_TTL)
+    if ent is None:
+        gen = _UPLOAD_INDEX.generation(key)
+        schema_name = _safe_schema(site_name)
+        conn = get_conn(); c = conn.cursor()
+        try:
+            if not _tenant_is_current(c, schema_name):
+                return None
+            c.execute(f'SELECT sha256 FROM "{schema_name}".upload_names WHERE name=%s', (name,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+            _release_request_conn_early()
+        if not row:
+            return None   # 不缓存“没有”：旧文件被 uploads-dedupe 收进来后要能立刻查到
+        ent = {"version": 0, "loaded_at": time.monotonic(), "sha256": row[0]}
+        _UPLOAD_INDEX.put(key, ent, gen)
+    path = _blob_path(site_name, ent["sha256"])
+    return (path, ent["sha256"]) if os.path.exists(path) else None
+
+
+def _send_upload(path: str, mimetype: str, etag: str, max_age: int = UPLOAD_CACHE_MAX_AGE):
+    """send_file 带 max_age 会标成 public，这里改回 private：只让浏览器缓存，过期后凭 ETag 304。"""
+    resp = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=max_age)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
+
+
+# ========= 上传图片：缩略图派生 =========
+# /site/<site>/uploads/<name>?w=320 返回按宽度缩小的 WebP（浏览器不收 WebP 时给 JPEG），
+# 缓存在 blob 旁边：.cas/ab/cd/<sha256>.w320.webp。宽度只取 THUMB_WIDTHS 里的档位（向上取），
+# 派生物由 (sha256, 宽度, 格式) 唯一决定，ETag 稳定，缓存策略同原图（浏览器私有缓存）。
+# 生成放在有界线程池里（Pillow 解码/缩放/编码时释放 GIL），同一派生物并发请求只算一次；
+# 上传入库后预先生成画廊要用的档位；首次请求时没生成好的放进线程池排队，公开请求不等、直接回原图（短缓存），
+# 只有登录的管理端请求（画廊）会在请求里等一会儿——匿名的 ?w= 不能占着 gthread 线程。
+THUMB_WIDTHS = sorted({int(x) for x in os.getenv("THUMB_WIDTHS", "160,320,640,1280").split(",") if x.strip()})
+THUMB_PREGEN = [int(x) for x in os.getenv("THUMB_PREGEN", "160,320").split(",") if x.strip()]
+THUMB_WORKERS = int(os.getenv("THUMB_WORKERS", "2"))
+THUMB_WAIT = float(os.getenv("THUMB_WAIT", "10"))     # 管理端请求里最多等多少秒（公开请求不等）
+THUMB_MAX_PIXELS = int(os.getenv("THUMB_MAX_PIXELS", str(80_000_000)))   # 超过的不解码（解压炸弹）
+GALLERY_THUMB_WIDTH = int(os.getenv("GALLERY_THUMB_WIDTH", "160"))   # 画廊格子 160px，2x 屏用下一档
+_THUMB_SOURCES = {"image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp"}
+_THUMB_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg")}
+_THUMB_POOL = {"pool": None}
+_THUMB_LOCK = threading.Lock()
+_THUMB_INFLIGHT = {}                     # 派生物路径 -> Future
+_THUMB_FAILED = _FormDefCache(1024)      # 生成失败的派生物：一段时间内不再重试，直接回原图
+_THUMB_STATS = {"hits": 0, "generated": 0, "coalesced": 0, "fallback": 0, "failed": 0}
+
+
+def _thumb_width(w: int) -> int:
+    """请求的宽度 -> 档位（不小于它的最小一档；超过最大档就用最大档）。"""
+    for tw in THUMB_WIDTHS:
+        if tw >= w:
+            return tw
+    return THUMB_WIDTHS[-1]
+
+
+def _thumb_path(site_name: str, sha: str, width: int, ext: str) -> str:
+    return f"{_blob_path(site_name, sha)}.w{width}.{ext}"
+
+
+def _thumb_render(site_name: str, src: str, dst: str, width: int, ext: str):
+    """原图 -> 宽 width 的派生物，先写 .cas/tmp 再 rename，多进程同时生成也不会读到半个文件。"""
+    from PIL import Image, ImageOps   # 重依赖：只在真正生成时加载
+    with Image.open(src) as im:
+        if im.width * im.height > THUMB_MAX_PIXELS:
+            raise ValueError(f"image too large: {im.width}x{im.height}")
+        im.draft("RGB", (width, width))   # JPEG 直接按 1/2、1/4、1/8 解码，手机大图省掉大部分解码时间
+        im = ImageOps.exif_transpose(im)  # 手机照片的方向在 EXIF 里，派生物里转正
+        im.thumbnail((width, width * 8), Image.LANCZOS)
+        has_alpha = im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info)
+        fmt = _THUMB_FORMATS[ext][0]
+        if fmt == "JPEG" and has_alpha:
+            bg = Image.new("RGB", im.size, (255, 255, 255))
+            bg.paste(im.convert("RGBA"), mask=im.convert("RGBA").getchannel("A"))
+            im = bg
+        elif im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if has_alpha else "RGB")
+        tmp_dir = os.path.join(_cas_root(site_name), "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as out:
+            if fmt == "WEBP":
+                im.save(out, fmt, quality=80, method=4)
+            else:
+                im.save(out, fmt, quality=82, optimize=True, progressive=True)
+    os.replace(out.name, dst)
+    return dst
+
+
+def _thumb_submit(site_name: str, src: str, dst: str, width: int, ext: str):
+    """把一个派生物排进线程池；同一个 dst 已在排队/生成就复用那个 Future。"""
+    with _THUMB_LOCK:
+        fut = _THUMB_INFLIGHT.get(dst)
+        if fut is not None:
+            _THUMB_STATS["coalesced"] += 1
+            return fut
+        if _THUMB_POOL["pool"] is None:
+            _THUMB_POOL["pool"] = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumbs")
+        fut = _THUMB_POOL["pool"].submit(_thumb_render, site_name, src, dst, width, ext)
+        _THUMB_INFLIGHT[dst] = fut
+
+    def done(f):
+        with _THUMB_LOCK:
+            _THUMB_INFLIGHT.pop(dst, None)
+            if f.exception() is None:
+                _THUMB_STATS["generated"] += 1
+            else:
+                _THUMB_STATS["failed"] += 1
+                _THUMB_FAILED.put(dst, {"version": 0, "loaded_at": time.monotonic()})
+                app.logger.warning("thumbnail %s failed: %s", dst, f.exception())
+    fut.add_done_callback(done)
+    return fut
+
+
+def _thumbs_enqueue(site_name: str, blobs):
+    """上传登记提交后调用：给比档位宽的图片预生成画廊用的 WebP，不等结果。"""
+    for _, sha, _, _, mime, w, h in blobs:
+        if mime not in _THUMB_SOURCES or not w or not h:
+            continue
+        src = _blob_path(site_name, sha)
+        for tw in THUMB_PREGEN:
+            dst = _thumb_path(site_name, sha, _thumb_width(tw), "webp")
+            if max(w, h) > tw and not os.path.exists(dst):
+                _thumb_submit(site_name, src, dst, _thumb_width(tw), "webp")
+
+
+def _thumb_for(site_name: str, sha: str, src: str, w: int):
+    """?w= 请求：返回 (派生物路径, mime)；不需要缩（非图片、本来就不宽）返回 (None, None)；
+    该缩但暂时拿不到（失败、超时）返回 (None, "")。"""
+    width = _thumb_width(w)
+    ext = "webp" if "image/webp" in (request.headers.get("Accept") or "") else "jpg"
+    dst = _thumb_path(site_name, sha, width, ext)
+    if os.path.exists(dst):
+        with _THUMB_LOCK:
+            _THUMB_STATS["hits"] += 1
+        return dst, _THUMB_FORMATS[ext][1]
+    info = _image_info(src)
+    # EXIF 旋转后宽高可能互换，按长边判断：长边都不超过档位就直接给原图，不放大
+    if not info or info[0] not in _THUMB_SOURCES or max(info[1], info[2]) <= width:
+        return None, None
+    if _THUMB_FAILED.get(dst, max_age=600) is None:
+        fut = _thumb_submit(site_name, src, dst, width, ext)
+        if session.get("user_id"):
+            try:
+                fut.result(timeout=THUMB_WAIT)
+                return dst, _THUMB_FORMATS[ext][1]
+            except Exception:
+                pass   # 失败已在回调里记下；超时的继续在后台生成，下次请求就有了
+    with _THUMB_LOCK:
+        _THUMB_STATS["fallback"] += 1
+    return None, ""
+
+
+def _thumb_stats() -> dict:
+    with _THUMB_LOCK:
+        return {**_THUMB_STATS, "inflight": len(_THUMB_INFLIGHT), "widths": THUMB_WIDTHS}
+
 
-    for field_key in request.files:
-        files = request.files.getlist(field_key)
-        saved_urls = []
-        for f in files[:max_files]:
+# ========= 公开表单 POST =========
+def _stored_name(filename: str) -> str:
+    """落盘文件名：时间戳_随机_安全名。secure_filename 会把纯中文名削成只剩 "pdf"，这里把扩展名补回来。"""
+    safe = secure_filename(filename)
+    ext = Path(filename).suffix.lower()
+    if re.fullmatch(r"\.[a-z0-9]{1,10}", ext) and not safe.lower().endswith(ext):
+        safe = f"file{ext}" if safe.lower() in ("", ext[1:]) else f"{safe}{ext}"
+    safe = safe or "file"
+    return f"{int(time.time())}_{uuid4().hex[:8]}_{safe}"
+
+
+def _save_upload_files(site_name: str, plan: dict, existing=None, refs=None, created=None):
+    """把 request.files 按计划里的数量/扩展名限制存到站点目录，不碰数据库。
+    existing: {字段: [已有 url]}；refs: {字段: [分片上传 id]}（已 complete 的才算，此时才转正），
+    三者按 已有 -> 分片 -> 本次 multipart 的顺序共用 max_files 名额。
+    返回 ({字段: [url]}, [(name, sha256, size, 原始文件名, mime, 宽, 高)])，后者由调用方在写库的事务里 _register_uploads。
+    created: 传入列表时，本次 multipart 新建的 blob 记进去（见 _discard_new_blobs）；
+    分片上传转正的不记——upload_id 已标为 used，重试提交还要靠这个 blob。"""
+    existing = existing or {}
+    refs = refs or {}
+    out, blobs = {}, []
+    for field_key in set(request.files) | set(refs):
+        urls = list(existing.get(field_key, []))
+        for upload_id in refs.get(field_key, []):
+            if len(urls) >= plan["upload_max_files"]:
+                break
+            took = _chunk_take(site_name, upload_id, field_key)
+            if took and took[0] not in urls:
+                urls.append(took[0])
+                blobs.append(took[1])
+        remain = max(0, plan["upload_max_files"] - len(urls))
+        if remain <= 0:
+            continue
+        for f in request.files.getlist(field_key)[:remain]:
             if not f or not f.filename:
                 continue
             ext = Path(f.filename).suffix.lower().lstrip(".")
-            if allowed and ext not in allowed:
+            if plan["allowed"] and ext not in plan["allowed"]:
                 continue
-            uniq = f"{int(time.time())}_{uuid4().hex[:8]}_{secure_filename(f.filename)}"
-            abs_path = os.path.join(site_folder, uniq)
-            f.save(abs_path)
-            saved_urls.append(f"/site/{site_name}/uploads/{uniq}")
-        if saved_urls:
-            data[field_key] = saved_urls
-
-    # 写入“namespaced”表
-    try:
-        c.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema_name}"')
-        c.execute(f"""
-            CREATE TABLE IF NOT EXISTS "{schema_name}".submissions (
-                id SERIAL PRIMARY KEY,
-                user_id INT,
-                data JSONB,
-                status TEXT DEFAULT '待审核',
-                review_comment TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        c.execute(f'INSERT INTO "{schema_name}".submissions (data, status) VALUES (%s, %s) RETURNING id',
-                  (json.dumps(data, ensure_ascii=False), '待审核'))
-        new_id = c.fetchone()[0]
+            uniq = _stored_name(f.filename)
+            sha, size, new_ns = _store_blob(site_name, f.stream)
+            if new_ns is not None and created is not None:
+                created.append((sha, new_ns))
+            blobs.append((uniq, sha, size, f.filename, *_blob_meta(_blob_path(site_name, sha), f.filename)))
+            urls.append(f"/site/{site_name}/uploads/{uniq}")
+        if len(urls) > len(existing.get(field_key, [])):
+            out[field_key] = urls
+    return out, blobs
+
+
+def _pop_upload_refs(data: dict) -> dict:
+    """从表单数据里取出 __upload__<字段>（分片上传 id，可多值；兼容 name[] 写法）。"""
+    refs = {}
+    for k in list(data.keys()):
+        if k.startswith("__upload__"):
+            data.pop(k, None)
+            field = k[len("__upload__"):]
+            field = field[:-2] if field.endswith("[]") else field
+            refs.setdefault(field, []).extend(v for v in request.form.getlist(k) if _RE_UPLOAD_ID.match(v))
+    return refs
+
+
+@app.route("/f/<site_name>", methods=["POST"])
+def public_submit(site_name):
+    schema_name = _safe_schema(site_name)
+
+    # ① 上传上限/允许类型（预编译计划；走缓存）+ 租户已开通（没开通就别收文件）。借过的连接先还掉
+    plan = _form_plan(site_name)
+    if plan is None:
+        return "not found", 404
+    _check_tenant(site_name)
+    _release_request_conn_early()
+
+    # ② 收请求体 + 文件落盘：慢客户端的字节慢慢到，这期间不占数据库连接
+    data = request.form.to_dict()
+    created = []
+    saved, blobs = _save_upload_files(site_name, plan, refs=_pop_upload_refs(data), created=created)
+    data.update(saved)
+    receipt = _new_receipt()
+    payload = (json.dumps(data, ensure_ascii=False), '待审核', _search_tokens(data),
+               _lookup_key(data, plan["lookup_field"]), receipt)
+
+    # ③ 短事务：登记上传 + 一条 INSERT + NOTIFY（租户表由迁移创建），提交后立刻归还连接
+    conn = get_conn(); c = conn.cursor()
+    try:
+        _require_tenant(c, schema_name)
+        _register_uploads(c, schema_name, blobs)
+        c.execute(f'''INSERT INTO "{schema_name}".submissions
+                            (data, status, search_tsv, lookup_key, receipt)
+                        VALUES (%s, %s, array_to_tsvector(%s::TEXT[]), %s, %s) RETURNING id''',
+                  payload)
+        _insert_attachments(c, schema_name, saved, submission_id=c.fetchone()[0])
+        _notify_submissions_changed(c, site_name)
         conn.commit()
+    except TenantNotReady:
+        raise
     except Exception as e:
-        conn.rollback(); conn.close()
+        conn.rollback()
+        _discard_new_blobs(c, site_name, schema_name, created)   # 这次写下、没登记上的文件现在就删
         return f"提交失败：{e}", 500
     finally:
         conn.close()
+        _release_request_conn_early()
+    _submissions_changed_local(site_name)
+    _thumbs_enqueue(site_name, blobs)
 
     # 成功页（公共）
     return render_template_string(
         PUBLIC_SUCCESS_HTML,
         site_name=site_name,
         home_url=url_for("index"),
-        public_url=url_for("public_form", site_name=site_name)
+        public_url=url_for("public_form", site_name=site_name),
+        receipt=receipt,
     )
 
+# ========= 分片上传（可续传）=========
+# 大附件不再塞进一次 multipart：先 init 拿 upload_id，再按偏移量 PUT 分片，最后 complete，
+# 表单提交时用隐藏域 __upload__<字段>=<upload_id> 引用。
+#   - 分片直接从 request.stream 追加写进 uploads/<site>/.partial/<id>.part，不经 Werkzeug 的表单缓冲
+#   - 进度就是 .part 的文件长度：断线后 GET 一下拿到 offset 接着传；偏移量对不上返回 409 + 当前 offset
+#   - complete 只校验、标记 done，文件仍留在 .partial/；等提交/草稿真正引用这个 upload_id 时
+#     才转正进内容寻址存储并登记。没人引用的（传完就走的）和没传完的一样，过了 TTL 被 _chunk_prune 删掉
+#   - 元数据是旁边的 <id>.json（同机多个 worker 共享磁盘即可），不进数据库
+#   - 这几个接口不用登录，所以按站点 / 按来源 IP 限额：未完成 + 已完成未引用的总字节数与个数
+CHUNK_UPLOAD_MAX_BYTES = int(os.getenv("CHUNK_UPLOAD_MAX_BYTES", str(app.config["MAX_CONTENT_LENGTH"])))  # 单个文件上限
+CHUNK_SIZE_HINT = 8 * 1024 * 1024        # 建议分片大小（远小于 MAX_CONTENT_LENGTH）
+CHUNK_UPLOAD_TTL = 24 * 3600             # 未完成/未引用的分片元数据保留多久
+CHUNK_QUOTA_SITE_BYTES = int(os.getenv("CHUNK_QUOTA_SITE_BYTES", str(20 * app.config["MAX_CONTENT_LENGTH"])))
+CHUNK_QUOTA_IP_BYTES = int(os.getenv("CHUNK_QUOTA_IP_BYTES", str(2 * app.config["MAX_CONTENT_LENGTH"])))
+CHUNK_QUOTA_IP_UPLOADS = int(os.getenv("CHUNK_QUOTA_IP_UPLOADS", "20"))
+_RE_UPLOAD_ID = re.compile(r"^[a-f0-9]{32}$")
+
+
+def _partial_dir(site_name: str) -> str:
+    return os.path.join(app.config["UPLOAD_FOLDER"], site_name, ".partial")
+
+
+def _chunk_meta_read(site_name: str, upload_id: str):
+    if not _RE_UPLOAD_ID.match(upload_id or ""):
+        return None
+    try:
+        with open(os.path.join(_partial_dir(site_name), f"{upload_id}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _chunk_meta_write(site_name: str, upload_id: str, meta: dict):
+    path = os.path.join(_partial_dir(site_name), f"{upload_id}.json")
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _chunk_prune(site_name: str):
+    folder = _partial_dir(site_name)
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    cutoff = time.time() - CHUNK_UPLOAD_TTL
+    for name in names:
+        if name.startswith("."):
+            continue   # .lock
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _chunk_status(meta: dict, offset: int):
+    return {"ok": True, "upload_id": meta["id"], "offset": offset, "size": meta["size"],
+            "done": bool(meta.get("done")), "url": meta.get("url") if meta.get("used") else None}
+
+
+def _chunk_pending(site_name: str):
+    """站点里还占着 .partial/ 的上传（未完成 + 已完成未引用）：[(来源 IP, 声明大小)]。"""
+    folder = _partial_dir(site_name)
+    out = []
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return out
+    for name in names:
+        if name.endswith(".json"):
+            meta = _chunk_meta_read(site_name, name[:-5])
+            if meta and not meta.get("used"):
+                out.append((meta.get("ip"), int(meta.get("size") or 0)))
+    return out
+
+
+def _chunk_take(site_name: str, upload_id: str, field_key: str):
+    """提交/草稿引用一个分片上传：已 complete 的转正进内容寻址存储（或确认 blob 还在），
+    返回 (url, blob 元组) 交给调用方在自己的事务里登记；不可用返回 None。同一个 id 可以被再次引用（草稿 -> 提交）。"""
+    meta = _chunk_meta_read(site_name, upload_id)
+    if not meta or not meta.get("done") or meta.get("field") != field_key:
+        return None
+    sha = meta["sha256"]
+    part = os.path.join(_partial_dir(site_name), f"{upload_id}.part")
+    blob = _blob_path(site_name, sha)
+    try:
+        _blob_commit(site_name, part, sha)
+    except OSError:
+        # .part 已被之前的引用（或并发的另一个请求）转正：blob 必须还在，刷新 mtime 免得 uploads-gc 在登记前回收
+        try:
+            os.utime(blob)
+        except OSError:
+            return None
+    meta.update(used=True, url=f"/site/{site_name}/uploads/{meta['name']}")
+    _chunk_meta_write(site_name, upload_id, meta)   # 顺便刷新 mtime：TTL 从最后一次引用算
+    return meta["url"], (meta["name"], sha, meta["size"], meta["filename"], *_blob_meta(blob, meta["filename"]))
+
+
+@app.post("/site/<site_name>/upload/init")
+def chunk_upload_init(site_name):
+    """{field, filename, size[, sha256]} -> {upload_id, offset:0, chunk_size}。字段须是表单里的文件题，扩展名受表单限制。
+    sha256 只作校验用：字节必须真的传上来，complete 时比对（不按哈希秒传——否则只凭一个哈希就能拿到站内文件的链接，
+    回应的不同也会泄露某份文件是否传过）；相同内容在转正时去重。"""
+    plan = _form_plan(site_name)
+    if plan is None:
+        return jsonify(ok=False, error="no such site"), 404
+    _check_tenant(site_name)
+    _release_request_conn_early()
+    body = request.get_json(silent=True) or {}
+    field = str(body.get("field") or "")
+    filename = str(body.get("filename") or "")
+    try:
+        size = int(body.get("size"))
+    except (TypeError, ValueError):
+        return jsonify(ok=False, error="size 必须是整数"), 400
+    file_keys = {str(f.get("key") or f.get("id")) for f in plan["clean_fields"]
+                 if str(f.get("type") or "").lower() == "file"}
+    if field not in file_keys:
+        return jsonify(ok=False, error="该字段不接受文件"), 400
+    ext = Path(filename).suffix.lower().lstrip(".")
+    if not filename or (plan["allowed"] and ext not in plan["allowed"]):
+        return jsonify(ok=False, error="不支持的文件类型"), 400
+    if size <= 0 or size > CHUNK_UPLOAD_MAX_BYTES:
+        return jsonify(ok=False, error=f"文件大小须在 1 ~ {CHUNK_UPLOAD_MAX_BYTES} 字节之间"), 413
+
+    sha = str(body.get("sha256") or "").strip().lower()
+    sha = sha if _RE_SHA256.match(sha) else None
+
+    _chunk_prune(site_name)
+    os.makedirs(_partial_dir(site_name), exist_ok=True)
+    ip = request.remote_addr or ""
+    upload_id = uuid4().hex
+    meta = {"id": upload_id, "field": field, "filename": filename, "size": size, "sha256": sha,
+            "name": _stored_name(filename), "ip": ip,
+            "created_at": time.time(), "done": False}
+    # 限额检查和占位写在同一把锁里（同站点多个 worker 并发 init 不会一起越过额度）
+    with open(os.path.join(_partial_dir(site_name), ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        pending = _chunk_pending(site_name)
+        mine = [n for who, n in pending if who == ip]
+        if (sum(n for _, n in pending) + size > CHUNK_QUOTA_SITE_BYTES
+                or sum(mine) + size > CHUNK_QUOTA_IP_BYTES or len(mine) >= CHUNK_QUOTA_IP_UPLOADS):
+            return jsonify(ok=False, error="未完成的上传太多，请先提交或稍后再试"), 429
+        open(os.path.join(_partial_dir(site_name), f"{upload_id}.part"), "wb").close()
+        _chunk_meta_write(site_name, upload_id, meta)
+    return jsonify({**_chunk_status(meta, 0), "chunk_size": CHUNK_SIZE_HINT})
+
+
+@app.route("/site/<site_name>/upload/<upload_id>", methods=["GET", "PUT"])
+def chunk_upload(site_name, upload_id):
+    """GET：当前 offset（断线续传先问这个）。PUT：请求体是从 Upload-Offset（或 ?offset=）开始的一段字节。"""
+    meta = _chunk_meta_read(site_name, upload_id)
+    if meta is None:
+        return jsonify(ok=False, error="上传不存在或已过期"), 404
+    part = os.path.join(_partial_dir(site_name), f"{upload_id}.part")
+    if meta.get("done"):
+        return jsonify(_chunk_status(meta, meta["size"]))
+    if request.method == "GET":
+        try:
+            return jsonify(_chunk_status(meta, os.path.getsize(part)))
+        except OSError:
+            return jsonify(ok=False, error="上传不存在或已过期"), 404
+
+    try:
+        offset = int(request.headers.get("Upload-Offset") or request.args.get("offset") or "")
+    except ValueError:
+        return jsonify(ok=False, error="缺少 Upload-Offset"), 400
+    try:
+        fd = os.open(part, os.O_WRONLY | os.O_APPEND)
+    except OSError:
+        return jsonify(ok=False, error="上传不存在或已过期"), 404
+    with os.fdopen(fd, "ab") as out:
+        try:
+            fcntl.flock(out, fcntl.LOCK_EX | fcntl.LOCK_NB)   # 同一个 upload 同时只允许一个 PUT
+        except OSError:
+            return jsonify(ok=False, error="该上传正在写入", offset=os.fstat(fd).st_size), 409
+        current = os.fstat(fd).st_size
+        if offset != current:
+            return jsonify(ok=False, error="offset 不匹配", offset=current), 409
+        left = meta["size"] - current
+        stream = request.stream
+        while True:
+            buf = stream.read(min(256 * 1024, left + 1))
+            if not buf:
+                break
+            if len(buf) > left:
+                out.write(buf[:left]); out.flush()
+                return jsonify(ok=False, error="超出声明的文件大小", offset=meta["size"]), 413
+            out.write(buf)
+            left -= len(buf)
+        out.flush()
+        return jsonify(_chunk_status(meta, meta["size"] - left))
+
+
+@app.post("/site/<site_name>/upload/<upload_id>/complete")
+def chunk_upload_complete(site_name, upload_id):
+    """字节收齐后校验 sha256（init 时给过就比对）并标记 done；转正和登记等提交/草稿引用时再做。重复调用幂等。"""
+    meta = _chunk_meta_read(site_name, upload_id)
+    if meta is None:
+        return jsonify(ok=False, error="上传不存在或已过期"), 404
+    if meta.get("done"):
+        return jsonify(_chunk_status(meta, meta["size"]))
+    part = os.path.join(_partial_dir(site_name), f"{upload_id}.part")
+    try:
+        got = os.path.getsize(part)
+    except OSError:
+        return jsonify(ok=False, error="上传不存在或已过期"), 404
+    if got != meta["size"]:
+        return jsonify(ok=False, error="文件还没传完", offset=got), 409
+    try:
+        sha = _sha256_file(part)
+    except OSError:   # 并发的另一个请求已经把它引用走了
+        meta = _chunk_meta_read(site_name, upload_id) or {}
+        if meta.get("done"):
+            return jsonify(_chunk_status(meta, meta["size"]))
+        return jsonify(ok=False, error="上传不存在或已过期"), 404
+    if meta.get("sha256") and meta["sha256"] != sha:
+        os.remove(part)   # 内容和声明的不一致：作废，前端会重新 init
+        os.remove(os.path.join(_partial_dir(site_name), f"{upload_id}.json"))
+        return jsonify(ok=False, error="文件校验失败，请重新上传"), 422
+    meta.update(done=True, sha256=sha)
+    _chunk_meta_write(site_name, upload_id, meta)
+    return jsonify(_chunk_status(meta, meta["size"]))
+
+
 # ========= 站点内上传文件访问 =========
 @app.route("/site/<site_name>/uploads/<path:filename>")
 def site_uploaded_file(site_name, filename):
+    if any(part.startswith(".") for part in filename.split("/")):
+        abort(404)   # .partial/、.cas/ 等内部目录不对外
+    hit = _resolve_upload(site_name, filename) if "/" not in filename else None
+    if hit:
+        path, sha = hit
+        w = request.args.get("w", type=int)
+        if w and w > 0:
+            thumb, mime = _thumb_for(site_name, sha, path, w)
+            if thumb:
+                resp = _send_upload(thumb, mime, f"{sha}.w{_thumb_width(w)}.{mime[6:]}")
+                resp.vary.add("Accept")
+                return resp
+            if mime == "":
+                # 缩略图暂时没有：先给原图，但别让浏览器把原图当成这个 URL 缓存太久
+                return _send_upload(path, mimetypes.guess_type(filename)[0] or "application/octet-stream",
+                                    sha, max_age=60)
+        return _send_upload(path, mimetypes.guess_type(filename)[0] or "application/octet-stream", sha)
     folder = os.path.join(app.config.get("UPLOAD_FOLDER", "uploads"), site_name)
     return send_from_directory(folder, filename, as_attachment=False)
 
 # ========= 状态查询 =========
 @app.route("/site/<site_name>/status_query")
 def public_status_query(site_name):
+    """按回执号（receipt）或姓名（lookup_key，规范化后全等）查最新一条，都是索引等值查找。
+    只知道姓名的匿名查询只回审核状态；提交内容（data）要凭回执号才给。"""
     name = (request.args.get("name") or "").strip()
-    if not name:
+    receipt = (request.args.get("receipt") or "").strip().upper()
+    # 输入框里直接填回执号也认
+    if not receipt and _RE_RECEIPT.match(name.upper()):
+        receipt = name.upper()
+    if not name and not receipt:
         return jsonify({"ok": False, "error": "缺少姓名"}), 400
 
     schema = _safe_schema(site_name)
     conn = get_conn(); c = conn.cursor()
     try:
         c.execute(f'SET search_path TO "{schema}", public')
-        c.execute("""
-            SELECT id, data, status, review_comment, created_at
-            FROM submissions
-            WHERE data::text ILIKE %s
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, (f"%{name}%",))
-        row = c.fetchone()
+        row = None
+        if receipt:
+            c.execute("""
+                SELECT id, data, status, review_comment, created_at
+                FROM submissions
+                WHERE receipt = %s
+            """, (receipt,))
+            row = c.fetchone()
+        by_receipt = row is not None
+        if row is None and name:
+            c.execute("""
+                SELECT id, data, status, review_comment, created_at
+                FROM submissions
+                WHERE lookup_key = %s
+                ORDER BY created_at DESC, id DESC
+                LIMIT 1
+            """, (_lookup_norm(name)[:200],))
+            row = c.fetchone()
         if not row:
             return jsonify({"ok": True, "found": False})
-        data = row[1] if isinstance(row[1], dict) else (json.loads(row[1]) if row[1] else {})
-        return jsonify({
+        out = {
             "ok": True, "found": True,
-            "id": row[0],
             "status": row[2] or "待审核",
             "review_comment": row[3] or "",
             "created_at": str(row[4]) if row[4] else "",
-            "data": data
-        })
+        }
+        if by_receipt:
+            out["id"] = row[0]
+            out["data"] = row[1] if isinstance(row[1], dict) else (json.loads(row[1]) if row[1] else {})
+        return jsonify(out)
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
     finally:
@@ -1770,6 +4052,18 @@ def uploaded_file(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 # ========= 删除与导出 =========
+def _set_download_name(resp, filename: str):
+    """流式导出（不走 send_file）的 Content-Disposition，写法同 send_file(download_name=...)：
+    站点名可能是中文，非 ASCII 时给一个 ASCII 兜底 filename 再加 RFC 5987 的 filename*。"""
+    try:
+        filename.encode("ascii")
+        names = {"filename": filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        names = {"filename": simple, "filename*": f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"}
+    resp.headers.set("Content-Disposition", "attachment", **names)
+    return resp
+
 @app.route("/form/<int:form_id>/delete/<int:sub_id>", methods=["GET","POST"])
 @admin_required
 def delete_submission(form_id, sub_id):
@@ -1781,9 +4075,11 @@ def delete_submission(form_id, sub_id):
         return jsonify({"success":False,"message":"表单不存在"})
     site_name = row[1]
     schema_name = row[2]
-    c.execute(f"SET search_path TO {schema_name}")
+    c.execute(f'SET LOCAL search_path TO "{schema_name}", public')
     c.execute("DELETE FROM submissions WHERE id=%s", (sub_id,))
+    _notify_submissions_changed(c, site_name)
     conn.commit(); conn.close()
+    _submissions_changed_local(site_name)
     if request.method=="POST" and request.is_json:
         return jsonify({"success":True})
     return redirect(url_for("site_admin", site_name=site_name))
@@ -1805,8 +4101,12 @@ def delete_form(form_id):
     schema_name = row[2]
     try:
         c.execute(f"DROP SCHEMA IF EXISTS {schema_name} CASCADE")
+        c.execute("DELETE FROM public.schema_migrations WHERE scope=%s", (schema_name,))
         c.execute("DELETE FROM form_defs WHERE id=%s", (form_id,))
+        _notify_form_changed(c, row[1])
         conn.commit()
+        _forget_tenant(schema_name)
+        _form_changed_local(row[1])
         ok = True; err = None
     except Exception as e:
         conn.rollback()
@@ -1826,11 +4126,6 @@ def preview_form(site_name):
     - POST: 优先使用请求里带来的 schema_json/form_name/form_desc
     - GET: 退化为预览数据库里已保存的表单（等价 /f/<site_name>）
     """
-    # 读取 schema / 标题 / 描述
-    schema = {}
-    form_title = site_name
-    form_desc_html = ""
-
     if request.method == "POST":
         raw = request.form.get("schema_json")
         if isinstance(raw, str) and 'data:image' in raw:
@@ -1843,85 +4138,31 @@ def preview_form(site_name):
             schema = json.loads(raw) if isinstance(raw, str) else (raw or {})
         except Exception:
             schema = {}
-
-        form_title = (request.form.get("form_name") or
-                      schema.get("title") or schema.get("name") or site_name)
-        form_desc_html = (request.form.get("form_desc") or
-                          schema.get("descHTML") or schema.get("desc") or schema.get("description") or "")
+        if not isinstance(schema, dict):
+            schema = {}
+        # 未保存的 schema 只能现编译；标题/描述以表单里填的为准
+        plan = _compile_form(schema, request.form.get("form_name") or "")
+        plan["title"] = plan["title"] or site_name
+        form_desc = request.form.get("form_desc")
+        if form_desc:
+            plan["desc_html"] = form_desc
     else:
-        # 和 /f/<site_name> 一致：从数据库读
-        conn = get_conn(); c = conn.cursor()
-        c.execute("SELECT name, schema_json, COALESCE(description,'') FROM form_defs WHERE site_name=%s", (site_name,))
-        row = c.fetchone(); conn.close()
-        if not row:
+        # 和 /f/<site_name> 一致：读已保存表单的预编译计划（走缓存）
+        plan = _form_plan(site_name)
+        if plan is None:
             abort(404)
-        form_title = row[0]
-        schema = row[1] if isinstance(row[1], dict) else json.loads(row[1] or "{}")
-        db_desc = (row[2] or "").strip()
-        form_desc_html = (schema.get("descHTML") or schema.get("desc") or schema.get("description") or db_desc)
-
-    # 主题/外观（与 public_form 保持一致）
-    theme = schema.get("theme") or {}
-    brand_light = (theme.get("brand_light") or theme.get("brand") or "#2563eb").strip()
-    brand_dark  = (theme.get("brand_dark")  or theme.get("brand") or "#0ea5e9").strip()
-    theme_mode  = (theme.get("mode") or theme.get("theme_mode") or theme.get("appearance") or "auto").lower()
-    if theme_mode not in ("light","dark","auto"):
-        theme_mode = "auto"
-
-    upload_cfg = (schema.get("upload") or (schema.get("settings") or {}).get("upload") or {})
-    upload_max_files = int(upload_cfg.get("max_files") or 3)
-
-    # 字段清洗（同 public_form）
-    raw_fields = schema.get("fields") or []
-    if not isinstance(raw_fields, list):
-        raw_fields = []
-    def _strip_desc(f):
-        g = dict(f or {})
-        for k in ("desc","descHTML","description","help","helpText"):
-            g.pop(k, None)
-        return g
-    clean_fields = [_strip_desc(f) for f in raw_fields]
-    # ✅ 取封面图与位置
-    _header = schema.get("header") or schema.get("display") or {}
-    header_image = (_header.get("title_image") or _header.get("cover_image") or "").strip()
-    header_image_pos = (_header.get("title_image_pos") or "center").strip()
 
     # 模板渲染
     try:
         return render_template(
             "public_form.html",
             site_name=site_name,
-            form_title=form_title,
-            form_desc=form_desc_html,
-            fields=clean_fields,
-            brand_light=brand_light,
-            brand_dark=brand_dark,
-            theme_mode=theme_mode,
-            has_file=any((f.get("type") or "").lower() == "file" for f in clean_fields),
-            upload_max_files=upload_max_files,
             # 传个标记给前端，如有用可用它做定制
             preview_mode=True,
-            schema_json=json.dumps(schema, ensure_ascii=False),  # ← 新增
-            header_image=header_image,
-            header_image_pos=header_image_pos,
-
+            **_form_plan_context(plan),
         )
     except TemplateNotFound:
-        brand = brand_dark if theme_mode == "dark" else brand_light
-        return render_template_string(
-            PUBLIC_FORM_HTML,
-            site_name=site_name,
-            form_name=form_title,
-            form_desc=form_desc_html,
-            fields=[{
-                "label": f.get("labelHTML") or f.get("label") or f.get("key",""),
-                "type": (f.get("type") or "text"),
-                "key":  (f.get("key") or f.get("id")),
-                "options": f.get("options") or [],
-                "required": bool(f.get("required", False)),
-            } for f in clean_fields],
-            brand=brand,
-        )
+        return _render_form_fallback(site_name, plan)
 
 # === 预览：不需要 site_name，直接按传入 schema 渲染公开页 ===
 @app.post("/preview")
@@ -1935,118 +4176,43 @@ def preview_inline():
         schema = json.loads(schema_json) if isinstance(schema_json, str) else (schema_json or {})
     except Exception:
         schema = {}
+    if not isinstance(schema, dict):
+        schema = {}
 
-    # 主题参数
-    theme = schema.get("theme") or {}
-    brand_light = (theme.get("brand_light") or theme.get("brand") or "#2563eb").strip()
-    brand_dark  = (theme.get("brand_dark")  or theme.get("brand") or "#0ea5e9").strip()
-    theme_mode  = (theme.get("mode") or theme.get("theme_mode") or theme.get("appearance") or "auto").lower()
-    if theme_mode not in ("light","dark","auto"):
-        theme_mode = "auto"
-
-    # 上传配置（预览不真正上传）
-    upload_cfg = (schema.get("upload") or (schema.get("settings") or {}).get("upload") or {})
-    upload_max_files = int(upload_cfg.get("max_files") or 3)
-
-    # 字段清洗
-    raw_fields = schema.get("fields") or []
-    if not isinstance(raw_fields, list):
-        raw_fields = []
-    def _strip_desc(f):
-        g = dict(f or {})
-        for k in ("desc","descHTML","description","help","helpText"):
-            g.pop(k, None)
-        return g
-    clean_fields = [_strip_desc(f) for f in raw_fields]
-
-    # 回退
-    fields_fallback = []
-    for f in clean_fields:
-        fields_fallback.append({
-            "label": f.get("labelHTML") or f.get("label") or f.get("key",""),
-            "type":  (f.get("type") or "text"),
-            "key":   (f.get("key") or f.get("id")),
-            "options": f.get("options") or [],
-            "required": bool(f.get("required", False)),
-        })
+    # 传入的 schema 未保存，现编译（与 public_form 同一套规则）
+    plan = _compile_form(schema, form_name)
+    plan["title"] = form_name or schema.get("name") or "预览"
+    if form_desc:
+        plan["desc_html"] = form_desc
 
-    # 关键改动：传 schema（对象），并且同时传 form_name 兼容模板
     try:
-        title = form_name or schema.get("name") or "预览"
-        desc  = form_desc or (schema.get("descHTML") or schema.get("desc") or schema.get("description"))
-
-        # ✅ 新增：从 schema 取封面图及位置（与 public_form 保持一致）
-        header_image = (
-                (schema.get("header") or {}).get("title_image")
-                or (schema.get("display") or {}).get("title_image")
-                or (schema.get("display") or {}).get("cover_image")
-                or ""
-        )
-        header_image_pos = (
-                (schema.get("header") or {}).get("title_image_pos")
-                or (schema.get("display") or {}).get("title_image_pos")
-                or "center"
-        )
-
         return render_template(
             "public_form.html",
             site_name="__preview__",  # 占位
-            form_title=form_name or schema.get("name") or "预览",
-            form_desc=form_desc or (schema.get("descHTML") or schema.get("desc") or schema.get("description")),
-            fields=clean_fields,
-            brand_light=brand_light,
-            brand_dark=brand_dark,
-            theme_mode=theme_mode,
-            has_file=any((f.get("type") or "").lower() == "file" for f in clean_fields),
-            upload_max_files=upload_max_files,
-            schema_json=json.dumps(schema, ensure_ascii=False),  # 传给模板
-
-            # ✅ 新增：传给模板
-            header_image=header_image,
-            header_image_pos=header_image_pos,
-
-            preview_mode=True  # 注意：只保留一次，别重复传
+            preview_mode=True,
+            **_form_plan_context(plan),
         )
-
-
     except TemplateNotFound:
-        brand = brand_dark if theme_mode == "dark" else brand_light
-        return render_template_string(
-            PUBLIC_FORM_HTML,
-            site_name="预览",
-            form_name=form_name or schema.get("name") or "预览",
-            form_desc=form_desc or (schema.get("descHTML") or schema.get("desc") or schema.get("description")),
-            fields=fields_fallback,
-            brand=brand
-        )
+        return _render_form_fallback("预览", plan)
 
 
 # ========= 公共页：保存草稿（含文件）=========
 @app.post("/site/<site_name>/draft/save")
 def save_public_draft(site_name):
-    conn = get_conn(); c = conn.cursor()
-
-    # 读 schema & 上传上限
-    c.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
+    # ① 上传上限/允许类型（预编译计划；走缓存）+ 租户已开通
+    plan = _form_plan(site_name)
+    if plan is None:
         return jsonify(ok=False, error="no such site"), 404
+    _check_tenant(site_name)
+    _release_request_conn_early()
 
-    schema = row[0] if isinstance(row[0], dict) else json.loads(row[0] or "{}")
-    upload_cfg = (schema.get("upload") or (schema.get("settings") or {}).get("upload") or {})
-    max_files = int(upload_cfg.get("max_files") or 3)
-    allowed = set(
-        x.strip().lower()
-        for x in str(upload_cfg.get("allowed_file_types", "")).split(",")
-        if x.strip()
-    )
-
+    # ② 收请求体 + 文件落盘（不占连接）
     token = (request.form.get("__draft_token") or uuid4().hex)
 
     # 非文件字段
     data = request.form.to_dict()
     data.pop("__draft_token", None)
+    refs = _pop_upload_refs(data)
 
     # 已上传 URL（由前端隐藏域传回）
     uploaded_map = {}
@@ -2056,47 +4222,37 @@ def save_public_draft(site_name):
             uploaded_map[field] = request.form.getlist(k)
             data.pop(k, None)
 
-    # 保存新选择文件 -> URL
-    site_folder = os.path.join(app.config["UPLOAD_FOLDER"], site_name)
-    os.makedirs(site_folder, exist_ok=True)
-
-    files_payload = {**uploaded_map}  # field -> [urls]
-    for field_key in request.files:
-        urls = files_payload.get(field_key, [])[:]
-        remain = max(0, max_files - len(urls))
-        if remain <= 0:
-            continue
-        for f in request.files.getlist(field_key)[:remain]:
-            if not f or not f.filename:
-                continue
-            ext = Path(f.filename).suffix.lower().lstrip(".")
-            if allowed and ext not in allowed:
-                continue
-            uniq = f"{int(time.time())}_{uuid4().hex[:8]}_{secure_filename(f.filename)}"
-            abs_path = os.path.join(site_folder, uniq)
-            f.save(abs_path)
-            urls.append(f"/site/{site_name}/uploads/{uniq}")
-        files_payload[field_key] = urls
+    # 保存新选择文件 -> URL（已有的排在前面，一起受 max_files 限制）
+    created = []
+    saved, blobs = _save_upload_files(site_name, plan, uploaded_map, refs, created)
+    files_payload = {**uploaded_map, **saved}  # field -> [urls]
 
-    # 建表 & UPSERT
+    # ③ 短事务：UPSERT（草稿表由迁移创建）
     schema_name = _safe_schema(site_name)
-    c.execute(f'''
-        CREATE TABLE IF NOT EXISTS "{schema_name}".drafts (
-          token TEXT PRIMARY KEY,
-          data  JSONB,
-          files JSONB,
-          created_at TIMESTAMP DEFAULT NOW(),
-          updated_at TIMESTAMP DEFAULT NOW()
+    conn = get_conn(); c = conn.cursor()
+    try:
+        _require_tenant(c, schema_name)
+        _register_uploads(c, schema_name, blobs)
+        c.execute(
+            f'''INSERT INTO "{schema_name}".drafts(token, data, files)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (token) DO UPDATE
+                SET data=EXCLUDED.data, files=EXCLUDED.files, updated_at=NOW()''',
+            (token, json.dumps(data, ensure_ascii=False), json.dumps(files_payload, ensure_ascii=False))
         )
-    ''')
-    c.execute(
-        f'''INSERT INTO "{schema_name}".drafts(token, data, files)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (token) DO UPDATE
-            SET data=EXCLUDED.data, files=EXCLUDED.files, updated_at=NOW()''',
-        (token, json.dumps(data, ensure_ascii=False), json.dumps(files_payload, ensure_ascii=False))
-    )
-    conn.commit(); conn.close()
+        c.execute(f'DELETE FROM "{schema_name}".attachments WHERE draft_token=%s', (token,))
+        _insert_attachments(c, schema_name, files_payload, draft_token=token)
+        conn.commit()
+    except TenantNotReady:
+        raise
+    except Exception:
+        conn.rollback()
+        _discard_new_blobs(c, site_name, schema_name, created)
+        raise
+    finally:
+        conn.close()
+        _release_request_conn_early()
+    _thumbs_enqueue(site_name, blobs)
 
     return jsonify(ok=True, token=token, files=files_payload)
 
@@ -2107,34 +4263,259 @@ def _extract_email(data: dict) -> str:
         if v: return str(v)
     return ""
 
-@app.route("/site/<site_name>/admin/export_word/<int:sub_id>")
+def _docx_pairs(raw) -> list:
+    data = raw if isinstance(raw, dict) else (json.loads(raw) if raw else {})
+    data = _normalize_obj(data)
+    return [(_maybe_fix_encoding(str(k)), _maybe_fix_encoding("" if v is None else str(v)))
+            for k, v in (data or {}).items()]
+
+
+@app.route("/site/<site_name>/admin/export_word/<int:sub_id>")
+@admin_required
+def export_word(site_name, sub_id):
+    schema = _safe_schema(site_name)
+    conn = get_conn(); c = conn.cursor()
+    c.execute(f'SET search_path TO "{schema}", public')
+    c.execute("SELECT data FROM submissions WHERE id=%s", (sub_id,))
+    row = c.fetchone(); conn.close()
+    if not row: return "❌ 记录不存在", 404
+
+    _, body = docx_export.render_submission(sub_id, _docx_pairs(row[0]))
+    return send_file(
+        io.BytesIO(body), as_attachment=True,
+        download_name=f"submission_{sub_id}.docx",
+        mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    )
+
+# ========= 批量导出 Word（zip，边生成边发） =========
+# python-docx 纯 Python、吃 CPU 且持有 GIL，放进进程池做；用 spawn 而不是 fork：
+# gthread worker 里有连接池和监听线程，fork 出来的子进程会带着它们的锁状态。
+# spawn 的子进程会以 __mp_main__ 的名义重新导入父进程的 __main__：gunicorn 下那是 gunicorn 的入口脚本，
+# 子进程实际只加载 docx_export；`python app.py` 下则会把 app.py 整个再导入一遍（`flask run` 是 flask 的入口），
+# 所以 app.py 导入时不能有副作用：连接池首次取连接才建连、后台线程首次用到才启动，app.run 在 main guard 里。
+# 同时在途的任务最多 DOCX_WORKERS * 2 个，行从服务端游标分批取，内存与导出条数无关。
+# 进度写到临时目录下的小 JSON（同机多个 gunicorn worker 都能读到），前端按 job id 轮询。
+DOCX_WORKERS = int(os.getenv("DOCX_WORKERS", str(min(4, os.cpu_count() or 1))))
+DOCX_EXPORT_MAX = int(os.getenv("DOCX_EXPORT_MAX", "10000"))   # 单次最多导出多少份
+_DOCX_POOL = {"pool": None}
+_DOCX_POOL_LOCK = threading.Lock()
+_EXPORT_JOB_DIR = os.path.join(tempfile.gettempdir(), "formly-export-jobs")
+_RE_JOB_ID = re.compile(r"^[a-f0-9]{8,32}$")
+
+
+def _docx_pool():
+    with _DOCX_POOL_LOCK:
+        if _DOCX_POOL["pool"] is None:
+            _DOCX_POOL["pool"] = ProcessPoolExecutor(
+                max_workers=DOCX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _DOCX_POOL["pool"]
+
+
+def _docx_pool_reset(pool):
+    with _DOCX_POOL_LOCK:
+        if _DOCX_POOL["pool"] is pool:
+            _DOCX_POOL["pool"] = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _job_prune(max_age=86400):
+    try:
+        for name in os.listdir(_EXPORT_JOB_DIR):
+            path = os.path.join(_EXPORT_JOB_DIR, name)
+            if time.time() - os.path.getmtime(path) > max_age:
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def _job_write(job_id: str, **state):
+    os.makedirs(_EXPORT_JOB_DIR, exist_ok=True)
+    path = os.path.join(_EXPORT_JOB_DIR, f"{job_id}.json")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({**state, "updated_at": time.time()}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _job_claim(job_id: str, site_name: str) -> bool:
+    """把 export_jobs 预先发出的 id 认领给这次导出：只能认领本站、还没开始的，且只能认领一次
+    （O_EXCL 建 .claim 标记，多个 gunicorn worker 之间也是原子的）。"""
+    job = _job_read(job_id) if _RE_JOB_ID.match(job_id or "") else None
+    if not job or job.get("site") != site_name or job.get("state") != "pending":
+        return False
+    try:
+        os.close(os.open(os.path.join(_EXPORT_JOB_DIR, f"{job_id}.claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+
+def _job_read(job_id: str):
+    try:
+        with open(os.path.join(_EXPORT_JOB_DIR, f"{job_id}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class _ZipSink:
+    """给 zipfile 用的只写缓冲：没有 seek，zipfile 会改用数据描述符，写完一项就能把字节发出去。"""
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, b):
+        self.buf += b
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        out = bytes(self.buf)
+        self.buf.clear()
+        return out
+
+
+def _word_zip_ids():
+    raw = []
+    body = request.get_json(silent=True) if request.method == "POST" else None
+    if isinstance(body, dict) and isinstance(body.get("ids"), list):
+        raw = body["ids"]
+    else:
+        for v in request.values.getlist("ids"):
+            raw += v.split(",")
+    try:
+        return sorted({int(x) for x in raw if str(x).strip()})
+    except ValueError:
+        raise ValueError("ids 必须是整数")
+
+
+@app.route("/site/<site_name>/admin/api/export_word_zip", methods=["GET", "POST"])
 @admin_required
-def export_word(site_name, sub_id):
+def export_word_zip(site_name):
+    """批量导出 Word：?ids=1,2,3（或 POST {"ids":[...]}），否则按列表页同样的筛选（q / status / f.* / created_*）。
+    响应是边生成边发的 zip；响应头 X-Export-Job 给出 job id，进度见 export_jobs/<job_id>。
+    直接跳转下载时读不到响应头，可先 POST export_jobs 领一个 id，再带 ?job=<id> 来导出。"""
     schema = _safe_schema(site_name)
+    try:
+        ids = _word_zip_ids()
+        where, params = _list_filters(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    if ids:
+        where.append("id = ANY(%s)"); params.append(ids)
+    q = (request.args.get("q") or "").strip()
+    if q:
+        search_sql, search_params, _ = _search_where(q)
+        where.append(search_sql); params += search_params
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
     conn = get_conn(); c = conn.cursor()
     c.execute(f'SET search_path TO "{schema}", public')
-    c.execute("SELECT data FROM submissions WHERE id=%s", (sub_id,))
-    row = c.fetchone(); conn.close()
-    if not row: return "❌ 记录不存在", 404
+    c.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM submissions {where_sql} LIMIT %s) t",
+              (*params, DOCX_EXPORT_MAX + 1))
+    total = int(c.fetchone()[0]); conn.close()
+    if total > DOCX_EXPORT_MAX:
+        return jsonify({"ok": False, "error": f"一次最多导出 {DOCX_EXPORT_MAX} 份，请先筛选"}), 400
+
+    # id 只由服务端生成：客户端自选的 id 可能撞上别人正在跑的任务、覆盖它的进度文件
+    job_id = (request.args.get("job") or "").strip().lower()
+    if not _job_claim(job_id, site_name):
+        job_id = uuid4().hex
+    _job_prune()
+    _job_write(job_id, site=site_name, state="running", total=total, done=0, failed=0)
+
+    def gen():
+        conn = get_dedicated_conn()
+        pool = _docx_pool()
+        sink = _ZipSink()
+        zf = zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED)   # docx 本身已压缩，不再 deflate
+        pending = {}
+        done, failed, state = 0, [], "error"
+        last = 0.0
+        try:
+            cur = conn.cursor()
+            cur.execute(f'SET search_path TO "{schema}", public')
+            rows = conn.cursor(name=f"wordzip_{uuid4().hex[:12]}")
+            rows.itersize = EXPORT_BATCH
+            rows.execute(f"SELECT id, data FROM submissions {where_sql} ORDER BY id", params)
+            it = iter(rows)
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < DOCX_WORKERS * 2:
+                    row = next(it, None)
+                    if row is None:
+                        exhausted = True
+                        break
+                    pending[pool.submit(docx_export.render_submission, row[0], _docx_pairs(row[1]))] = row[0]
+                if not pending:
+                    break
+                finished, _ = futures_wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    sid = pending.pop(fut)
+                    try:
+                        _, body = fut.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        failed.append(f"#{sid}: {e}")
+                        continue
+                    zf.writestr(f"submission_{sid}.docx", body)
+                    done += 1
+                now = time.monotonic()
+                if now - last >= 0.5:
+                    last = now
+                    _job_write(job_id, site=site_name, state="running", total=total,
+                               done=done, failed=len(failed))
+                chunk = sink.take()
+                if chunk:
+                    yield chunk
+            rows.close()
+            if failed:
+                zf.writestr("errors.txt", "\n".join(failed) + "\n")
+            zf.close()
+            state = "done"
+            yield sink.take()
+        except GeneratorExit:
+            state = "cancelled"   # 客户端断开
+            raise
+        except BrokenProcessPool:
+            _docx_pool_reset(pool)
+            raise
+        finally:
+            for fut in pending:
+                fut.cancel()
+            conn.rollback()
+            conn.close()
+            _job_write(job_id, site=site_name, state=state, total=total, done=done, failed=len(failed))
 
-    data = row[0] if isinstance(row[0], dict) else (json.loads(row[0]) if row[0] else {})
-    data = _normalize_obj(data)
+    resp = Response(gen(), mimetype="application/zip")
+    _set_download_name(resp, f"{site_name}_submissions_word.zip")
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Export-Job"] = job_id
+    return resp
 
-    doc = Document(); doc.add_heading(f"提交 #{sub_id}", level=1)
-    # 注意：此处遍历 schema["fields"] 可能导致 KeyError（若 schema 未带 fields）。保持原样不动。
-    for k, v in (data or {}).items():
-        safe_k = _maybe_fix_encoding(str(k))
-        safe_v = _maybe_fix_encoding("" if v is None else str(v))
-        p = doc.add_paragraph()
-        p.add_run(f"{safe_k}: ").bold = True
-        p.add_run(safe_v)
 
-    buffer = io.BytesIO(); doc.save(buffer); buffer.seek(0)
-    return send_file(
-        buffer, as_attachment=True,
-        download_name=f"submission_{sub_id}.docx",
-        mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    )
+@app.route("/site/<site_name>/admin/api/export_jobs", methods=["POST"])
+@admin_required
+def export_job_create(site_name):
+    """预先领一个导出任务 id（state=pending），给 export_word_zip?job=<id> 用，前端据此轮询进度。"""
+    _safe_schema(site_name)
+    job_id = uuid4().hex
+    _job_prune()
+    _job_write(job_id, site=site_name, state="pending", total=0, done=0, failed=0)
+    return jsonify({"ok": True, "job": job_id})
+
+
+@app.route("/site/<site_name>/admin/api/export_jobs/<job_id>")
+@admin_required
+def export_job_status(site_name, job_id):
+    job = _job_read(job_id) if _RE_JOB_ID.match(job_id or "") else None
+    if not job or job.get("site") != site_name:
+        return jsonify({"ok": False, "error": "任务不存在"}), 404
+    job.pop("site", None)
+    return jsonify({"ok": True, **job})
+
 
 @app.route("/site/<site_name>/admin/export_excel/<int:sub_id>")
 @admin_required
@@ -2149,6 +4530,7 @@ def export_excel(site_name, sub_id):
     rows = [(_maybe_fix_encoding(str(k)),
              _maybe_fix_encoding("" if v is None else str(v)))
             for k, v in data.items()]
+    import pandas as pd  # 重依赖：只在导出时加载
     df = pd.DataFrame(rows, columns=["字段", "内容"])
 
     try:
@@ -2179,82 +4561,351 @@ def try_fix(s):
     except Exception:
         return s
 
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "2000"))   # 服务端游标每批取多少行
+_EXPORT_FIXED = ["id", "status", "review_comment", "created_at"]
+
+
+def _export_columns(c, site_name: str) -> list:
+    """导出列：固定列 + schema 里的字段顺序 + 数据里出现过、schema 里没有的 key（库里一次 DISTINCT）。"""
+    plan = _form_plan(site_name) or {}
+    cols = list(_EXPORT_FIXED)
+    seen = set(cols)
+    for f in plan.get("clean_fields") or []:
+        k = f.get("key") or f.get("id")
+        if k and str(k) not in seen:
+            cols.append(str(k)); seen.add(str(k))
+    c.execute("SELECT DISTINCT jsonb_object_keys(data) FROM submissions WHERE data IS NOT NULL")
+    for k in sorted(r[0] for r in c.fetchall()):
+        kk = _maybe_fix_encoding(str(k))
+        if kk not in seen:
+            cols.append(kk); seen.add(kk)
+    return cols
+
+
+def _export_rows(schema_name: str, site_name: str):
+    """生成器：先产出列名，再逐行产出 list。用独立连接 + 命名（服务端）游标分批读，内存与总行数无关。"""
+    conn = get_dedicated_conn()
+    try:
+        c = conn.cursor()
+        c.execute(f'SET search_path TO "{schema_name}", public')
+        cols = _export_columns(c, site_name)
+        yield cols
+        dyn = cols[len(_EXPORT_FIXED):]
+        cur = conn.cursor(name=f"export_{uuid4().hex[:12]}")
+        cur.itersize = EXPORT_BATCH
+        cur.execute("SELECT id, data, status, review_comment, created_at FROM submissions ORDER BY id")
+        for rid, d, status, review, created in cur:
+            d = d if isinstance(d, dict) else (json.loads(d) if d else {})
+            vals = {}
+            for k, v in (d or {}).items():
+                vals[_maybe_fix_encoding(str(k))] = v
+            row = [rid, _maybe_fix_encoding(status or ""), _maybe_fix_encoding(review or ""),
+                   str(created) if created else ""]
+            for k in dyn:
+                v = vals.get(k)
+                row.append(_maybe_fix_encoding("" if v is None else str(_normalize_obj(v))))
+            yield row
+        cur.close()
+        conn.rollback()
+    finally:
+        conn.close()
+
+
 @app.route("/site/<site_name>/admin/api/export_all_excel")
 @admin_required
 def export_all_excel(site_name):
+    """全量导出。?format=csv 边查边发；默认 xlsx 用 openpyxl 只写模式（行直接落临时文件）。"""
     schema = _safe_schema(site_name)
-    conn = get_conn(); c = conn.cursor()
-    c.execute(f'SET search_path TO "{schema}", public')
-    c.execute("SELECT id, data, status, review_comment, created_at FROM submissions ORDER BY id")
-    rows = c.fetchall(); conn.close()
-
-    records, cols = [], {"id", "status", "review_comment", "created_at"}
-    for r in rows:
-        d = r[1] if isinstance(r[1], dict) else (json.loads(r[1]) if r[1] else {})
-        d = _normalize_obj(d)
-        rec = {
-            "id": r[0],
-            "status": _maybe_fix_encoding(r[2] or ""),
-            "review_comment": _maybe_fix_encoding(r[3] or ""),
-            "created_at": str(r[4]) if r[4] else ""
-        }
-        for k, v in (d or {}).items():
-            kk = _maybe_fix_encoding(str(k))
-            rec[kk] = _maybe_fix_encoding("" if v is None else str(v))
-            cols.add(kk)
-        records.append(rec)
-
-    # 统一列顺序，保证固定列在前
-    fixed = ["id", "status", "review_comment", "created_at"]
-    dynamic = [col for col in cols if col not in fixed]
-    df = pd.DataFrame(records, columns=fixed + list(dynamic))
-
-    buf = io.BytesIO()
-    with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False)
-    buf.seek(0)
+    fmt = (request.args.get("format") or "xlsx").lower()
+    rows = _export_rows(schema, site_name)
+
+    if fmt == "csv":
+        import csv
+
+        def gen():
+            buf = io.StringIO()
+            w = csv.writer(buf)
+            yield "\ufeff".encode("utf-8")   # BOM：Excel 直接打开不乱码
+            n = 0
+            for row in rows:
+                w.writerow(row)
+                n += 1
+                if n % 500 == 0:
+                    yield buf.getvalue().encode("utf-8")
+                    buf.seek(0); buf.truncate()
+            if buf.tell():
+                yield buf.getvalue().encode("utf-8")
+
+        resp = Response(gen(), mimetype="text/csv")
+        _set_download_name(resp, f"{site_name}_all_submissions.csv")
+        resp.headers["Cache-Control"] = "no-store"
+        return resp
+
+    import tempfile
+    from openpyxl import Workbook   # 只在导出时加载
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    try:
+        for row in rows:
+            ws.append(row)
+    finally:
+        rows.close()
+    tmp = tempfile.TemporaryFile()
+    wb.save(tmp)
+    tmp.seek(0)
     return send_file(
-        buf, as_attachment=True,
+        tmp, as_attachment=True,
         download_name=f"{site_name}_all_submissions.xlsx",
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
+# ========= 分析用导出：Parquet / Arrow IPC =========
+# 按表单 schema 把 submissions.data 展平成带类型的列，分批写成行组，pandas/duckdb/polars 直接读：
+#   number -> float64，date -> date32（解析不了的记为空），select/radio -> 字典编码，
+#   checkbox/file -> list<string>，其余 -> string；数据里有、schema 里没有的 key 按 string 追加
+# pyarrow 只在导出时加载；没装时接口返回 501，其它功能不受影响
+ANALYTICS_ROW_GROUP = int(os.getenv("ANALYTICS_ROW_GROUP", "100000"))   # 每个行组 / record batch 的行数
+_ANALYTICS_KINDS = {"number": "number", "date": "date", "select": "dict", "radio": "dict",
+                    "checkbox": "list", "file": "list"}
+
+
+def _analytics_columns(c, site_name: str) -> list:
+    """[(key, kind, label, options)]：schema 字段在前（顺序同表单），再补数据里出现过的其它 key。"""
+    schema = _form_schema(site_name) or {}
+    labels = {col["key"]: col["label"] for col in _extract_columns_from_schema(schema)}
+    cols, seen = [], set(_EXPORT_FIXED)
+    for f in (_form_plan(site_name) or {}).get("clean_fields") or []:
+        k = f.get("key") or f.get("id")
+        if not k or str(k) in seen:
+            continue
+        k = str(k)
+        kind = _ANALYTICS_KINDS.get(str(f.get("type") or "").lower(), "string")
+        opts = []
+        for o in f.get("options") or []:
+            v = o.get("value", o.get("label")) if isinstance(o, dict) else o
+            if v is not None and str(v) not in opts:
+                opts.append(str(v))
+        cols.append((k, kind, labels.get(k) or re.sub(r"<[^>]+>", "", str(f.get("label") or "")).strip() or k, opts))
+        seen.add(k)
+    c.execute("SELECT DISTINCT jsonb_object_keys(data) FROM submissions WHERE data IS NOT NULL")
+    for k in sorted(r[0] for r in c.fetchall()):
+        kk = _maybe_fix_encoding(str(k))
+        if kk not in seen:
+            cols.append((kk, "string", kk, [])); seen.add(kk)
+    return cols
+
+
+def _analytics_value(kind: str, v):
+    if v is None or v == "" or v == []:
+        return None
+    if kind == "number":
+        if isinstance(v, bool):
+            return None
+        try:
+            return float(str(v).strip())
+        except ValueError:
+            return None
+    if kind == "date":
+        try:
+            return datetime.strptime(str(v).strip()[:10], "%Y-%m-%d").date()
+        except ValueError:
+            return None
+    if kind == "list":
+        return [_maybe_fix_encoding(str(x)) for x in (v if isinstance(v, (list, tuple)) else [v])]
+    if isinstance(v, (dict, list)):
+        v = json.dumps(_normalize_obj(v), ensure_ascii=False)
+    return _maybe_fix_encoding(str(v))
+
+
+def _write_analytics(schema_name: str, site_name: str, fmt: str, sink) -> int:
+    """把一个站点的全部提交写进 sink（路径或可写文件对象），返回行数。fmt: parquet | arrow。"""
+    import pyarrow as pa
+
+    conn = get_dedicated_conn()
+    writer = None
+    try:
+        c = conn.cursor()
+        c.execute(f'SET search_path TO "{schema_name}", public')
+        cols = _analytics_columns(c, site_name)
+        str_dict = pa.dictionary(pa.int32(), pa.string())
+        types = {"number": pa.float64(), "date": pa.date32(), "dict": str_dict,
+                 "list": pa.list_(pa.string()), "string": pa.string()}
+        fields = [pa.field("id", pa.int64(), nullable=False), pa.field("status", str_dict),
+                  pa.field("review_comment", pa.string()), pa.field("created_at", pa.timestamp("us"))]
+        for k, kind, label, _ in cols:
+            fields.append(pa.field(k, types[kind], metadata={"label": label, "type": kind}))
+        schema = pa.schema(fields, metadata={"site": site_name})
+
+        # 字典列的词表跨批次只追加不重排：Parquet 每个行组各自编码，Arrow 文件靠 dictionary delta 续写
+        vocab = {"status": ["待审核", "已通过", "未通过"]}
+        for k, kind, _, opts in cols:
+            if kind == "dict":
+                vocab[k] = list(opts)
+        index = {k: {v: i for i, v in enumerate(vs)} for k, vs in vocab.items()}
+
+        def encode(name, values):
+            idx, pos = [], index[name]
+            for v in values:
+                if v is None:
+                    idx.append(None)
+                    continue
+                i = pos.get(v)
+                if i is None:
+                    i = pos[v] = len(vocab[name])
+                    vocab[name].append(v)
+                idx.append(i)
+            return pa.DictionaryArray.from_arrays(pa.array(idx, pa.int32()), pa.array(vocab[name], pa.string()))
+
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(sink, schema, compression="zstd")
+        else:
+            import pyarrow.ipc as ipc
+            writer = ipc.new_file(sink, schema, options=ipc.IpcWriteOptions(
+                compression="zstd", emit_dictionary_deltas=True))
+
+        def flush(buf):
+            arrays = [pa.array(buf[0], pa.int64()), encode("status", buf[1]),
+                      pa.array(buf[2], pa.string()), pa.array(buf[3], pa.timestamp("us"))]
+            for j, (k, kind, _, _) in enumerate(cols):
+                vals = buf[4 + j]
+                arrays.append(encode(k, vals) if kind == "dict" else pa.array(vals, types[kind]))
+            batch = pa.record_batch(arrays, schema=schema)
+            if fmt == "parquet":
+                writer.write_batch(batch, row_group_size=len(buf[0]))
+            else:
+                writer.write_batch(batch)
+
+        cur = conn.cursor(name=f"analytics_{uuid4().hex[:12]}")
+        cur.itersize = EXPORT_BATCH
+        cur.execute("SELECT id, data, status, review_comment, created_at FROM submissions ORDER BY id")
+        n = 0
+        buf = [[] for _ in range(4 + len(cols))]
+        for rid, d, status, review, created in cur:
+            d = d if isinstance(d, dict) else (json.loads(d) if d else {})
+            vals = {_maybe_fix_encoding(str(k)): v for k, v in (d or {}).items()}
+            buf[0].append(rid)
+            buf[1].append(status or None)
+            buf[2].append(_maybe_fix_encoding(review) if review else None)
+            buf[3].append(created)
+            for j, (k, kind, _, _) in enumerate(cols):
+                buf[4 + j].append(_analytics_value("string" if kind == "dict" else kind, vals.get(k)))
+            n += 1
+            if len(buf[0]) >= ANALYTICS_ROW_GROUP:
+                flush(buf)
+                buf = [[] for _ in range(4 + len(cols))]
+        if buf[0] or not n:
+            flush(buf)
+        cur.close()
+        conn.rollback()
+        return n
+    finally:
+        if writer is not None:
+            writer.close()
+        conn.close()
+
+
+@app.route("/site/<site_name>/admin/api/export_analytics")
+@admin_required
+def export_analytics(site_name):
+    """?format=parquet（默认）| arrow：带类型的列式导出，给 pandas / duckdb 直接读。"""
+    fmt = (request.args.get("format") or "parquet").lower()
+    if fmt not in ("parquet", "arrow"):
+        return jsonify({"ok": False, "error": "format 只支持 parquet / arrow"}), 400
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return jsonify({"ok": False, "error": "服务器未安装 pyarrow，暂不支持该导出"}), 501
+    import tempfile
+    tmp = tempfile.TemporaryFile()
+    _write_analytics(_safe_schema(site_name), site_name, fmt, tmp)
+    tmp.seek(0)
+    ext, mime = (("parquet", "application/vnd.apache.parquet") if fmt == "parquet"
+                 else ("arrow", "application/vnd.apache.arrow.file"))
+    return send_file(tmp, as_attachment=True, download_name=f"{site_name}_submissions.{ext}", mimetype=mime)
+
+
+@app.cli.command("export-analytics")
+@click.argument("site")
+@click.option("--format", "fmt", type=click.Choice(["parquet", "arrow"]), default="parquet")
+@click.option("--out", "out", default=None, help="输出路径；默认 <site>_submissions.<format>")
+def export_analytics_command(site, fmt, out):
+    """把一个站点的提交导出成 Parquet / Arrow IPC 文件。"""
+    out = out or f"{site}_submissions.{fmt}"
+    t0 = time.perf_counter()
+    n = _write_analytics(_safe_schema(site), site, fmt, out)
+    click.echo(f"{n} rows -> {out} ({os.path.getsize(out)} bytes, {time.perf_counter() - t0:.1f}s)")
+
+
+GALLERY_PAGE_DEFAULT = 60
+GALLERY_PAGE_MAX = 200
+
+
 @app.route("/site/<site_name>/admin/api/gallery")
 @admin_required
 def api_gallery(site_name):
+    """提交里的附件（默认只看图片，?kind=all 全部），按 attachments.id 倒序键集分页：?limit=&before_id=。"""
     schema = _safe_schema(site_name)
+    limit = _int_arg("limit", GALLERY_PAGE_DEFAULT, 1, GALLERY_PAGE_MAX)
+    before_id = _int_arg("before_id")
+    images = (request.args.get("kind") or "image") != "all"
+    where = ["submission_id IS NOT NULL"]
+    if images:
+        where.append("mime LIKE 'image/%%'")   # 与部分索引 attachments_images_idx 的条件一致
+    filter_sql = " AND ".join(where)
+    cursor_sql, params = "", []
+    if before_id is not None:
+        cursor_sql, params = " AND id < %s", [before_id]
+
     conn = get_conn(); c = conn.cursor()
     c.execute(f'SET search_path TO "{schema}", public')
-    c.execute("SELECT data FROM submissions ORDER BY id DESC LIMIT 1000")
-    rows = c.fetchall(); conn.close()
-
-    image_keys = ("image","img","photo","picture","图片","照片","附件","attachment")
-    exts = (".png",".jpg",".jpeg",".gif",".webp",".bmp",".svg")
-    def _to_url(u: str):
-        if not u: return None
-        if u.startswith("http"): return u
-        if u.startswith("/"):    return u      # 已是站内绝对路径：/site/<site>/uploads/xxx
-        # 其他情况（历史数据可能是纯文件名），走全局 /uploads/<filename>
-        return url_for("uploaded_file", filename=u, _external=True)
+    c.execute(f"""SELECT id, submission_id, field, url, filename, mime, size, width, height, created_at
+                    FROM attachments WHERE {filter_sql}{cursor_sql} ORDER BY id DESC LIMIT %s""",
+              (*params, limit + 1))
+    rows = c.fetchall()
+    total = None
+    if before_id is None:
+        c.execute(f"SELECT COUNT(*) FROM attachments WHERE {filter_sql}", ())
+        total = int(c.fetchone()[0])
+    conn.close()
 
-    items = []
-    for (d,) in rows:
-        data = d if isinstance(d, dict) else (json.loads(d) if d else {})
-        for k, v in (data or {}).items():
-            key_l = str(k).lower()
-            cand_urls = []
-            if isinstance(v, str):
-                cand_urls = [v]
-            elif isinstance(v, list):
-                cand_urls = [x for x in v if isinstance(x, str)]
-            else:
-                continue
-            for u in cand_urls:
-                if (any(x in key_l for x in image_keys)) or u.lower().endswith(exts):
-                    url = _to_url(u)
-                    if url:
-                        items.append({"field": k, "url": url})
-    return jsonify({"ok": True, "items": items})
+    more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{"id": r[0], "submission_id": r[1], "field": r[2], "url": r[3], "filename": r[4],
+              "mime": r[5], "size": r[6], "width": r[7], "height": r[8],
+              "created_at": r[9].isoformat() if r[9] else None} for r in rows]
+    # 格子里用缩略图（1x / 2x 两档），点开/下载仍是原图
+    prefix = f"/site/{site_name}/uploads/"
+    for it in items:
+        if it["mime"] in _THUMB_SOURCES and it["url"].startswith(prefix):
+            it["thumb"] = f'{it["url"]}?w={_thumb_width(GALLERY_THUMB_WIDTH)}'
+            it["thumb_2x"] = f'{it["url"]}?w={_thumb_width(GALLERY_THUMB_WIDTH * 2)}'
+    return jsonify({"ok": True, "items": items, "total": total,
+                    "next_cursor": {"before_id": rows[-1][0]} if more else None})
+
+
+@app.route("/site/<site_name>/admin/api/storage")
+@admin_required
+def api_storage(site_name):
+    """存储占用：提交里引用的附件（按字段 / 类型汇总），以及去重后实际落盘的字节数。"""
+    schema = _safe_schema(site_name)
+    conn = get_conn(); c = conn.cursor()
+    c.execute(f'SET search_path TO "{schema}", public')
+    c.execute("""SELECT field, COUNT(*), COALESCE(SUM(size), 0),
+                        COUNT(*) FILTER (WHERE mime LIKE 'image/%')
+                   FROM attachments WHERE submission_id IS NOT NULL
+                  GROUP BY field ORDER BY 3 DESC""")
+    by_field = [{"field": f, "files": int(n), "bytes": int(b), "images": int(im)}
+                for f, n, b, im in c.fetchall()]
+    c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM upload_blobs")
+    blobs, disk = c.fetchone()
+    conn.close()
+    return jsonify({"ok": True,
+                    "files": sum(x["files"] for x in by_field),
+                    "bytes": sum(x["bytes"] for x in by_field),
+                    "images": sum(x["images"] for x in by_field),
+                    "by_field": by_field,
+                    "stored": {"blobs": int(blobs), "bytes": int(disk)}})
 
 def drop_bg_notify_from_all():
     conn = get_conn(); c = conn.cursor()
@@ -2262,9 +4913,12 @@ def drop_bg_notify_from_all():
       UPDATE form_defs
          SET schema_json = jsonb_strip_nulls(
              (schema_json - 'bg' - 'bg_position' - 'notifications')
-           )
+           ),
+             schema_version = schema_version + 1
     """)
+    _notify_form_changed(c, "*")
     conn.commit(); conn.close()
+    _form_changed_local("*")
 
 def _norm(s: str) -> str:
     """把字符串做宽松匹配：去空白/标点并小写。"""
@@ -2291,6 +4945,380 @@ def _extract_label(f: dict) -> str:
             return cur.strip()
     return ''
 
+def _chart_field_resolver(schema_json: dict):
+    """返回 (resolve_field, field_label, fields)：支持用 key 或题目标题找字段。"""
+    fields = (schema_json or {}).get("fields", []) or []
+    key_set = set()
+    label_to_key = {}
+    for f in fields:
+        k = f.get("key") or f.get("id") or f.get("name")
+        if not k:
+            continue
+        key_set.add(str(k))
+        lab = _extract_label(f)
+        if lab:
+            label_to_key[_norm(lab)] = str(k)
+
+    def resolve_field(user_input: str) -> str | None:
+        """支持：直接传 key；或传中文标题/英文标题"""
+        if not user_input:
+            return None
+        if user_input in key_set:
+            return user_input
+        return label_to_key.get(_norm(user_input))
+
+    def field_label(fld):
+        return _extract_label(next((f for f in fields if (f.get("key") or f.get("id") or f.get("name")) == fld), {})) or fld
+
+    return resolve_field, field_label, fields
+
+# ========= 图表汇总表（rollup） =========
+# 每个租户 schema 有 rollup_field / rollup_daily / rollup_status 三张计数表，
+# 由 submissions 上的行级触发器在 INSERT/UPDATE/DELETE 时增量维护（提交、审核、删除都覆盖，
+# 不依赖应用代码路径）。每个计数按 shard 拆成多行（shard 数固定在迁移 0007 里），读时 SUM。
+# 字段计数只维护 rollup_fields 里登记且 ready 的字段：选择类字段 + 图表配置里的字段。
+# 保存表单/图表配置时只登记（ready=false），整表补算由 flask rollup-backfill 做（发布时跑）。
+# flask rollup-rebuild 全量重算；flask rollup-check 对比实时聚合，报告不一致。
+_ROLLUP_FIELD_AGG = """
+    SELECT f.field, e.v, COUNT(*)
+      FROM "{s}".submissions sub
+      JOIN "{s}".rollup_fields f ON sub.data ? f.field
+     CROSS JOIN LATERAL (
+            SELECT jsonb_array_elements_text(sub.data -> f.field) AS v
+             WHERE jsonb_typeof(sub.data -> f.field) = 'array'
+            UNION ALL
+            SELECT sub.data ->> f.field
+             WHERE jsonb_typeof(sub.data -> f.field) NOT IN ('array', 'null')
+     ) e
+     WHERE f.field = ANY(%s)
+     GROUP BY 1, 2
+"""
+_ROLLUP_STATUS_AGG = """
+    SELECT COALESCE(NULLIF(btrim(status), ''), '待审核'), COUNT(*) FROM "{s}".submissions GROUP BY 1
+"""
+_ROLLUP_DAILY_AGG = """
+    SELECT created_at::DATE, COUNT(*) FROM "{s}".submissions WHERE created_at IS NOT NULL GROUP BY 1
+"""
+
+
+def _rollup_field_keys(schema_json: dict) -> list:
+    """需要维护字段计数的字段：选择类字段 + charts_config 里能解析到的字段。"""
+    resolve_field, _, fields = _chart_field_resolver(schema_json)
+    keys = []
+    for f in fields:
+        if (f.get("type") or "").lower() in ("select", "radio", "checkbox"):
+            k = f.get("key") or f.get("id") or f.get("name")
+            if k:
+                keys.append(str(k))
+    for ch in ((schema_json or {}).get("charts_config") or {}).get("charts") or []:
+        fld = resolve_field((ch.get("field") or ch.get("label") or "").strip())
+        if fld:
+            keys.append(fld)
+    return list(dict.fromkeys(keys))
+
+
+def _rollup_sync_fields(c, schema_name: str, keys) -> list:
+    """登记/注销字段计数（请求里调用，不锁 submissions）：新字段登记为 ready=false，
+    等 rollup-backfill 补算；在那之前图表对它实时聚合。返回新增的字段。"""
+    s = schema_name
+    # 先拿租户级事务锁再读现状：两个并发保存不会都算出同一个“新增”字段
+    c.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{s}:rollup_fields",))
+    c.execute(f'SELECT field FROM "{s}".rollup_fields')
+    have = {r[0] for r in c.fetchall()}
+    want = set(keys or [])
+    added, removed = sorted(want - have), sorted(have - want)
+    if removed:
+        c.execute(f'DELETE FROM "{s}".rollup_fields WHERE field = ANY(%s)', (removed,))
+        c.execute(f'DELETE FROM "{s}".rollup_field WHERE field = ANY(%s)', (removed,))
+    if added:
+        c.execute(f'''INSERT INTO "{s}".rollup_fields (field, ready) SELECT unnest(%s::TEXT[]), FALSE
+                       ON CONFLICT (field) DO NOTHING''', (added,))
+    return added
+
+
+def _rollup_backfill(c, schema_name: str) -> list:
+    """补算 ready=false 的字段并置为 ready。锁表期间挡住写入（读不受影响），所以只在 CLI / 迁移里调用。"""
+    s = schema_name
+    c.execute(f'SELECT array_agg(field) FROM "{s}".rollup_fields WHERE NOT ready')
+    if not c.fetchone()[0]:
+        return []
+    c.execute(f'LOCK TABLE "{s}".submissions IN SHARE ROW EXCLUSIVE MODE')
+    c.execute(f'SELECT array_agg(field) FROM "{s}".rollup_fields WHERE NOT ready')
+    pending = c.fetchone()[0] or []
+    c.execute(f'DELETE FROM "{s}".rollup_field WHERE field = ANY(%s)', (pending,))
+    c.execute(f'INSERT INTO "{s}".rollup_field (field, value, n) ' + _ROLLUP_FIELD_AGG.format(s=s), (pending,))
+    c.execute(f'UPDATE "{s}".rollup_fields SET ready = TRUE WHERE field = ANY(%s)', (pending,))
+    return pending
+
+
+def _rollup_rebuild(c, schema_name: str, keys=None):
+    """全量重算三张计数表（keys 不为 None 时顺便重设登记字段）。"""
+    s = schema_name
+    c.execute(f'LOCK TABLE "{s}".submissions IN SHARE ROW EXCLUSIVE MODE')
+    if keys is not None:
+        c.execute(f'DELETE FROM "{s}".rollup_fields')
+        c.execute(f'INSERT INTO "{s}".rollup_fields (field) SELECT unnest(%s::TEXT[])', (list(keys),))
+    c.execute(f'TRUNCATE "{s}".rollup_field, "{s}".rollup_daily, "{s}".rollup_status')
+    c.execute(f'INSERT INTO "{s}".rollup_status (status, n) ' + _ROLLUP_STATUS_AGG.format(s=s))
+    c.execute(f'INSERT INTO "{s}".rollup_daily (day, n) ' + _ROLLUP_DAILY_AGG.format(s=s))
+    c.execute(f'SELECT array_agg(field) FROM "{s}".rollup_fields')
+    fields = c.fetchone()[0] or []
+    c.execute(f'INSERT INTO "{s}".rollup_field (field, value, n) ' + _ROLLUP_FIELD_AGG.format(s=s), (fields,))
+    if _rollup_sharded(c, s):
+        c.execute(f'UPDATE "{s}".rollup_fields SET ready = TRUE WHERE NOT ready')
+
+
+def _rollup_sharded(c, schema_name: str) -> bool:
+    """迁移 0007 之前的租户（rollup-rebuild 可能在 migrate 之前被调用）没有 shard / ready 列。"""
+    c.execute("""SELECT 1 FROM information_schema.columns
+                  WHERE table_schema = %s AND table_name = 'rollup_fields' AND column_name = 'ready'""",
+              (schema_name,))
+    return c.fetchone() is not None
+
+
+def _rollup_check(c, schema_name: str) -> list:
+    """对比计数表（各 shard 求和）与实时聚合，返回不一致项 [(类别, 键, 实时, 计数表)]。只看已补算的字段。"""
+    s = schema_name
+    c.execute(f'SELECT array_agg(field) FROM "{s}".rollup_fields WHERE ready')
+    fields = c.fetchone()[0] or []
+    c.execute(f"""
+        SELECT 'status', COALESCE(l.k, r.status), COALESCE(l.n, 0), COALESCE(r.n, 0)
+          FROM ({_ROLLUP_STATUS_AGG.format(s=s)}) l(k, n)
+          FULL JOIN (SELECT status, SUM(n)::BIGINT AS n FROM "{s}".rollup_status GROUP BY 1) r ON r.status = l.k
+         WHERE COALESCE(l.n, 0) <> COALESCE(r.n, 0)
+        UNION ALL
+        SELECT 'daily', COALESCE(l.k, r.day)::TEXT, COALESCE(l.n, 0), COALESCE(r.n, 0)
+          FROM ({_ROLLUP_DAILY_AGG.format(s=s)}) l(k, n)
+          FULL JOIN (SELECT day, SUM(n)::BIGINT AS n FROM "{s}".rollup_daily GROUP BY 1) r ON r.day = l.k
+         WHERE COALESCE(l.n, 0) <> COALESCE(r.n, 0)
+        UNION ALL
+        SELECT 'field', COALESCE(l.f, r.field) || '=' || COALESCE(l.v, r.value), COALESCE(l.n, 0), COALESCE(r.n, 0)
+          FROM ({_ROLLUP_FIELD_AGG.format(s=s)}) l(f, v, n)
+          FULL JOIN (SELECT field, value, SUM(n)::BIGINT AS n FROM "{s}".rollup_field
+                      WHERE field = ANY(%s) GROUP BY 1, 2) r ON r.field = l.f AND r.value = l.v
+         WHERE COALESCE(l.n, 0) <> COALESCE(r.n, 0)
+    """, (fields, fields))
+    return c.fetchall()
+
+
+def _cli_sites(c, sites):
+    if sites:
+        return list(sites)
+    c.execute("SELECT site_name FROM form_defs ORDER BY id")
+    return [r[0] for r in c.fetchall()]
+
+
+@app.cli.command("rollup-rebuild")
+@click.option("--site", "sites", multiple=True, help="只重算指定站点（可重复）；默认全部站点")
+def rollup_rebuild_command(sites):
+    """全量重算图表计数表（回填 / 修复不一致）。"""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        for site in _cli_sites(c, sites):
+            schema_name = _safe_schema(site)
+            try:
+                _rollup_rebuild(c, schema_name, _rollup_field_keys(_form_schema(site) or {}))
+                conn.commit()
+                click.echo(f"[{schema_name}] rebuilt")
+            except Exception as e:
+                conn.rollback()
+                click.echo(f"[{schema_name}] failed: {e}")
+    finally:
+        conn.close()
+
+
+@app.cli.command("lookup-rekey")
+@click.option("--site", "sites", multiple=True, help="只处理指定站点（可重复）；默认全部站点")
+def lookup_rekey_command(sites):
+    """按表单当前的"姓名"字段重算已有提交的 lookup_key（保存表单时换了字段会自动排队做，这里手动兜底）。"""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        for site in _cli_sites(c, sites):
+            schema_name = _safe_schema(site)
+            if not _tenant_is_current(c, schema_name):
+                continue
+            n = _lookup_rekey(c, schema_name, _lookup_field(_tenant_form_schema(c, schema_name)))
+            conn.commit()
+            click.echo(f"[{schema_name}] {n} row(s) rekeyed")
+    finally:
+        conn.close()
+
+
+@app.cli.command("rollup-backfill")
+@click.option("--site", "sites", multiple=True, help="只处理指定站点（可重复）；默认全部站点")
+def rollup_backfill_command(sites):
+    """补算保存表单/图表配置时新登记的字段计数（flask migrate 结束时也会跑一遍）。"""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        for site in _cli_sites(c, sites):
+            schema_name = _safe_schema(site)
+            if not _tenant_is_current(c, schema_name):
+                continue
+            try:
+                done = _rollup_backfill(c, schema_name)
+                conn.commit()
+                if done:
+                    click.echo(f"[{schema_name}] backfilled {', '.join(done)}")
+            except Exception as e:
+                conn.rollback()
+                click.echo(f"[{schema_name}] failed: {e}")
+    finally:
+        conn.close()
+
+
+@app.cli.command("rollup-check")
+@click.option("--site", "sites", multiple=True, help="只检查指定站点（可重复）；默认全部站点")
+def rollup_check_command(sites):
+    """对比图表计数表与实时聚合；有不一致时退出码为 1。"""
+    conn = get_conn()
+    bad = 0
+    try:
+        c = conn.cursor()
+        for site in _cli_sites(c, sites):
+            schema_name = _safe_schema(site)
+            diffs = _rollup_check(c, schema_name)
+            conn.rollback()
+            bad += len(diffs)
+            click.echo(f"[{schema_name}] {'ok' if not diffs else f'{len(diffs)} mismatch(es)'}")
+            for kind, key, live, rolled in diffs[:50]:
+                click.echo(f"    {kind} {key}: live={live} rollup={rolled}")
+    finally:
+        conn.close()
+    if bad:
+        raise SystemExit(1)
+
+
+@app.cli.command("uploads-dedupe")
+@click.option("--site", "sites", multiple=True, help="只处理指定站点（可重复）；默认全部站点")
+def uploads_dedupe_command(sites):
+    """把 uploads/<site>/ 下的旧文件收进内容寻址存储（URL 不变），相同内容只留一份。"""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        for site in _cli_sites(c, sites):
+            schema_name = _safe_schema(site)
+            folder = os.path.join(app.config["UPLOAD_FOLDER"], site)
+            if not os.path.isdir(folder):
+                continue
+            if not _tenant_is_current(c, schema_name):
+                click.echo(f"[{schema_name}] skipped: run `flask migrate` first")
+                continue
+            c.execute(f'SELECT name FROM "{schema_name}".upload_names')
+            known = {r[0] for r in c.fetchall()}
+            moved = dups = saved = 0
+            batch = []
+
+            def flush():
+                # 先登记再搬：搬走之前，URL 解析到的 blob 还不存在，会回落到旧文件
+                _register_uploads(c, schema_name, [(n, sha, size, n, *_blob_meta(path, n))
+                                                   for n, path, sha, size in batch])
+                conn.commit()
+                for _, path, sha, _ in batch:
+                    _blob_commit(site, path, sha)
+                batch.clear()
+
+            for name in sorted(os.listdir(folder)):
+                path = os.path.join(folder, name)
+                if name.startswith(".") or name in known or not os.path.isfile(path):
+                    continue
+                sha, size = _sha256_file(path), os.path.getsize(path)
+                if os.path.exists(_blob_path(site, sha)) or any(b[2] == sha for b in batch):
+                    dups += 1; saved += size
+                batch.append((name, path, sha, size))
+                moved += 1
+                if len(batch) >= 200:
+                    flush()
+            if batch:
+                flush()
+            click.echo(f"[{schema_name}] {moved} file(s) indexed, {dups} duplicate(s), {saved} bytes freed")
+    finally:
+        conn.close()
+
+
+@app.cli.command("uploads-meta")
+@click.option("--site", "sites", multiple=True, help="只处理指定站点（可重复）；默认全部站点")
+def uploads_meta_command(sites):
+    """补 upload_blobs 的 mime / 宽高（0009 之前登记的 blob 没有），再同步到 attachments。"""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        for site in _cli_sites(c, sites):
+            s = _safe_schema(site)
+            if not _tenant_is_current(c, s):
+                click.echo(f"[{s}] skipped: run `flask migrate` first")
+                continue
+            c.execute(f"""SELECT b.sha256, MIN(n.filename) FROM "{s}".upload_blobs b
+                            LEFT JOIN "{s}".upload_names n ON n.sha256 = b.sha256
+                           WHERE b.mime IS NULL GROUP BY b.sha256""")
+            rows = [(sha, *_blob_meta(_blob_path(site, sha), fn)) for sha, fn in c.fetchall()]
+            if rows:
+                execute_values(c, f"""UPDATE "{s}".upload_blobs b SET mime = v.mime, width = v.w, height = v.h
+                                        FROM (VALUES %s) AS v(sha, mime, w, h) WHERE b.sha256 = v.sha""",
+                               rows, template="(%s, %s, %s::INT, %s::INT)")
+            # attachments 回填时 blob 还没登记（uploads-dedupe 晚跑）或没有宽高的，一并补上
+            c.execute(f"""UPDATE "{s}".attachments a
+                             SET sha256 = b.sha256, size = b.size, width = b.width, height = b.height,
+                                 mime = COALESCE(b.mime, a.mime), filename = COALESCE(a.filename, n.filename)
+                            FROM "{s}".upload_names n JOIN "{s}".upload_blobs b ON b.sha256 = n.sha256
+                           WHERE n.name = a.name AND a.url LIKE '/site/%%'
+                             AND (a.sha256 IS NULL OR (a.width IS NULL AND b.width IS NOT NULL))""")
+            synced = c.rowcount
+            conn.commit()
+            click.echo(f"[{s}] {len(rows)} blob(s) probed, {synced} attachment(s) updated")
+    finally:
+        conn.close()
+
+
+@app.cli.command("uploads-gc")
+@click.option("--site", "sites", multiple=True, help="只处理指定站点（可重复）；默认全部站点")
+@click.option("--grace-hours", default=24, show_default=True, help="比这更新的文件名 / blob 不回收")
+def uploads_gc_command(sites, grace_hours):
+    """回收没人引用的上传：提交、草稿、表单配置里都找不到的文件名；refs 归零的 blob；没登记的 blob 文件。"""
+    conn = get_conn()
+    try:
+        c = conn.cursor()
+        for site in _cli_sites(c, sites):
+            s = _safe_schema(site)
+            if not _tenant_is_current(c, s):
+                continue
+            c.execute(f"""
+                WITH used AS (
+                    SELECT DISTINCT (regexp_matches(t, '/uploads/([^"\\\\?#/]+)', 'g'))[1] AS name
+                      FROM (SELECT data::text AS t FROM "{s}".submissions
+                            UNION ALL SELECT COALESCE(data::text, '') || COALESCE(files::text, '') FROM "{s}".drafts
+                            UNION ALL SELECT schema_json::text FROM public.form_defs WHERE site_name = %s) x)
+                DELETE FROM "{s}".upload_names n
+                 WHERE n.created_at < NOW() - make_interval(hours => %s)
+                   AND NOT EXISTS (SELECT 1 FROM used u WHERE u.name = n.name)
+            """, (site, grace_hours))
+            names = c.rowcount
+            c.execute(f"""DELETE FROM "{s}".upload_blobs
+                           WHERE refs <= 0 AND created_at < NOW() - make_interval(hours => %s)""", (grace_hours,))
+            blobs = c.rowcount
+            c.execute(f'SELECT sha256 FROM "{s}".upload_blobs')
+            live = {r[0] for r in c.fetchall()}
+            conn.commit()
+            # 磁盘上不在 upload_blobs 里的（刚删掉的、事务失败留下的、tmp 残留），过了宽限期就删；
+            # 缩略图 <sha256>.w320.webp 跟着它的 blob 走
+            cutoff = time.time() - grace_hours * 3600
+            files = freed = 0
+            for root, _, fnames in os.walk(_cas_root(site)):
+                for name in fnames:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                        if name.split(".", 1)[0] not in live and st.st_mtime < cutoff:
+                            os.remove(path)
+                            files += 1; freed += st.st_size
+                    except OSError:
+                        pass
+            click.echo(f"[{s}] {names} name(s), {blobs} blob row(s), {files} file(s) / {freed} bytes removed")
+    finally:
+        conn.close()
+
 # === 变更点 ④：图表配置读写 + 按配置返回图表数据 ===
 
 @app.route("/site/<site_name>/admin/api/charts_config", methods=["GET", "POST"])
@@ -2300,17 +5328,15 @@ def api_charts_config(site_name):
     GET:  返回保存的图表配置 {"charts":[{"field":"字段key","type":"pie|line|flow","label":"可选显示名"}]}
     POST: 保存图表配置，body 形如 {"charts":[...]}；会写回 form_defs.schema_json.charts_config
     """
+    if request.method == "GET":
+        schema = _form_schema(site_name)
+        if schema is None:
+            return jsonify({"ok": False, "error": "不存在的表单"}), 404
+        cfg = schema.get("charts_config") or {"charts": []}
+        return jsonify({"ok": True, "config": cfg})
+
     conn = get_conn(); c = conn.cursor()
     try:
-        if request.method == "GET":
-            c.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
-            row = c.fetchone()
-            if not row:
-                return jsonify({"ok": False, "error": "不存在的表单"}), 404
-            schema = row[0] if isinstance(row[0], dict) else (json.loads(row[0]) if row[0] else {})
-            cfg = schema.get("charts_config") or {"charts": []}
-            return jsonify({"ok": True, "config": cfg})
-
         # POST 保存
         payload = request.get_json(silent=True) or {}
         charts = payload.get("charts") or []
@@ -2333,9 +5359,21 @@ def api_charts_config(site_name):
             return jsonify({"ok": False, "error": "不存在的表单"}), 404
         schema = row[0] if isinstance(row[0], dict) else (json.loads(row[0]) if row[0] else {})
         schema["charts_config"] = {"charts": norm}
-        c.execute("UPDATE form_defs SET schema_json=%s WHERE site_name=%s", (Json(schema), site_name))
+        c.execute("""
+            UPDATE form_defs SET schema_json=%s, schema_version=schema_version+1
+             WHERE site_name=%s
+        """, (Json(schema), site_name))
+        _notify_form_changed(c, site_name)
+        # 同 create_form：租户已是最新版本才在请求里登记图表字段，否则提交后交给后台开通线程补
+        schema_name = _safe_schema(site_name)
+        tenant_ready = _tenant_is_current(c, schema_name)
+        if tenant_ready:
+            _rollup_sync_fields(c, schema_name, _rollup_field_keys(schema))
         conn.commit()
-        return jsonify({"ok": True})
+        _form_changed_local(site_name)
+        if not tenant_ready:
+            _queue_tenant(schema_name)
+        return jsonify({"ok": True, "tenant_ready": tenant_ready})
     except Exception as e:
         conn.rollback()
         return jsonify({"ok": False, "error": str(e)}), 500
@@ -2345,152 +5383,149 @@ def api_charts_config(site_name):
 @app.route("/site/<site_name>/admin/api/charts", methods=["GET"])
 @admin_required
 def api_charts(site_name):
-    from collections import Counter, defaultdict
-    from datetime import datetime, timedelta
+    # 结果缓存：key 含表单版本（charts_config 变了就换 key），版本为提交数据版本；
+    # 多个标签页同时轮询时只算一次
+    fd = _get_form_def(site_name)
+    q_field_raw = (request.args.get("field") or "").strip()
+    q_type = (request.args.get("type") or "").strip().lower()
+    key = (site_name, fd["version"] if fd else 0, q_field_raw, q_type)
+    _ensure_listener()
+    ttl = CHARTS_CACHE_TTL if _LISTENER["ok"] else CHARTS_CACHE_TTL_DEGRADED
+    body, status = _CHARTS_CACHE.get_or_compute(
+        key, _submissions_version(site_name), ttl,
+        lambda: _compute_charts(site_name, q_field_raw, q_type),
+        cacheable=lambda v: v[1] == 200,
+    )
+    return jsonify(body), status
 
-    schema_name = _safe_schema(site_name)
 
-    # 最近提交
-    conn = get_conn(); c = conn.cursor()
-    try:
-        c.execute(f'SET search_path TO "{schema_name}", public')
-        c.execute("""
-            SELECT data, status, created_at
-            FROM submissions
-            ORDER BY id DESC
-            LIMIT 2000
-        """)
-        rows = c.fetchall()
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"ok": False, "error": str(e)}), 500
-    finally:
-        conn.close()
+def _compute_charts(site_name: str, q_field_raw: str, q_type: str):
+    """返回 (payload, http_status)。"""
+    schema_name = _safe_schema(site_name)
 
-    # 读 schema 与图表配置
-    conn2 = get_conn(); c2 = conn2.cursor()
-    try:
-        c2.execute("SELECT schema_json FROM form_defs WHERE site_name=%s", (site_name,))
-        r = c2.fetchone()
-    finally:
-        conn2.close()
-    schema_json = r[0] if (r and isinstance(r[0], dict)) else (json.loads(r[0]) if r and r[0] else {})
+    # 读 schema 与图表配置（走缓存，不占连接）
+    schema_json = _form_schema(site_name) or {}
     charts_cfg = (schema_json.get("charts_config") or {}).get("charts") or []
 
-    # === 新增：构建「标题 -> 字段key」映射，支持用题目标题查图 ===
-    fields = (schema_json or {}).get("fields", []) or []
-    key_set = set()
-    label_to_key = {}
-    for f in fields:
-        k = f.get("key") or f.get("id") or f.get("name")
-        if not k:
-            continue
-        key_set.add(str(k))
-        lab = _extract_label(f)
-        if lab:
-            label_to_key[_norm(lab)] = str(k)
-
-    def resolve_field(user_input: str) -> str | None:
-        """支持：直接传 key；或传中文标题/英文标题"""
-        if not user_input:
-            return None
-        if user_input in key_set:
-            return user_input
-        return label_to_key.get(_norm(user_input))
+    # 「标题 -> 字段key」映射，支持用题目标题查图
+    resolve_field, field_label, fields = _chart_field_resolver(schema_json)
 
     # 查询参数（单图临时查看）
-    q_field_raw = (request.args.get("field") or "").strip()
-    q_type  = (request.args.get("type") or "").strip().lower()
     if q_type not in ("pie","line","flow",""):
         q_type = "pie"
     q_field = resolve_field(q_field_raw) if q_field_raw else ""
 
-    # 聚合容器
-    def to_dict(obj):
-        try:
-            return obj if isinstance(obj, dict) else (json.loads(obj) if obj else {})
-        except Exception:
-            return {}
+    # 先决定要画哪些图（field, type, label），只聚合这些字段
+    wanted = []
+    if q_field:
+        # 临时查看（query 覆盖）
+        wanted = [(q_field, q_type or "pie", field_label(q_field))]
+    elif charts_cfg:
+        for ch in charts_cfg:
+            want = (ch.get("field") or ch.get("label") or "").strip()
+            fld  = resolve_field(want)
+            if not fld:
+                continue
+            # 没给 label 时，用 schema 里的标题
+            wanted.append((fld, (ch.get("type") or "pie").lower(), ch.get("label") or field_label(fld)))
+    if not wanted:
+        # 兼容：没配置时自动挑一个选择类字段；再没有就用最新一条提交的第一个 key（在 SQL 里取）
+        for f in fields:
+            t = (f.get("type") or "").lower()
+            if t in ("select", "radio", "checkbox"):
+                fk = f.get("key") or f.get("id") or f.get("name")
+                wanted = [(str(fk), "pie", str(_extract_label(f) or fk))]
+                break
+    need_sample = not wanted
+    field_keys = list(dict.fromkeys(w[0] for w in wanted))
 
     now = datetime.utcnow()
     start_day = (now - timedelta(days=13)).date()
-    daily = Counter()
-    status_counter = Counter()
-    field_counters = defaultdict(Counter)   # field_key -> Counter()
 
-    # 扫描数据
-    for data, status, created_at in rows:
-        d = to_dict(data)
-        try:
-            dt = created_at if isinstance(created_at, datetime) else datetime.fromisoformat(str(created_at))
-        except Exception:
-            dt = now
-        day = dt.date()
-        if day >= start_day:
-            daily[day.isoformat()] += 1
-
-        s = (status or "").strip() or "待审核"
-        status_counter[s] += 1
-
-        for k, v in (d or {}).items():
-            k = str(k)
-            if isinstance(v, list):
-                for each in v:
-                    field_counters[k][str(each)] += 1
-            else:
-                field_counters[k][str(v)] += 1
+    # 读计数表（触发器增量维护）：近 14 天日序列 + 状态分布 + 已登记字段的取值分布，一次往返；
+    # 没登记的字段（临时查看 / 兜底取样）再实时聚合一次
+    conn = get_conn(); c = conn.cursor()
+    try:
+        c.execute(f'SET search_path TO "{schema_name}", public')
+        c.execute("""
+            WITH tracked AS (SELECT field FROM rollup_fields WHERE field = ANY(%s) AND ready)
+            SELECT 'd', NULL, to_char(day, 'YYYY-MM-DD'), SUM(n)::BIGINT FROM rollup_daily
+             WHERE day >= %s GROUP BY day HAVING SUM(n) <> 0
+            UNION ALL
+            SELECT 's', NULL, status, SUM(n)::BIGINT FROM rollup_status GROUP BY status HAVING SUM(n) <> 0
+            UNION ALL
+            SELECT 't', field, NULL, 0 FROM tracked
+            UNION ALL
+            SELECT 'f', field, value, SUM(n)::BIGINT FROM rollup_field
+             WHERE field IN (SELECT field FROM tracked) GROUP BY field, value HAVING SUM(n) <> 0
+        """, (field_keys, start_day))
+        rows = c.fetchall()
+        tracked = {r[1] for r in rows if r[0] == "t"}
+        live_keys = [k for k in field_keys if k not in tracked]
+        if live_keys or need_sample:
+            c.execute("""
+                WITH flds AS (
+                    SELECT unnest(%s::TEXT[]) AS k
+                    UNION ALL
+                    SELECT k FROM (
+                        SELECT jsonb_object_keys(data) AS k
+                          FROM (SELECT data FROM submissions ORDER BY id DESC LIMIT 1) last
+                         LIMIT 1
+                    ) sample
+                     WHERE %s
+                )
+                SELECT 'k', k, NULL, 0 FROM flds
+                UNION ALL
+                SELECT 'f', flds.k, e.v, COUNT(*)
+                  FROM submissions
+                  JOIN flds ON submissions.data ? flds.k
+                 CROSS JOIN LATERAL (
+                        SELECT jsonb_array_elements_text(data -> flds.k) AS v
+                         WHERE jsonb_typeof(data -> flds.k) = 'array'
+                        UNION ALL
+                        SELECT data ->> flds.k
+                         WHERE jsonb_typeof(data -> flds.k) NOT IN ('array', 'null')
+                 ) e
+                 GROUP BY 2, 3
+            """, (live_keys, need_sample))
+            rows += c.fetchall()
+    except Exception as e:
+        conn.rollback()
+        return {"ok": False, "error": str(e)}, 500
+    finally:
+        conn.close()
+
+    daily, status_arr, dist = {}, [], {}
+    for kind, fld, val, cnt in rows:
+        if kind == "d":
+            daily[val] = int(cnt)
+        elif kind == "s":
+            status_arr.append({"name": val, "count": int(cnt)})
+        elif kind == "k":
+            if need_sample and fld:
+                wanted = [(fld, "pie", fld)]
+        elif kind == "t":
+            pass
+        else:
+            dist.setdefault(fld, []).append({"value": val, "count": int(cnt)})
+    for cat in dist.values():
+        cat.sort(key=lambda x: (-x["count"], x["value"]))
 
     # 通用结果
-    dates = [(now - timedelta(days=i)).date() for i in range(13, -1, -1)]
-    daily_arr = [{"date": d.isoformat(), "count": int(daily.get(d.isoformat(), 0))} for d in dates]
-    status_arr = [{"name": k, "count": int(v)} for k, v in status_counter.items()]
+    dates = [(now - timedelta(days=i)).date().isoformat() for i in range(13, -1, -1)]
+    daily_arr = [{"date": d, "count": daily.get(d, 0)} for d in dates]
 
     def chart_payload(field_key: str, ctype: str, label: str = None):
         label = label or field_key or "字段"
-        dist = field_counters.get(field_key, Counter())
-        cat = [{"value": k, "count": int(v)} for k, v in dist.items()]
+        cat = dist.get(field_key, [])
         payload = {"field": field_key, "label": label, "type": ctype or "pie", "data": cat}
         if ctype == "line":
             payload["daily"] = daily_arr
         if ctype == "flow":
-            payload["funnel"] = sorted(cat, key=lambda x: x["count"], reverse=True)
+            payload["funnel"] = list(cat)   # 已按数量降序
         return payload
 
-    # 先按已保存配置返回
-    charts = []
-    if charts_cfg and not q_field:
-        for ch in charts_cfg:
-            want = (ch.get("field") or ch.get("label") or "").strip()
-            fld  = resolve_field(want)
-            if not fld:
-                continue
-            # 没给 label 时，用 schema 里的标题
-            show_label = (ch.get("label") or
-                          _extract_label(next((f for f in fields if (f.get("key") or f.get("id") or f.get("name")) == fld), {})) or
-                          fld)
-            charts.append(chart_payload(fld, (ch.get("type") or "pie").lower(), show_label))
-
-    # 临时查看（query 覆盖）
-    if q_field:
-        charts = [chart_payload(q_field, q_type or "pie",
-                                _extract_label(next((f for f in fields if (f.get("key") or f.get("id") or f.get("name")) == q_field), {})) or q_field)]
-
-    # 兼容：没配置时自动挑一个字段
-    if not charts:
-        field_key, field_label = None, None
-        for f in fields:
-            t = (f.get("type") or "").lower()
-            if t in ("select", "radio", "checkbox"):
-                field_key = f.get("key") or f.get("id") or f.get("name")
-                field_label = _extract_label(f) or field_key
-                break
-        if not field_key and rows:
-            sample = to_dict(rows[0][0])
-            if isinstance(sample, dict) and sample:
-                field_key = next(iter(sample.keys()), None)
-                field_label = field_key or "字段"
-        if field_key:
-            charts = [chart_payload(str(field_key), "pie", str(field_label))]
+    charts = [chart_payload(fld, ctype, label) for fld, ctype, label in wanted]
 
     resp = {
         "ok": True,
@@ -2504,7 +5539,7 @@ def api_charts(site_name):
         resp["charts"] = []
         resp["field"] = {"label": "字段", "data": []}
 
-    return jsonify(resp)
+    return resp, 200
 
 
 # === 变更点 ④ 结束 ===
@@ -2532,20 +5567,17 @@ def allow_embed(resp):
             resp.headers.pop('X-Frame-Options', None)
         except Exception:
             pass
-        try:
-            if resp.content_type and resp.content_type.startswith('text/html'):
-                html = resp.get_data(as_text=True)
-                low = html.lower()
-                if '</head>' in low and '<base' not in low:
-                    html = html.replace('</head>', '<base target="_top"></head>', 1)
-                    resp.set_data(html)
-                elif '<body' in low and '<base' not in low:
-                    html = html.replace('<body', '<base target="_top"><body', 1)
-                    resp.set_data(html)
-        except Exception:
-            pass
     return resp
 
+# 成功页被 iframe 嵌入时，链接在顶层窗口打开
+_RE_BASE_TAG = re.compile(rb"<base", re.I)
+_html_rule(
+    "embed-base-target",
+    lambda path, ep: ep == "create_success",
+    head=lambda m, buf: None if _RE_BASE_TAG.search(buf) else b'<base target="_top">',
+    order=10,
+)
+
 def _has_cjk(text: str) -> bool:
     if not text: return False
     import re as _re
@@ -2563,9 +5595,31 @@ def handle_413(e):
         return jsonify({"ok": False, "error": msg}), 413
     return (msg, 413, {"Content-Type": "text/plain; charset=utf-8"})
 # ========== 健康检查 ==========
+# /_health 对外只回 ok；/_health/pool 里有路由、缓存、连接池的内部数字，
+# 登录后可看，监控抓取用共享密钥：设 HEALTH_TOKEN，请求带 X-Health-Token 头（不设就只能登录看）
+HEALTH_TOKEN = os.getenv("HEALTH_TOKEN", "")
+
+
+def _health_token_ok() -> bool:
+    got = request.headers.get("X-Health-Token") or ""
+    return bool(HEALTH_TOKEN) and secrets.compare_digest(got.encode(), HEALTH_TOKEN.encode())
+
+
 @app.route("/_health")
 def _health(): return "ok", 200
 
+@app.route("/_health/pool")
+def _health_pool():
+    # 连接池实时统计：in_use / idle / 等待次数与耗时 / 单次占用时长
+    if not (session.get("user_id") or _health_token_ok()):
+        abort(404)
+    return jsonify({"ok": True, "pool": _POOL.stats(),
+                    "form_cache": {**_FORM_CACHE.stats(), "listener_ok": _LISTENER["ok"]},
+                    "page_cache": _PAGE_CACHE.stats(),
+                    "charts_cache": _CHARTS_CACHE.stats(),
+                    "thumbs": _thumb_stats(),
+                    "hold_by_route": _route_hold_stats()})
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,85 @@
+# bench_checkout.py —— 对比“旧 get_conn（心跳 + 两次 SET）”与“新连接池”每次取连接的往返次数与耗时
+# 用法：DB_URL=postgresql://... python bench/bench_checkout.py [次数]
+import os, sys, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from dotenv import load_dotenv
+load_dotenv()
+
+import psycopg2
+import psycopg2.extensions
+import app as formly
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+# 每个请求里 get_conn() 的调用次数（改造前的实际代码路径）
+ROUTES = {
+    "public_form": 1,
+    "public_submit": 1,
+    "site_admin(+主题注入)": 2,
+    "_api_list_responses": 2,
+    "api_charts": 2,
+}
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        self.connection.statements += 1
+        return super().execute(query, vars)
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    statements = 0
+
+    def cursor(self, *a, **kw):
+        kw.setdefault("cursor_factory", CountingCursor)
+        return super().cursor(*a, **kw)
+
+
+def make_pool():
+    return formly._InstrumentedPool(
+        formly.DB_URL, minconn=1, maxconn=2, timeout=5, validate_idle=0,
+        connect_kwargs={"connection_factory": CountingConnection},
+    )
+
+
+def legacy_checkout(pool):
+    # 改造前 get_conn 的逻辑：SELECT 1 心跳 + set_client_encoding + 两条 SET
+    raw = pool.getconn()
+    with raw.cursor() as c:
+        c.execute("SELECT 1")
+    raw.set_client_encoding("UTF8")
+    with raw.cursor() as c:
+        c.execute("SET statement_timeout TO 60000")
+        c.execute("SET idle_in_transaction_session_timeout TO 30000")
+    return raw
+
+
+def new_checkout(pool):
+    return pool.getconn()
+
+
+def run(label, checkout):
+    pool = make_pool()
+    raw = pool.getconn(); pool.putconn(raw)      # 预热（建链成本不计入）
+    base = raw.statements
+    t0 = time.perf_counter()
+    for _ in range(N):
+        r = checkout(pool)
+        pool.putconn(r)
+    dt = time.perf_counter() - t0
+    rt = (raw.statements - base) / N
+    pool.closeall()
+    print(f"{label:<8} 往返/次取连接: {rt:.2f}   平均耗时: {dt / N * 1000:.3f} ms")
+    return rt, dt / N * 1000
+
+
+if __name__ == "__main__":
+    print(f"DB: {formly.DB_URL.split('@')[-1].split('?')[0]}   次数: {N}")
+    old_rt, old_ms = run("legacy", legacy_checkout)
+    new_rt, new_ms = run("pooled", new_checkout)
+    print()
+    print(f"{'路由':<24}{'get_conn 次数':>12}{'省下往返':>10}{'省下耗时(ms)':>14}")
+    for route, n in ROUTES.items():
+        print(f"{route:<24}{n:>12}{(old_rt - new_rt) * n:>10.0f}{(old_ms - new_ms) * n:>14.3f}")
@@ -0,0 +1,58 @@
+# bench_html_pipeline.py —— 对比 HTML 后处理：旧的多钩子串行 replace vs 现在的单次 _apply_html_rules
+# 用法：DB_URL=postgresql://... python bench/bench_html_pipeline.py [次数]
+#   只 import app（不连库），用 templates/create_form.html 作为输入（最大的页面，命中 imgbtn + 入场动画 + meta）
+import os, statistics, sys, time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault("DB_URL", "postgresql://bench@localhost/bench")
+
+import app  # noqa: E402
+
+
+def legacy_chain(html_bytes):
+    """按旧钩子的执行顺序逐个解码 → lower/replace → 编码（还原改动前的开销形态）。"""
+    data = html_bytes
+    # _tweak_create_form_image_button
+    html = data.decode("utf-8")
+    if "</body>" in html:
+        html = html.replace("</body>", app._CREATE_FORM_IMGBTN_HTML + "</body>")
+    data = html.encode("utf-8")
+    # _inject_enter_animation
+    html = data.decode("utf-8")
+    if "</body>" in html:
+        html = html.replace("</body>", app._ENTER_ANIMATION_HTML + "</body>")
+    data = html.encode("utf-8")
+    # _ensure_meta_charset
+    html = data.decode("utf-8")
+    low = html.lower()
+    if "</head>" in low and "<meta charset=" not in low:
+        html = html.replace("</head>", '<meta charset="utf-8"></head>', 1)
+    return html.encode("utf-8")
+
+
+def timeit(fn, n):
+    xs = []
+    for _ in range(n):
+        t = time.perf_counter()
+        fn()
+        xs.append((time.perf_counter() - t) * 1000)
+    return statistics.median(xs), max(xs)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    buf = (ROOT / "templates" / "create_form.html").read_bytes()
+    old = legacy_chain(buf)
+    new = app._apply_html_rules(buf, "/create_form", "create_form")
+    print(f"input: {len(buf)} bytes; legacy out: {len(old)}; pipeline out: {len(new)}")
+    print(f"</body> occurrences in input: {buf.count(b'</body>')} (legacy injects into each)")
+    for name, fn in (("legacy", lambda: legacy_chain(buf)),
+                     ("pipeline", lambda: app._apply_html_rules(buf, "/create_form", "create_form"))):
+        med, mx = timeit(fn, n)
+        print(f"{name:9s} median {med:.3f} ms   max {mx:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# bench_startup.py —— 测 worker 冷启动：import app 耗时 + 首个请求耗时（每次都在全新子进程里跑）
+# 用法：DB_URL=postgresql://... python bench/bench_startup.py [次数] [--site 站点名]
+#   --site 给了就额外测一次需要查库的首个请求（/f/<站点>），否则只测 /_health 与 /login
+import json, os, statistics, subprocess, sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+cl = app.app.test_client()
+out = {"import_ms": (t1 - t0) * 1000}
+for key, path in PATHS:
+    t = time.perf_counter()
+    r = cl.get(path)
+    out[key] = (time.perf_counter() - t) * 1000
+    out[key + "_status"] = r.status_code
+out["heavy_loaded"] = [m for m in ("pandas", "numpy", "docx", "openpyxl") if m in sys.modules]
+out["db_connects_at_import"] = CONNECTS_AT_IMPORT
+print(json.dumps(out))
+"""
+
+
+def run_once(paths):
+    code = CHILD.replace("PATHS", repr(paths))
+    # import 完立刻记一下池子建了几条连接（应为 0）
+    code = code.replace("t1 = time.perf_counter()\n",
+                        "t1 = time.perf_counter()\nCONNECTS_AT_IMPORT = app._POOL.stats()['connects']\n", 1)
+    p = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise SystemExit(p.stderr)
+    return json.loads(p.stdout.strip().splitlines()[-1])
+
+
+def main():
+    args = sys.argv[1:]
+    site = None
+    if "--site" in args:
+        i = args.index("--site"); site = args[i + 1]; del args[i:i + 2]
+    n = int(args[0]) if args else 5
+    paths = [("first_health_ms", "/_health"), ("first_login_page_ms", "/login")]
+    if site:
+        paths.append(("first_public_form_ms", f"/f/{site}"))
+
+    runs = [run_once(paths) for _ in range(n)]
+    print(f"冷启动 {n} 次（中位数 / 最大值）：")
+    for key in ["import_ms"] + [k for k, _ in paths]:
+        vals = [r[key] for r in runs]
+        print(f"  {key:<24}{statistics.median(vals):>10.1f} ms{max(vals):>10.1f} ms")
+    last = runs[-1]
+    print(f"  import 阶段建立的数据库连接: {last['db_connects_at_import']}")
+    print(f"  首个请求后已加载的重依赖: {', '.join(last['heavy_loaded']) or '无'}")
+
+
+if __name__ == "__main__":
+    main()
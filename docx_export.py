@@ -0,0 +1,17 @@
+# docx_export.py —— 单条提交 -> .docx 字节
+# 单独成模块：批量导出用 spawn 进程池调用 render_submission，任务本身只需要 import 这里（和 python-docx）。
+# 注意 spawn 还会重新导入父进程的 __main__：gunicorn 下无妨，`python app.py` 启动时子进程会再导入一遍 app.py，
+# 见 app.py「批量导出 Word」一节的说明
+import io
+
+
+def render_submission(sub_id, pairs):
+    """pairs: [(字段, 内容), ...]，已是修好编码的字符串。返回 (sub_id, docx 字节)。"""
+    from docx import Document  # 重依赖：只在导出时加载，加快 worker 启动
+    doc = Document(); doc.add_heading(f"提交 #{sub_id}", level=1)
+    for k, v in pairs:
+        p = doc.add_paragraph()
+        p.add_run(f"{k}: ").bold = True
+        p.add_run(v)
+    buffer = io.BytesIO(); doc.save(buffer)
+    return sub_id, buffer.getvalue()
@@ -1116,18 +1116,30 @@ async function delRow(site, id) {
     var site=(document.body.dataset.site||'').trim(); if(!site){alert('请先填写网站名，系统会自动保存'); return;}
     location.href='/site/'+site+'/admin/api/export_all_excel'; showToast('已开始导出');
   });
-  bind(document.getElementById('btnGallery'),'click',async function(){
-    var site=(document.body.dataset.site||'').trim(); if(!site){alert('请先填写网站名，系统会自动保存'); return;}
-    var r=await fetch('/site/'+site+'/admin/api/gallery'); var d=await r.json();
-    if(!r.ok||!Array.isArray(d.items)){alert('加载失败'); return;}
-    var galleryRoot=document.getElementById('galleryRoot'); if(galleryRoot) galleryRoot.innerHTML='';
+  // 图集按 next_cursor 分页：打开时取第一页，“加载更多”接着取
+  var galleryCursor=null;
+  async function loadGallery(reset){
+    var site=(document.body.dataset.site||'').trim(); if(!site){alert('请先填写网站名，系统会自动保存'); return false;}
+    if(reset) galleryCursor=null;
+    var r=await fetch('/site/'+site+'/admin/api/gallery'+(galleryCursor?('?before_id='+galleryCursor):'')); var d=await r.json();
+    if(!r.ok||!Array.isArray(d.items)){alert('加载失败'); return false;}
+    var galleryRoot=document.getElementById('galleryRoot'); if(galleryRoot&&reset) galleryRoot.innerHTML='';
     d.items.forEach(function(it){
       var a=document.createElement('a'); a.href=it.url; a.download=''; a.title='点击下载';
-      var img=new Image(); img.src=it.url; img.style.width='160px'; img.style.height='120px'; img.style.objectFit='cover'; img.style.borderRadius='10px';
+      var img=new Image(); img.loading='lazy'; img.decoding='async';
+      if(it.thumb_2x) img.srcset=it.thumb+' 1x, '+it.thumb_2x+' 2x';
+      img.src=it.thumb||it.url; img.style.width='160px'; img.style.height='120px'; img.style.objectFit='cover'; img.style.borderRadius='10px';
       a.appendChild(img); if(galleryRoot) galleryRoot.appendChild(a);
     });
+    galleryCursor=d.next_cursor?d.next_cursor.before_id:null;
+    var more=document.getElementById('galleryMore'); if(more) more.hidden=!galleryCursor;
+    return true;
+  }
+  bind(document.getElementById('btnGallery'),'click',async function(){
+    if(!(await loadGallery(true))) return;
     var galleryModalEl=document.getElementById('galleryModal'); if(galleryModalEl) galleryModalEl.classList.add('show');
   });
+  bind(document.getElementById('galleryMore'),'click',function(){ loadGallery(false); });
   bind(document.getElementById('closeGallery'),'click',function(){
     var gm=document.getElementById('galleryModal'); if(gm) gm.classList.remove('show');
   });
@@ -0,0 +1,78 @@
+"""测试公共夹具。
+
+app 在 import 时只要求 DB_URL 有值（不连库），纯函数测试不需要数据库；
+用到数据库的测试通过 `db` / `site` 夹具拿连接，库连不上就跳过：
+
+    DB_URL=postgresql://localhost/formly_test python -m pytest -q
+"""
+import json
+import os
+import shutil
+import sys
+import uuid
+
+import psycopg2
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DB_URL", "postgresql://localhost/formly_test")
+os.environ.setdefault("FORM_CACHE_LISTEN", "0")   # 不起 LISTEN 线程
+
+import app as A  # noqa: E402
+
+FILE_FIELD = "shots"
+SCHEMA = {"fields": [
+    {"key": "name", "label": "姓名", "type": "text"},
+    {"key": "ticket", "label": "票种", "type": "select", "options": ["早鸟票", "标准票"]},
+    {"key": FILE_FIELD, "label": "截图", "type": "file"},
+]}
+
+
+@pytest.fixture(scope="session")
+def db():
+    """autocommit 的直连（造数据 / 清理用）；连不上就跳过依赖数据库的测试。"""
+    try:
+        raw = psycopg2.connect(A.DB_URL, connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"database not reachable: {e}")
+    raw.autocommit = True
+    yield raw
+    raw.close()
+
+
+@pytest.fixture(scope="session")
+def uploads(tmp_path_factory):
+    old = A.app.config["UPLOAD_FOLDER"]
+    A.app.config["UPLOAD_FOLDER"] = str(tmp_path_factory.mktemp("uploads"))
+    yield A.app.config["UPLOAD_FOLDER"]
+    A.app.config["UPLOAD_FOLDER"] = old
+
+
+@pytest.fixture(scope="session")
+def site(db, uploads):
+    """迁移 + 登录 + 建一个带文件题的表单；返回 (已登录的 client, site_name)。"""
+    name = "pyt_" + uuid.uuid4().hex[:8]
+    res = A.app.test_cli_runner().invoke(args=["migrate"])
+    assert res.exit_code == 0, res.output
+    client = A.app.test_client()
+    user = "pytest_" + name
+    client.post("/register", data={"username": user, "password": "p"})
+    r = client.post("/login", data={"username": user, "password": "p"})
+    assert r.status_code == 302
+    r = client.post("/create_form?ajax=1", data={
+        "form_name": "pytest", "site_name": name,
+        "schema_json": json.dumps(SCHEMA, ensure_ascii=False)})
+    assert r.status_code == 200, r.get_data(as_text=True)
+    A._TENANT_QUEUE.join()
+    yield client, name
+
+    schema = A._safe_schema(name)
+    with db.cursor() as c:
+        c.execute(f'DROP SCHEMA IF EXISTS "{schema}" CASCADE')
+        c.execute("DELETE FROM public.schema_migrations WHERE scope=%s", (schema,))
+        c.execute("DELETE FROM form_defs WHERE site_name=%s", (name,))
+        c.execute("DELETE FROM users WHERE username=%s", (user,))
+    A._forget_tenant(schema)
+    A._FORM_CACHE.evict(name)
+    shutil.rmtree(os.path.join(uploads, name), ignore_errors=True)
@@ -0,0 +1,84 @@
+import time
+
+import app as A
+
+
+def _ent(version):
+    return {"version": version, "loaded_at": time.monotonic()}
+
+
+def test_put_and_get():
+    cache = A._FormDefCache(4)
+    cache.put("a", _ent(1), cache.generation("a"))
+    assert cache.get("a", 60)["version"] == 1
+    assert cache.get("a", -1) is None   # 过期
+
+
+def test_fill_that_raced_an_eviction_is_dropped():
+    cache = A._FormDefCache(4)
+    gen = cache.generation("a")       # 读库前
+    cache.evict("a")                  # 写入方在我们读库期间改了表单
+    cache.put("a", _ent(1), gen)      # 读到的是旧定义
+    assert cache.get("a", 60) is None
+    cache.put("a", _ent(2), cache.generation("a"))
+    assert cache.get("a", 60)["version"] == 2
+
+
+def test_evict_all_bumps_the_epoch():
+    cache = A._FormDefCache(4)
+    gen_a, gen_b = cache.generation("a"), cache.generation("b")
+    cache.evict("*")
+    cache.put("a", _ent(1), gen_a)
+    cache.put("b", _ent(1), gen_b)
+    assert cache.get("a", 60) is None and cache.get("b", 60) is None
+
+
+def test_eviction_of_other_key_does_not_drop_fill():
+    cache = A._FormDefCache(4)
+    gen = cache.generation("a")
+    cache.evict("b")
+    cache.put("a", _ent(1), gen)
+    assert cache.get("a", 60)["version"] == 1
+
+
+def test_generation_table_overflow_is_conservative():
+    cache = A._FormDefCache(1)
+    gen = cache.generation("a")
+    for i in range(5):                # 超过 4 * maxsize 个不同 key：整体进一代
+        cache.evict(f"k{i}")
+    assert len(cache._gens) <= 4
+    cache.put("a", _ent(1), gen)
+    assert cache.get("a", 60) is None
+
+
+def test_older_version_never_replaces_newer():
+    cache = A._FormDefCache(4)
+    cache.put("a", _ent(3))
+    cache.put("a", _ent(2))
+    assert cache.get("a", 60)["version"] == 3
+
+
+def test_lru_bound():
+    cache = A._FormDefCache(2)
+    for k in "abc":
+        cache.put(k, _ent(1))
+    assert cache.get("a", 60) is None
+    assert cache.stats()["size"] == 2
+
+
+def test_get_form_def_does_not_cache_a_read_that_raced_an_update(site, monkeypatch):
+    _, name = site
+    A._FORM_CACHE.evict(name)
+    real = A.get_conn
+
+    def racing_get_conn():
+        A._FORM_CACHE.evict(name)     # 模拟另一个 worker 在读库期间保存了表单
+        return real()
+
+    monkeypatch.setattr(A, "get_conn", racing_get_conn)
+    ent = A._get_form_def(name)
+    assert ent is not None and ent["site_name"] == name
+    assert A._FORM_CACHE.get(name, 60) is None
+    monkeypatch.setattr(A, "get_conn", real)
+    assert A._get_form_def(name) is not None
+    assert A._FORM_CACHE.get(name, 60) is not None
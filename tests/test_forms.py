@@ -0,0 +1,68 @@
+import pytest
+
+import app as A
+
+
+# ========= _compile_form：坏配置不能让整页 500 =========
+@pytest.mark.parametrize("schema", [
+    None, [], "x",
+    {"settings": [1]},
+    {"settings": {"upload": "x"}},
+    {"upload": {"max_files": "abc", "allowed_file_types": None}},
+    {"upload": {"max_files": -1}},
+    {"fields": "x"},
+    {"fields": [1, None, {"key": "a", "options": None}]},
+    {"fields": [{"type": 5, "key": "a"}, {"key": 1, "label": ["x"]}]},
+    {"theme": "red"},
+    {"theme": {"brand": 5, "mode": 3, "brand_dark": []}},
+    {"header": "x", "display": [1]},
+])
+def test_compile_tolerates_malformed_schema(schema):
+    plan = A._compile_form(schema, "T")
+    assert plan["title"] == "T"
+    assert plan["upload_max_files"] >= 1
+    assert plan["theme_mode"] in ("light", "dark", "auto")
+    assert plan["admin_theme"][2] in ("light", "dark", "auto")
+    assert isinstance(plan["clean_fields"], list)
+    assert isinstance(plan["allowed"], frozenset)
+
+
+def test_compile_upload_settings():
+    plan = A._compile_form({"settings": {"upload": {"max_files": "5", "allowed_file_types": " PDF, png ,"}}})
+    assert plan["upload_max_files"] == 5
+    assert plan["allowed"] == {"pdf", "png"}
+    assert A._compile_form({"upload": {"max_files": "x"}})["upload_max_files"] == 3
+
+
+def test_compile_fields_and_lookup():
+    plan = A._compile_form({"fields": [
+        {"key": "email", "label": "邮箱", "type": "text", "desc": "说明"},
+        {"key": "who", "label": "<b>姓名</b>", "type": "text"},
+        {"key": "f", "type": "FILE"},
+    ]})
+    assert [f["key"] for f in plan["clean_fields"]] == ["email", "who", "f"]
+    assert plan["has_file"] is True
+    assert plan["lookup_field"] == "who"
+    assert A._compile_form({"fields": [{"key": "n", "type": "number"}, {"key": "t"}]})["lookup_field"] == "t"
+
+
+# ========= _lookup_norm =========
+@pytest.mark.parametrize("raw, want", [
+    ("张 三", "张三"),
+    ("  Zhang\tSan\n", "zhangsan"),
+    ("ＺＨＡＮＧ　三", "zhang三"),   # 全角字母、全角空格
+    ("Ⅻ", "xii"),
+    (None, ""),
+    (123, "123"),
+])
+def test_lookup_norm(raw, want):
+    assert A._lookup_norm(raw) == want
+
+
+def test_lookup_key_uses_the_same_normaliser():
+    assert A._lookup_key({"who": "ＺＨＡＮＧ 三"}, "who") == A._lookup_norm("zhang三")
+    assert A._lookup_key('{"who": "A"}', "who") == "a"
+    assert A._lookup_key({"who": ["B", "C"]}, "who") == "b"
+    assert A._lookup_key({"who": " "}, "who") is None
+    assert A._lookup_key("not json", "who") is None
+    assert A._lookup_key({"who": "A"}, None) is None
@@ -0,0 +1,68 @@
+import os
+
+import app as A
+
+CREATE_FORM = os.path.join(A.app.root_path, "templates", "create_form.html")
+
+
+def _legacy(buf, heads=(), bodies=()):
+    """合并前各 after_request 钩子的写法：</head> 替换第一处，</body> 每处都替换。"""
+    for h in heads:
+        buf = buf.replace(b"</head>", h + b"</head>", 1)
+    for b in bodies:
+        buf = buf.replace(b"</body>", b + b"</body>")
+    return buf
+
+
+def _create_form_snippets():
+    # 按 order：图片按钮（20）在入场动画（50）前面，同旧钩子的执行顺序
+    return (A._CREATE_FORM_IMGBTN_HTML.encode("utf-8")
+            + A._ENTER_ANIMATION_HTML.encode("utf-8"))
+
+
+def test_create_form_injects_before_the_real_body_close_only():
+    with open(CREATE_FORM, "rb") as f:
+        buf = f.read()
+    # 模板里注释中还有一个 </body>（"粘贴到 create_form.html 的 </body> 前一行"）
+    assert buf.count(b"</body>") == 2
+    inject = _create_form_snippets()
+
+    out = A._apply_html_rules(buf, "/create_form", "create_form")
+    legacy = _legacy(buf, bodies=[inject])
+    assert legacy.count(inject) == 2
+    assert out.count(inject) == 1
+    # 旧输出去掉注释里那一份（浏览器本来就不执行）就和新输出逐字节一致
+    assert legacy.replace(inject, b"", 1) == out
+    assert out.index(inject) == buf.rfind(b"</body>")
+
+
+def test_head_snippets_match_legacy_order():
+    buf = b"<html><head><title>t</title></head><body>x</body></html>"
+    out = A._apply_html_rules(buf, "/site/a/create_success", "create_success")
+    # 旧钩子：后注册的 <base> 先执行，<meta charset> 再插到它后面
+    assert out == _legacy(buf, heads=[b'<base target="_top">', b'<meta charset="utf-8">'])
+
+
+def test_existing_meta_and_base_are_respected():
+    buf = b'<html><head><META CHARSET="utf-8"><base href="/"></head><body></body></html>'
+    assert A._apply_html_rules(buf, "/site/a/create_success", "create_success") is buf
+
+
+def test_no_head_falls_back_to_body_open():
+    buf = b"<html><body>x</body></html>"
+    out = A._apply_html_rules(buf, "/site/a/create_success", "create_success")
+    assert out == b'<html><base target="_top"><body>x</body></html>'
+
+
+def test_body_snippet_without_body_tag_is_skipped():
+    buf = b"<html><head><meta charset=utf-8></head><p>x"
+    assert A._apply_html_rules(buf, "/site/a/preview", "preview") is buf
+
+
+def test_create_form_page_through_the_app(site):
+    client, _ = site
+    r = client.get("/create_form")
+    assert r.status_code == 200
+    body = r.get_data()
+    assert body.count(_create_form_snippets()) == 1
+    assert "粘贴到 create_form.html 的 </body> 前一行".encode("utf-8") in body
@@ -0,0 +1,88 @@
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+
+import app as A
+
+
+class _FakeRaw:
+    closed = 0
+
+    def __init__(self):
+        self.info = SimpleNamespace(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class _FakePool(A._InstrumentedPool):
+    def _connect(self):
+        with self._cond:
+            self._st["connects"] += 1
+        return _FakeRaw()
+
+
+@pytest.fixture
+def pool():
+    p = _FakePool("postgresql://unused", minconn=0, maxconn=1, timeout=0.05, validate_idle=0)
+    yield p
+    p.closeall()
+
+
+def test_getconn_times_out_when_exhausted(pool):
+    raw = pool.getconn()
+    t0 = time.monotonic()
+    with pytest.raises(A.PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - t0 >= 0.05
+    st = pool.stats()
+    assert (st["timeouts"], st["in_use"], st["opened"]) == (1, 1, 1)
+    pool.putconn(raw)
+    assert pool.getconn() is raw   # 空闲连接复用，不再新建
+    assert pool.stats()["connects"] == 1
+
+
+def test_waiter_is_woken_by_putconn(pool):
+    raw = pool.getconn()
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.getconn(timeout=5)))
+    t.start()
+    time.sleep(0.05)
+    pool.putconn(raw)
+    t.join(5)
+    assert got == [raw]
+    assert pool.stats()["waits"] == 1
+
+
+def test_closed_connection_is_discarded(pool):
+    raw = pool.getconn()
+    raw.close()
+    pool.putconn(raw)
+    assert pool.getconn() is not raw
+    assert pool.stats()["discarded"] == 1
+
+
+def _exhausted(*a, **kw):
+    raise A.PoolTimeout("no free DB connection within 0.0s")
+
+
+def test_pool_timeout_becomes_503(monkeypatch):
+    monkeypatch.setattr(A._POOL, "getconn", _exhausted)
+    client = A.app.test_client()
+    site = "nosuch_" + uuid.uuid4().hex[:8]   # 缓存里没有：一定要借连接
+
+    r = client.get(f"/f/{site}")
+    assert r.status_code == 503
+    assert r.headers["Retry-After"] == "1"
+    assert r.content_type.startswith("text/plain")
+
+    r = client.get(f"/f/{site}", headers={"Accept": "application/json"})
+    assert r.status_code == 503
+    assert r.get_json()["ok"] is False
@@ -0,0 +1,48 @@
+import app as A
+
+
+def test_tokens_cjk_bigrams_and_words():
+    toks = A._search_tokens({"name": "张三丰", "email": "Foo_Bar@x.com", "ok": True, "n": [1, None]})
+    assert toks == ["张", "张三", "三", "三丰", "丰", "foo_bar", "x", "com", "1"]
+
+
+def test_tokens_nfkc_and_json_text():
+    assert A._search_tokens('{"a": "ＡＢＣ"}') == ["abc"]
+    assert A._search_tokens("not json") == ["not", "json"]
+
+
+def test_tokens_are_capped(monkeypatch):
+    monkeypatch.setattr(A, "SEARCH_MAX_TOKENS", 3)
+    assert len(A._search_tokens({"a": "w1 w2 w3 w4 w5"})) == 3
+
+
+def test_query_and_of_terms():
+    assert A._search_query("张三 abc") == "'张三' & 'abc':*"
+    assert A._search_query("张") == "'张'"
+    assert A._search_query("abc ABC") == "'abc':*"
+    assert A._search_query("ＡＢＣ") == "'abc':*"
+
+
+def test_query_never_emits_tsquery_syntax():
+    assert A._search_query("O'Neil") == "'o':* & 'neil':*"
+    assert A._search_query("a & !b | (c)") == "'a':* & 'b':* & 'c':*"
+    assert A._search_query("%%") is None
+    assert A._search_query("") is None
+
+
+def test_where_escapes_like_metacharacters():
+    sql, params, tsq = A._search_where("100% a_b")
+    assert tsq == "'100':* & 'a_b':*"
+    assert params == [tsq, "%100\\%%", "%a\\_b%"]
+    assert sql.count("ILIKE %s") == 2
+    assert A._search_where(r"c:\x")[1][1] == r"%c:\\x%"
+
+
+def test_where_normalises_before_escaping():
+    # 全角 ％ 经 NFKC 变成 %，同样按字面匹配
+    assert A._search_where("１００％")[1] == A._search_where("100%")[1]
+
+
+def test_where_without_tokens_is_ilike_only():
+    assert A._search_where("%") == ("normalize(data::text, NFKC) ILIKE %s", ["%\\%%"], None)
+    assert A._search_where("  ") == ("TRUE", [], None)
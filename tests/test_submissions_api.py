@@ -0,0 +1,145 @@
+import json
+import uuid
+from datetime import datetime
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import app as A
+
+
+# ========= _list_filters（纯函数）=========
+def test_filters_field_values_match_scalar_or_array():
+    where, params = A._list_filters(MultiDict([("f.city", "北京"), ("f.city", "上海"), ("f.x", "")]))
+    assert where == ["(data @> %s::jsonb OR data @> %s::jsonb OR data @> %s::jsonb OR data @> %s::jsonb)"]
+    assert params == ['{"city": "北京"}', '{"city": ["北京"]}', '{"city": "上海"}', '{"city": ["上海"]}']
+
+
+def test_filters_ignore_bare_prefix_and_blank_status():
+    assert A._list_filters(MultiDict([("f.", "a"), ("status", " "), ("q", "x")])) == ([], [])
+
+
+def test_filters_status_and_dates():
+    where, params = A._list_filters(MultiDict([
+        ("status", "通过"), ("status", "待审核 "),
+        ("created_from", "2024-01-02"), ("created_to", "2024-01-05"),
+    ]))
+    assert where == ["status = ANY(%s)", "created_at >= %s", "created_at < %s"]
+    # 只给日期的 created_to 含当天
+    assert params == [["通过", "待审核"], datetime(2024, 1, 2), datetime(2024, 1, 6)]
+    _, params = A._list_filters(MultiDict([("created_to", "2024-01-05T12:00:00")]))
+    assert params == [datetime(2024, 1, 5, 12)]
+
+
+def test_filters_reject_bad_dates():
+    with pytest.raises(ValueError):
+        A._list_filters(MultiDict([("created_from", "yesterday")]))
+
+
+# ========= 列表接口：游标翻页 =========
+CREATED = ["2024-01-03", "2024-01-01", None, "2024-01-02", "2024-01-01", None, "2024-01-05", "2024-01-04"]
+
+
+@pytest.fixture
+def rows(site, db):
+    """插一批 created_at 有重复、有 NULL 的行；返回 (tag, [(id, created_at)])。"""
+    _, name = site
+    tag = uuid.uuid4().hex[:8]
+    out = []
+    with db.cursor() as c:
+        for i, at in enumerate(CREATED):
+            c.execute(f'INSERT INTO "{A._safe_schema(name)}".submissions(data, created_at) '
+                      "VALUES (%s, %s) RETURNING id",
+                      (json.dumps({"tag": tag, "n": i}), at))
+            out.append((c.fetchone()[0], datetime.fromisoformat(at) if at else datetime.min))
+    return tag, out
+
+
+def _expected(rows, desc):
+    # NULL 的 created_at 按最旧处理，同一时间按 id
+    return [i for i, _ in sorted(rows, key=lambda r: (r[1], r[0]), reverse=desc)]
+
+
+def _walk(client, url, params, direction="next_cursor", start=None):
+    pages, q = [], {**params, **(start or {})}
+    while True:
+        j = client.get(url, query_string=q).get_json()
+        assert j["ok"], j
+        pages.append(j)
+        if not j[direction]:
+            return pages
+        q = {**params, **j[direction]}
+
+
+@pytest.mark.parametrize("order", ["desc", "asc"])
+@pytest.mark.parametrize("sort", ["created_at", "id"])
+def test_cursor_walks_forward_and_back(site, rows, sort, order):
+    client, name = site
+    tag, data = rows
+    url = f"/site/{name}/admin/api/submissions"
+    params = {"f.tag": tag, "sort": sort, "order": order, "limit": 3}
+    want = (_expected(data, order == "desc") if sort == "created_at"
+            else sorted((i for i, _ in data), reverse=order == "desc"))
+
+    fwd = _walk(client, url, params)
+    assert [[it["id"] for it in p["items"]] for p in fwd] == [want[:3], want[3:6], want[6:]]
+    assert fwd[0]["prev_cursor"] is None
+    assert fwd[0]["total"] == len(data) and fwd[0]["total_exact"]
+    side = "before" if order == "desc" else "after"
+    assert set(fwd[0]["next_cursor"]) == ({f"{side}_id", f"{side}_at"} if sort == "created_at"
+                                          else {f"{side}_id"})
+
+    # 从最后一页往回翻（反方向：先按反序取离游标最近的一页再翻回来）
+    back = _walk(client, url, params, "prev_cursor", fwd[-1]["prev_cursor"])
+    assert [[it["id"] for it in p["items"]] for p in back] == [want[3:6], want[:3]]
+    assert back[-1]["prev_cursor"] is None
+    assert back[-1]["next_cursor"] is not None
+
+
+def test_cursor_survives_deleting_the_cursor_row(site, rows, db):
+    client, name = site
+    tag, data = rows
+    url = f"/site/{name}/admin/api/submissions"
+    params = {"f.tag": tag, "sort": "created_at", "limit": 3}
+    want = _expected(data, True)
+    cur = client.get(url, query_string=params).get_json()["next_cursor"]
+    assert cur["before_id"] == want[2]
+    with db.cursor() as c:
+        c.execute(f'DELETE FROM "{A._safe_schema(name)}".submissions WHERE id=%s', (want[2],))
+    j = client.get(url, query_string={**params, **cur}).get_json()
+    assert [it["id"] for it in j["items"]] == want[3:6]
+
+
+def test_null_created_at_cursor_is_minus_infinity(site, rows):
+    client, name = site
+    tag, data = rows
+    url = f"/site/{name}/admin/api/submissions"
+    j = client.get(url, query_string={"f.tag": tag, "sort": "created_at", "order": "asc", "limit": 1}).get_json()
+    assert j["next_cursor"]["after_at"] == "-infinity"
+
+
+@pytest.mark.parametrize("bad", [{"before_at": "not-a-time", "before_id": 1},
+                                 {"created_from": "yesterday"}])
+def test_bad_cursor_or_filter_is_400(site, bad):
+    client, name = site
+    r = client.get(f"/site/{name}/admin/api/submissions", query_string={"sort": "created_at", **bad})
+    assert r.status_code == 400
+    assert r.get_json()["ok"] is False
+
+
+# ========= 关键词搜索：% _ 按字面 =========
+def test_search_matches_like_metacharacters_literally(site, db):
+    client, name = site
+    tag = uuid.uuid4().hex[:8]
+    ids = []
+    with db.cursor() as c:
+        for note in ("100% done", "1000 done", "a_b", "axb"):
+            data = {"tag": tag, "note": note}
+            c.execute(f'INSERT INTO "{A._safe_schema(name)}".submissions(data, search_tsv) '
+                      "VALUES (%s, array_to_tsvector(%s::TEXT[])) RETURNING id",
+                      (json.dumps(data), A._search_tokens(data)))
+            ids.append(c.fetchone()[0])
+    url = f"/site/{name}/admin/api/submissions"
+    for q, want in (("100%", [ids[0]]), ("１００％", [ids[0]]), ("a_b", [ids[2]])):
+        j = client.get(url, query_string={"f.tag": tag, "q": q, "sort": "id"}).get_json()
+        assert [it["id"] for it in j["items"]] == want, q
@@ -0,0 +1,168 @@
+import hashlib
+import io
+import os
+
+import pytest
+
+import app as A
+from conftest import FILE_FIELD
+
+
+# ========= 分片上传 =========
+@pytest.fixture
+def chunked(site, tmp_path, monkeypatch):
+    """每个用例一个空的上传目录（限额按 .partial/ 里的存量算）。"""
+    monkeypatch.setitem(A.app.config, "UPLOAD_FOLDER", str(tmp_path))
+    return site
+
+
+def _init(client, name, size, ip="203.0.113.1", **body):
+    return client.post(f"/site/{name}/upload/init",
+                       json={"field": FILE_FIELD, "filename": "a.bin", "size": size, **body},
+                       headers={"X-Forwarded-For": ip})
+
+
+def _put(client, name, uid, offset, data):
+    return client.put(f"/site/{name}/upload/{uid}", data=data, headers={"Upload-Offset": str(offset)})
+
+
+def test_chunked_upload_resumes_at_offset(chunked):
+    client, name = chunked
+    data = os.urandom(1000)
+    r = _init(client, name, len(data), sha256=hashlib.sha256(data).hexdigest())
+    assert r.status_code == 200
+    uid = r.get_json()["upload_id"]
+    assert r.get_json()["offset"] == 0
+
+    assert _put(client, name, uid, 0, data[:400]).get_json()["offset"] == 400
+    assert client.get(f"/site/{name}/upload/{uid}").get_json()["offset"] == 400
+
+    r = client.post(f"/site/{name}/upload/{uid}/complete")
+    assert r.status_code == 409 and r.get_json()["offset"] == 400
+
+    # 断线重传同一段：偏移量对不上，409 带上当前 offset
+    r = _put(client, name, uid, 0, data[:400])
+    assert r.status_code == 409 and r.get_json()["offset"] == 400
+
+    assert _put(client, name, uid, 400, data[400:]).get_json()["offset"] == 1000
+    r = client.post(f"/site/{name}/upload/{uid}/complete")
+    assert r.status_code == 200 and r.get_json()["done"] is True
+    assert client.post(f"/site/{name}/upload/{uid}/complete").get_json()["done"] is True
+
+    took = A._chunk_take(name, uid, FILE_FIELD)
+    assert took is not None
+    url, blob = took
+    assert blob[1] == hashlib.sha256(data).hexdigest() and blob[2] == 1000
+    with open(A._blob_path(name, blob[1]), "rb") as f:
+        assert f.read() == data
+
+
+def test_chunked_upload_rejects_wrong_hash(chunked):
+    client, name = chunked
+    uid = _init(client, name, 3, sha256="0" * 64).get_json()["upload_id"]
+    _put(client, name, uid, 0, b"abc")
+    assert client.post(f"/site/{name}/upload/{uid}/complete").status_code == 422
+    assert client.get(f"/site/{name}/upload/{uid}").status_code == 404
+
+
+def test_chunked_upload_size_cap(chunked, monkeypatch):
+    client, name = chunked
+    monkeypatch.setattr(A, "CHUNK_UPLOAD_MAX_BYTES", 100)
+    assert _init(client, name, 101).status_code == 413
+    assert _init(client, name, 0).status_code == 413
+
+    uid = _init(client, name, 10).get_json()["upload_id"]
+    r = _put(client, name, uid, 0, b"x" * 11)   # 超出 init 时声明的大小
+    assert r.status_code == 413 and r.get_json()["offset"] == 10
+
+
+def test_chunked_upload_validates_field_and_size(chunked):
+    client, name = chunked
+    r = client.post(f"/site/{name}/upload/init", json={"field": "name", "filename": "a.bin", "size": 1})
+    assert r.status_code == 400
+    r = client.post(f"/site/{name}/upload/init", json={"field": FILE_FIELD, "filename": "a.bin", "size": "x"})
+    assert r.status_code == 400
+    assert client.post("/site/no_such_site_x/upload/init", json={"size": 1}).status_code == 404
+    assert client.get(f"/site/{name}/upload/{'0' * 32}").status_code == 404
+    assert client.get(f"/site/{name}/upload/..%2F..%2Fapp").status_code == 404
+
+
+def test_chunked_upload_per_ip_count_quota(chunked, monkeypatch):
+    client, name = chunked
+    monkeypatch.setattr(A, "CHUNK_QUOTA_IP_UPLOADS", 2)
+    assert _init(client, name, 1).status_code == 200
+    assert _init(client, name, 1).status_code == 200
+    assert _init(client, name, 1).status_code == 429
+    # 额度按代理后面的客户端地址算，另一个客户端不受影响
+    assert _init(client, name, 1, ip="203.0.113.2").status_code == 200
+
+
+def test_chunked_upload_byte_quotas(chunked, monkeypatch):
+    client, name = chunked
+    monkeypatch.setattr(A, "CHUNK_QUOTA_IP_BYTES", 100)
+    monkeypatch.setattr(A, "CHUNK_QUOTA_SITE_BYTES", 150)
+    assert _init(client, name, 60).status_code == 200
+    assert _init(client, name, 50).status_code == 429
+    assert _init(client, name, 50, ip="203.0.113.2").status_code == 200
+    assert _init(client, name, 50, ip="203.0.113.3").status_code == 429   # 站点总额
+
+
+def test_referenced_upload_frees_quota(chunked, monkeypatch):
+    client, name = chunked
+    monkeypatch.setattr(A, "CHUNK_QUOTA_IP_UPLOADS", 1)
+    uid = _init(client, name, 3).get_json()["upload_id"]
+    _put(client, name, uid, 0, b"abc")
+    client.post(f"/site/{name}/upload/{uid}/complete")
+    assert _init(client, name, 1).status_code == 429
+    assert A._chunk_take(name, uid, FILE_FIELD) is not None
+    assert _init(client, name, 1).status_code == 200
+
+
+# ========= 缩略图档位 / 图片头 =========
+def test_thumb_width_buckets(monkeypatch):
+    monkeypatch.setattr(A, "THUMB_WIDTHS", [160, 320, 640, 1280])
+    assert [A._thumb_width(w) for w in (1, 160, 161, 320, 700, 1280, 5000)] == \
+        [160, 160, 320, 320, 1280, 1280, 1280]
+
+
+@pytest.mark.parametrize("fmt, kw, mime", [
+    ("PNG", {}, "image/png"),
+    ("GIF", {}, "image/gif"),
+    ("BMP", {}, "image/bmp"),
+    ("JPEG", {}, "image/jpeg"),
+    ("JPEG", {"progressive": True}, "image/jpeg"),
+    ("WEBP", {}, "image/webp"),                      # VP8
+    ("WEBP", {"lossless": True}, "image/webp"),      # VP8L
+])
+def test_image_info(tmp_path, fmt, kw, mime):
+    Image = pytest.importorskip("PIL.Image")
+    path = tmp_path / "img"
+    Image.new("RGB", (37, 23), "red").save(path, fmt, **kw)
+    assert A._image_info(str(path)) == (mime, 37, 23)
+
+
+def test_image_info_webp_extended_and_jpeg_with_exif(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    path = tmp_path / "img"
+    Image.new("RGBA", (41, 19), (255, 0, 0, 128)).save(path, "WEBP")   # 带 alpha -> VP8X
+    assert A._image_info(str(path)) == ("image/webp", 41, 19)
+    exif = Image.Exif()
+    exif[0x010E] = "x" * 5000                                             # SOF 前面有个长 APP1 段
+    Image.new("RGB", (64, 48)).save(path, "JPEG", exif=exif)
+    assert A._image_info(str(path)) == ("image/jpeg", 64, 48)
+
+
+def test_image_info_rejects_non_images(tmp_path):
+    for name, data in (("txt", b"hello world"), ("empty", b""), ("jpg", b"\xff\xd8\xff\xe0\x00")):
+        (tmp_path / name).write_bytes(data)
+        assert A._image_info(str(tmp_path / name)) is None
+    assert A._image_info(str(tmp_path / "missing")) is None
+
+
+# ========= 下载文件名 =========
+@pytest.mark.parametrize("filename", ["export.csv", "报名表_2024.xlsx", "Café résumé.zip", 'a "b".csv'])
+def test_download_name_matches_send_file(filename):
+    with A.app.test_request_context():
+        want = A.send_file(io.BytesIO(b""), as_attachment=True, download_name=filename)
+        got = A._set_download_name(A.make_response(""), filename)
+        assert got.headers["Content-Disposition"] == want.headers["Content-Disposition"]